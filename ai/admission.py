@@ -0,0 +1,182 @@
+# ai/admission.py
+"""
+Admission control for the expensive API routes.
+
+Each budget allows a fixed number of requests to run at once and a small
+bounded queue of waiters. When the queue is full, or a waiter has queued
+longer than its timeout, the request is rejected immediately with
+503 + Retry-After. Overload then produces fast rejections instead of
+piling up more diffusion runs or uploads than the box can hold.
+
+Cheap routes (/health, /metrics) are not budgeted. Flask uses the blocking
+slot(); the ASGI app uses async_slot() on its event loop.
+
+Configuration, per budget NAME in {GENERATE, EXTRACT, OPTIMIZE, SCORE}:
+    CHROMA_<NAME>_CONCURRENCY   requests running at once
+    CHROMA_<NAME>_QUEUE         requests allowed to wait for a slot
+    CHROMA_<NAME>_QUEUE_TIMEOUT seconds a request may wait before rejection
+"""
+import os
+import math
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+
+from metrics import ADMISSION_IN_FLIGHT, ADMISSION_QUEUE_DEPTH, ADMISSION_REJECTIONS
+
+class Overloaded(Exception):
+    """Raised when a request cannot be admitted; carries a Retry-After hint in seconds."""
+
+    def __init__(self, budget, reason, retry_after):
+        super().__init__(f"{budget} budget is full ({reason})")
+        self.budget = budget
+        self.reason = reason
+        self.retry_after = retry_after
+
+class AdmissionLimiter:
+    def __init__(self, name, concurrency, queue_size, queue_timeout):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.queue_size = max(0, queue_size)
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        # Smoothed seconds a request holds a slot, for Retry-After estimates
+        self.service_time = 1.0
+        self._cond = threading.Condition()
+        self._async_waiters = deque()
+
+    def retry_after(self):
+        backlog = (self.waiting + 1) / self.concurrency
+        return max(1, math.ceil(self.service_time * backlog))
+
+    def _reject(self, reason):
+        ADMISSION_REJECTIONS.inc(self.name, reason)
+        return Overloaded(self.name, reason, self.retry_after())
+
+    def _admitted(self):
+        self.active += 1
+        ADMISSION_IN_FLIGHT.set(self.active, self.name)
+
+    def _released(self, held):
+        self.active -= 1
+        self.service_time = 0.8 * self.service_time + 0.2 * held
+        ADMISSION_IN_FLIGHT.set(self.active, self.name)
+
+    # --- Blocking (Flask worker threads) ---
+    def acquire(self):
+        with self._cond:
+            # Newcomers queue behind existing waiters so admission stays FIFO-ish
+            if self.active < self.concurrency and self.waiting == 0:
+                self._admitted()
+                return
+            if self.waiting >= self.queue_size:
+                raise self._reject("queue_full")
+            self.waiting += 1
+            ADMISSION_QUEUE_DEPTH.set(self.waiting, self.name)
+            try:
+                admitted = self._cond.wait_for(lambda: self.active < self.concurrency, self.queue_timeout)
+            finally:
+                self.waiting -= 1
+                ADMISSION_QUEUE_DEPTH.set(self.waiting, self.name)
+            if not admitted:
+                raise self._reject("timeout")
+            self._admitted()
+
+    def release(self, held):
+        with self._cond:
+            self._released(held)
+            self._cond.notify()
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - start)
+
+    # --- Async (ASGI event loop; all state is touched from the loop thread) ---
+    async def acquire_async(self):
+        if self.active < self.concurrency and not self._async_waiters:
+            self._admitted()
+            return
+        if self.waiting >= self.queue_size:
+            raise self._reject("queue_full")
+        waiter = asyncio.get_running_loop().create_future()
+        self._async_waiters.append(waiter)
+        self.waiting += 1
+        ADMISSION_QUEUE_DEPTH.set(self.waiting, self.name)
+        try:
+            # The releasing request hands its slot over by resolving the future
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.done():
+                return      # the slot was handed over just as the timeout fired
+            waiter.cancel()
+            raise self._reject("timeout")
+        except asyncio.CancelledError:
+            # Client went away; pass on a slot that was already handed to us
+            if waiter.done() and not waiter.cancelled():
+                self.release_async(0.0)
+            waiter.cancel()
+            raise
+        finally:
+            if waiter in self._async_waiters:
+                self._async_waiters.remove(waiter)
+            self.waiting -= 1
+            ADMISSION_QUEUE_DEPTH.set(self.waiting, self.name)
+
+    def release_async(self, held):
+        self._released(held)
+        while self._async_waiters:
+            waiter = self._async_waiters.popleft()
+            if not waiter.done():
+                self._admitted()
+                waiter.set_result(None)
+                return
+
+    @asynccontextmanager
+    async def async_slot(self):
+        await self.acquire_async()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release_async(time.perf_counter() - start)
+
+    def state(self):
+        return {"in_flight": self.active, "queued": self.waiting,
+                "concurrency": self.concurrency, "queue_size": self.queue_size}
+
+def _budget(name, concurrency, queue_size, queue_timeout):
+    prefix = f"CHROMA_{name.upper()}_"
+    return AdmissionLimiter(
+        name,
+        int(os.getenv(prefix + "CONCURRENCY", concurrency)),
+        int(os.getenv(prefix + "QUEUE", queue_size)),
+        float(os.getenv(prefix + "QUEUE_TIMEOUT", queue_timeout)),
+    )
+
+_CPUS = os.cpu_count() or 1
+
+# Diffusion runs one at a time on a box; CPU routes get one slot per core.
+BUDGETS = {
+    "generate": _budget("generate", 1, 2, 60.0),
+    "extract": _budget("extract", _CPUS, 2 * _CPUS, 15.0),
+    "optimize": _budget("optimize", _CPUS, 2 * _CPUS, 15.0),
+    "score": _budget("score", _CPUS, 2 * _CPUS, 15.0),
+}
+
+ROUTE_BUDGETS = {
+    "/api/generate-palette": BUDGETS["generate"],
+    "/api/extract": BUDGETS["extract"],
+    "/api/optimize": BUDGETS["optimize"],
+    "/api/score": BUDGETS["score"],
+}
+
+def admission_state():
+    return {name: limiter.state() for name, limiter in BUDGETS.items()}
@@ -1,7 +1,10 @@
 # ai/advanced_ai_palette.py
+import io
 import os
 import math
+import time
 import random
+import threading
 import numpy as np
 import torch
 import torch.nn as nn
@@ -11,6 +14,9 @@ from itertools import combinations
 from image_to_palette import extract_palette as extract_palette_from_image
 from torch.utils.data import Dataset, DataLoader
 import pandas as pd
+from metrics import STAGE_SECONDS, OPTIMIZE_EVALUATIONS
+from weights import load_state_dict, build_module
+from reward_components import RewardRegistry
 
 # -------------------------- Color conversion utilities --------------------------
 def hex_to_rgb(hex_color):
@@ -99,6 +105,137 @@ def contrast_ratio(hex1, hex2):
     Lmax, Lmin = max(L1, L2), min(L1, L2)
     return (Lmax + 0.05) / (Lmin + 0.05)
 
+_XYZ_TO_RGB = np.array([[3.2404542, -1.5371385, -0.4985314],
+                        [-0.9692660, 1.8760108, 0.0415560],
+                        [0.0556434, -0.2040259, 1.0572252]])
+_WHITE_XYZ = np.array([0.95047, 1.0, 1.08883])
+
+def wcag_luminance_array(lab):
+    """
+    Vectorized relative_luminance(xyz_to_rgb(*lab_to_xyz(*c))) for an (N, 3) Lab
+    array, including the 8-bit sRGB quantization, so it agrees exactly with the
+    hex colors the palette is returned as.
+    """
+    lab = np.asarray(lab, dtype=np.float64).reshape(-1, 3)
+    fy = (lab[:, 0] + 16) / 116
+    f = np.stack([lab[:, 1] / 500 + fy, fy, fy - lab[:, 2] / 200], axis=1)
+    xyz = np.where(f ** 3 > 0.008856, f ** 3, (f - 16 / 116) / 7.787) * _WHITE_XYZ
+    u = xyz @ _XYZ_TO_RGB.T
+    v = np.where(u <= 0.0031308, 12.92 * u, 1.055 * np.maximum(u, 0) ** (1 / 2.4) - 0.055)
+    c = np.round(np.clip(v, 0, 1) * 255) / 255.0
+    linear = np.where(c <= 0.03928, c / 12.92, ((c + 0.055) / 1.055) ** 2.4)
+    return linear @ np.array([0.2126, 0.7152, 0.0722])
+
+def contrast_matrix(lab):
+    """All-pairs WCAG contrast ratios, (K, K), from one vectorized luminance pass."""
+    lum = wcag_luminance_array(lab)
+    return (np.maximum.outer(lum, lum) + 0.05) / (np.minimum.outer(lum, lum) + 0.05)
+
+# -------------------------- Hard Contrast Constraints --------------------------
+WCAG_LEVELS = {'AA': 4.5, 'AAA': 7.0}
+_L_GRID = np.linspace(0.0, 100.0, 401)
+
+class ContrastConstraint:
+    """
+    Hard WCAG contrast requirement for optimization.
+
+    pairs='roles' requires every secondary/accent color to reach min_ratio
+    against the primary (the pairs contrast_score rewards); pairs='all'
+    requires it between every two colors; a list of (i, j) index pairs
+    constrains just those. repair() projects a palette onto the feasible
+    region by changing only Lab lightness, one color at a time, choosing the
+    smallest lightness change that satisfies all of that color's pairs.
+    """
+
+    def __init__(self, min_ratio=4.5, pairs='roles', max_passes=4):
+        self.min_ratio = float(min_ratio)
+        self.pairs = pairs if pairs in ('roles', 'all') else [tuple(int(i) for i in p) for p in pairs]
+        self.max_passes = max_passes
+
+    @classmethod
+    def from_spec(cls, spec):
+        """Builds a constraint from {'level': 'AA'|'AAA'} or {'min_ratio': x}, plus optional 'pairs'."""
+        if 'min_ratio' in spec:
+            min_ratio = float(spec['min_ratio'])
+        else:
+            level = spec.get('level', 'AA')
+            if level not in WCAG_LEVELS:
+                raise ValueError(f"Unknown WCAG level {level!r}; use one of {sorted(WCAG_LEVELS)}")
+            min_ratio = WCAG_LEVELS[level]
+        return cls(min_ratio, spec.get('pairs', 'roles'))
+
+    def pairs_for(self, lab):
+        """(anchors, pairs): indices that repair must not move, and the constrained pairs."""
+        K = len(lab)
+        if self.pairs == 'roles':
+            roles = assign_roles_lab(np.asarray(lab, dtype=np.float32))
+            primary = roles['primary'][0]
+            return {primary}, [(primary, j) for j in roles['secondary'] + roles['accent']]
+        if self.pairs == 'all':
+            return set(), list(combinations(range(K), 2))
+        return set(), [(i, j) for i, j in self.pairs if i < K and j < K and i != j]
+
+    def violations(self, lab):
+        _, pairs = self.pairs_for(lab)
+        ratios = contrast_matrix(lab)
+        return [(i, j) for i, j in pairs if ratios[i, j] < self.min_ratio]
+
+    def satisfied(self, lab):
+        return not self.violations(lab)
+
+    def _best_lightness(self, color, partner_lum):
+        # Luminance of this a/b at every grid lightness, in one vectorized call
+        grid = np.column_stack([_L_GRID, np.full_like(_L_GRID, color[1]), np.full_like(_L_GRID, color[2])])
+        lum = wcag_luminance_array(grid)[:, None]
+        ratio = (np.maximum(lum, partner_lum) + 0.05) / (np.minimum(lum, partner_lum) + 0.05)
+        ok = (ratio >= self.min_ratio).all(axis=1)
+        if not ok.any():
+            return None
+        candidates = _L_GRID[ok]
+        return float(candidates[np.argmin(np.abs(candidates - color[0]))])
+
+    def repair(self, hex_palette):
+        """Returns (hex palette, feasible) after moving violating colors along L only."""
+        lab = np.array([hex_to_lab(h) for h in hex_palette], dtype=np.float64)
+        for _ in range(self.max_passes):
+            anchors, pairs = self.pairs_for(lab)
+            ratios = contrast_matrix(lab)
+            violated = [(i, j) for i, j in pairs if ratios[i, j] < self.min_ratio]
+            if not violated:
+                return [lab_to_hex(*c) for c in lab], True
+            lum = wcag_luminance_array(lab)
+            for i, j in violated:
+                if ratios[i, j] >= self.min_ratio:
+                    continue  # fixed earlier in this pass
+                movable = [c for c in (j, i) if c not in anchors]
+                options = []
+                for c in movable:
+                    partners = [b if a == c else a for a, b in pairs if c in (a, b)]
+                    L = self._best_lightness(lab[c], lum[partners])
+                    if L is not None:
+                        options.append((abs(L - lab[c, 0]), c, L))
+                if not options:
+                    continue
+                _, c, L = min(options)
+                # Quantize through hex so the checked color is exactly the returned one
+                lab[c] = hex_to_lab(lab_to_hex(L, lab[c, 1], lab[c, 2]))
+                lum[c] = wcag_luminance_array(lab[c])[0]
+                ratios = contrast_matrix(lab)
+        hex_out = [lab_to_hex(*c) for c in lab]
+        return hex_out, self.satisfied(lab)
+
+    def report(self, lab):
+        """Contrast matrix plus the constraint's pairs and whether they all pass."""
+        _, pairs = self.pairs_for(lab)
+        ratios = contrast_matrix(lab)
+        return {
+            "min_ratio": self.min_ratio,
+            "pairs": [[int(i), int(j)] for i, j in pairs],
+            "failing": [[int(i), int(j)] for i, j in pairs if ratios[i, j] < self.min_ratio],
+            "feasible": all(ratios[i, j] >= self.min_ratio for i, j in pairs),
+            "matrix": np.round(ratios, 2).tolist(),
+        }
+
 # -------------------------- Scoring Functions --------------------------
 def harmony_score(lab_palette):
     ab = lab_palette[:, 1:3]
@@ -179,10 +316,80 @@ class PaletteAestheticNet(nn.Module):
         x = torch.sigmoid(self.out(x))
         return x.squeeze(1)
 
+# Rough per-channel extent of CIELAB, so the set model sees inputs near [-1, 1]
+LAB_SCALE = torch.tensor([100.0, 128.0, 128.0])
+
+class PaletteSetNet(nn.Module):
+    """
+    Permutation-invariant (DeepSets) aesthetic model for palettes of any size.
+
+    Each color is embedded independently by phi; masked mean and max pooling
+    over the colors feed rho. Padding positions (mask False) never influence
+    the score, so one batched forward can score palettes of mixed sizes.
+    """
+    variable_k = True
+
+    def __init__(self, hidden_dim=128):
+        super().__init__()
+        self.K = None
+        self.phi = nn.Sequential(
+            nn.Linear(3, hidden_dim), nn.ReLU(),
+            nn.Linear(hidden_dim, hidden_dim), nn.ReLU(),
+        )
+        self.rho = nn.Sequential(
+            nn.Linear(2 * hidden_dim, hidden_dim), nn.ReLU(),
+            nn.Linear(hidden_dim, 1),
+        )
+
+    def forward(self, palette_lab, mask=None):
+        # palette_lab: (B, K, 3); mask: (B, K) bool, True for real colors
+        if mask is None:
+            mask = torch.ones(palette_lab.shape[:2], dtype=torch.bool, device=palette_lab.device)
+        h = self.phi(palette_lab / LAB_SCALE.to(palette_lab.device))
+        m = mask.unsqueeze(-1)
+        count = m.sum(dim=1).clamp(min=1)
+        mean = (h * m).sum(dim=1) / count
+        # Empty palettes would pool -inf; zero them instead
+        maxed = h.masked_fill(~m, float('-inf')).max(dim=1).values
+        maxed = torch.where(torch.isinf(maxed), torch.zeros_like(maxed), maxed)
+        x = torch.sigmoid(self.rho(torch.cat([mean, maxed], dim=1)))
+        return x.squeeze(1)
+
+def is_set_model(model):
+    return getattr(model, 'variable_k', False)
+
+def pad_palettes(lab_palettes):
+    """Stacks (k_i, 3) Lab arrays into a (B, max k, 3) tensor plus a (B, max k) bool mask."""
+    B = len(lab_palettes)
+    K = max((len(p) for p in lab_palettes), default=0)
+    batch = torch.zeros((B, K, 3), dtype=torch.float32)
+    mask = torch.zeros((B, K), dtype=torch.bool)
+    for i, lab in enumerate(lab_palettes):
+        k = len(lab)
+        if k:
+            batch[i, :k] = torch.as_tensor(np.asarray(lab, dtype=np.float32))
+            mask[i, :k] = True
+    return batch, mask
+
+def load_aesthetic_model(path, K=8):
+    """
+    Loads a saved state dict into whichever architecture it was trained with.
+    A .safetensors sibling of `path` is memory-mapped rather than read.
+    """
+    state_dict, source = load_state_dict(path)
+    if any(key.startswith('phi.') for key in state_dict):
+        model = build_module(PaletteSetNet, state_dict)
+    else:
+        model = build_module(lambda: PaletteAestheticNet(K=K), state_dict)
+    model.weights_source = source
+    return model
+
 # -------------------------- Role Assignment --------------------------
 def assign_roles(hex_palette):
-    lab = palette_hexes_to_lab_array(hex_palette)
-    K = len(hex_palette)
+    return assign_roles_lab(palette_hexes_to_lab_array(hex_palette))
+
+def assign_roles_lab(lab):
+    K = len(lab)
     sat = np.linalg.norm(lab[:, 1:3], axis=1)
     L = lab[:, 0]
     
@@ -205,69 +412,359 @@ def assign_roles(hex_palette):
     }
 
 # -------------------------- Composite Reward --------------------------
-def composite_reward(hex_palette, roles, weights=None, model_L=None, k_value=8):
-    if len(hex_palette) < k_value:
-        # Pad with white if the palette is too short
-        padding = ["#FFFFFF"] * (k_value - len(hex_palette))
-        hex_palette.extend(padding)
-    elif len(hex_palette) > k_value:
-        # Truncate if the palette is too long
-        hex_palette = hex_palette[:k_value]
-
-    lab_palette = palette_hexes_to_lab_array(hex_palette)
-    
-    H = harmony_score(lab_palette)
-    D = distinctness_score(lab_palette)
-    P = cohesion_score(lab_palette)
-    W = weight_score(lab_palette, roles)
-    C = contrast_score(lab_palette, roles)
-    
-    # Learned aesthetic score
-    L = 0.5                     # Default
-    if model_L is None:
-        model_L = train_model_aadb()
-        
+WHITE_LAB = np.array(hex_to_lab("#FFFFFF"), dtype=np.float32)
+DEFAULT_WEIGHTS = {'H': 0.25, 'C': 0.25, 'D': 0.2, 'W': 0.1, 'P': 0.1, 'L': 0.1}
+
+def learned_score(lab_palette, model_L):
+    return learned_scores([lab_palette], model_L)[0]
+
+def learned_scores(lab_palettes, model_L):
+    """
+    Scores a batch of palettes with one forward pass. Set models take mixed
+    sizes with a padding mask; fixed-K models get each input padded/truncated.
+    """
     try:
         model_L.eval()
-        pal = torch.from_numpy(lab_palette.astype(np.float32)).unsqueeze(0)
-        with torch.no_grad():
-            L = float(model_L(pal).item())
-            L = max(0.0, min(1.0, L))
+        if is_set_model(model_L):
+            pal, mask = pad_palettes(lab_palettes)
+            args = (pal, mask)
+        else:
+            pal = torch.from_numpy(np.stack([fit_to_k(np.asarray(lab, dtype=np.float32), model_L.K)
+                                             for lab in lab_palettes]))
+            args = (pal,)
+        with torch.no_grad(), STAGE_SECONDS.time("model_forward"):
+            scores = model_L(*args).clamp(0.0, 1.0)
+        return [float(x) for x in scores]
     except Exception as e:
         print(f"Error using model_L: {e}")
-        L = 0.5
-    
-    if weights is None:
-        weights = {'H': 0.25, 'C': 0.25, 'D': 0.2, 'W': 0.1, 'P': 0.1, 'L': 0.1}
-    
-    reward = (weights['H'] * H + weights['C'] * C + weights['D'] * D + 
-              weights['W'] * W + weights['P'] * P + weights['L'] * L)
-    
-    components = {'H': H, 'C': C, 'D': D, 'W': W, 'P': P, 'L': L}
-    return float(reward), components
+        return [0.5] * len(lab_palettes)
+
+# Components declare what they read; composite_reward_lab evaluates only the weighted ones
+# and shares the intermediates between them (see reward_components.py)
+REWARD_COMPONENTS = RewardRegistry()
+
+REWARD_COMPONENTS.intermediate('roles', requires=('lab',))(assign_roles_lab)
+REWARD_COMPONENTS.intermediate('luminance', requires=('lab',))(wcag_luminance_array)
+
+@REWARD_COMPONENTS.intermediate('hue_diff', requires=('lab',))
+def _pairwise_hue_diff(lab):
+    angles = np.degrees(np.arctan2(lab[:, 2], lab[:, 1])) % 360
+    diff = np.abs(angles[:, None] - angles[None, :])
+    return np.minimum(diff, 360 - diff)
+
+@REWARD_COMPONENTS.intermediate('lab_dist', requires=('lab',))
+def _pairwise_lab_dist(lab):
+    return np.linalg.norm(lab[:, None, :] - lab[None, :, :], axis=2)
+
+@REWARD_COMPONENTS.intermediate('ab_dist', requires=('lab',))
+def _pairwise_ab_dist(lab):
+    return np.linalg.norm(lab[:, None, 1:3] - lab[None, :, 1:3], axis=2)
+
+def _upper_mean(matrix):
+    return matrix[np.triu_indices(len(matrix), 1)].mean()
+
+@REWARD_COMPONENTS.component('H', requires=('hue_diff',))
+def _harmony(hue_diff):
+    # harmony_score from the shared hue-difference matrix
+    if len(hue_diff) < 2:
+        return 0.5
+    return max(0.0, min(1.0, (_upper_mean(hue_diff) - 20.0) / (110.0 - 20.0)))
+
+@REWARD_COMPONENTS.component('D', requires=('lab_dist',))
+def _distinctness(lab_dist):
+    mean_d = _upper_mean(lab_dist) if len(lab_dist) > 1 else 0
+    return max(0.0, min(1.0, (mean_d - 6) / (40 - 6)))
+
+@REWARD_COMPONENTS.component('P', requires=('ab_dist',))
+def _cohesion(ab_dist):
+    return np.exp(-ab_dist.mean() / 20)
+
+REWARD_COMPONENTS.component('W', requires=('lab', 'roles'))(weight_score)
+
+@REWARD_COMPONENTS.component('C', requires=('luminance', 'roles'))
+def _contrast(luminance, roles):
+    # contrast_score from the shared WCAG luminances
+    if not roles.get('primary'):
+        return 0.5
+    others = roles.get('secondary', []) + roles.get('accent', [])
+    if not others:
+        return 1.0
+    Lp = luminance[roles['primary'][0]]
+    Lo = luminance[others]
+    ratio = (np.maximum(Lp, Lo) + 0.05) / (np.minimum(Lp, Lo) + 0.05)
+    return np.mean(1 / (1 + np.exp(-1.5 * (ratio - 4.5))))
+
+@REWARD_COMPONENTS.component('L', requires=('lab', 'model_L'))
+def _learned(lab, model_L):
+    # Without a model the learned term is neutral rather than trained on the spot
+    if model_L is None:
+        return 0.5
+    # Set models take any K; a fixed-K model's input alone is padded/truncated
+    return learned_score(lab.astype(np.float32), model_L)
+
+def composite_reward(hex_palette, roles, weights=None, model_L=None, k_value=8, **inputs):
+    return composite_reward_lab(palette_hexes_to_lab_array(hex_palette), roles,
+                                weights=weights, model_L=model_L, k_value=k_value, **inputs)
+
+def fit_to_k(lab_palette, k_value):
+    # Pads with white / truncates to exactly k_value colors (returns a copy when padding)
+    if len(lab_palette) < k_value:
+        padding = np.repeat(WHITE_LAB[None, :], k_value - len(lab_palette), axis=0)
+        return np.concatenate([lab_palette, padding])
+    return lab_palette[:k_value]
+
+def composite_reward_lab(lab_palette, roles, weights=None, model_L=None, k_value=8, **inputs):
+    """
+    Weighted sum of the REWARD_COMPONENTS named in `weights` (DEFAULT_WEIGHTS
+    when None). Only components with a non-zero weight are computed and
+    returned, so a reduced weight set is proportionally cheaper. roles may be
+    None to derive them, and extra keyword inputs feed custom components.
+
+    Components are computed on the real palette: padding with white skewed
+    every pairwise score. k_value is kept for call compatibility.
+    """
+    lab = np.asarray(lab_palette, dtype=np.float64).reshape(-1, 3)
+    return REWARD_COMPONENTS.evaluate(DEFAULT_WEIGHTS if weights is None else weights,
+                                      lab=lab, roles=roles, model_L=model_L, **inputs)
+
+# -------------------------- Incremental Scoring --------------------------
+def _wcag_luminance(lab):
+    return relative_luminance(xyz_to_rgb(*lab_to_xyz(*lab)))
+
+def _hue_angle(lab):
+    return math.degrees(math.atan2(lab[2], lab[1])) % 360
+
+class IncrementalScorer:
+    """
+    Stateful composite_reward for palettes that change one color at a time.
+
+    Caches the pairwise hue-angle, Lab-distance and a/b-distance matrices plus
+    per-color chroma and WCAG luminance, together with the running pair sums
+    behind harmony, distinctness and cohesion. update(i, lab) rewrites only
+    row/column i and adjusts the sums in O(K); score() then costs O(K log K)
+    for role assignment plus one model forward, instead of the O(K^2) rescoring
+    and K hex conversions of a full composite_reward.
+
+    Scores the palette as given, for any K, and matches composite_reward.
+    The running sums are rebuilt from scratch every REFRESH_EVERY updates, so
+    float drift cannot accumulate over a long search.
+    """
+    REFRESH_EVERY = 256
+
+    def __init__(self, lab_palette, weights=None, model_L=None):
+        self.lab = np.array(lab_palette, dtype=np.float64).reshape(-1, 3)
+        self.K = len(self.lab)
+        self.weights = weights or DEFAULT_WEIGHTS
+        self.model_L = model_L
+        self.refresh()
+
+    def refresh(self):
+        """Rebuilds every cache from self.lab (also clears accumulated float drift)."""
+        lab = self.lab
+        self.updates = 0
+        self.angles = np.array([_hue_angle(c) for c in lab])
+        self.chroma = np.linalg.norm(lab[:, 1:3], axis=1)
+        self.luminance = np.array([_wcag_luminance(c) for c in lab])
+        diff = np.abs(self.angles[:, None] - self.angles[None, :])
+        self.hue_diff = np.minimum(diff, 360 - diff)
+        self.lab_dist = np.linalg.norm(lab[:, None, :] - lab[None, :, :], axis=2)
+        self.ab_dist = np.linalg.norm(lab[:, None, 1:3] - lab[None, :, 1:3], axis=2)
+        self.hue_sum = self.hue_diff.sum() / 2
+        self.lab_sum = self.lab_dist.sum() / 2
+        self.ab_sum = self.ab_dist.sum()
+
+    def update(self, i, new_lab):
+        """Replaces color i and patches row/column i of every cached matrix."""
+        lab = self.lab
+        lab[i] = new_lab
+        self.chroma[i] = math.hypot(lab[i, 1], lab[i, 2])
+        self.luminance[i] = _wcag_luminance(lab[i])
+        self.angles[i] = _hue_angle(lab[i])
+
+        diff = np.abs(self.angles - self.angles[i])
+        hue_row = np.minimum(diff, 360 - diff)
+        lab_row = np.linalg.norm(lab - lab[i], axis=1)
+        ab_row = np.linalg.norm(lab[:, 1:3] - lab[i, 1:3], axis=1)
+
+        self.hue_sum += hue_row.sum() - self.hue_diff[i].sum()
+        self.lab_sum += lab_row.sum() - self.lab_dist[i].sum()
+        self.ab_sum += 2 * (ab_row.sum() - self.ab_dist[i].sum())
+        for matrix, row in ((self.hue_diff, hue_row), (self.lab_dist, lab_row), (self.ab_dist, ab_row)):
+            matrix[i, :] = row
+            matrix[:, i] = row
+        self.updates += 1
+        if self.updates >= self.REFRESH_EVERY:
+            self.refresh()
+
+    def roles(self):
+        # Same rules (and tie-breaking) as assign_roles, read from the caches.
+        K = self.K
+        primary = int(np.argmax(self.chroma))
+        remaining = [i for i in range(K) if i != primary]
+        if remaining:
+            dists = self.lab_dist[remaining, primary]
+            idx_secondary = sorted(remaining, key=lambda i: -dists[i % len(dists)])[:2]
+        else:
+            idx_secondary = []
+        remaining = [i for i in range(K) if i != primary and i not in idx_secondary]
+        idx_accent = sorted(remaining, key=lambda i: -self.chroma[i])[:2] if remaining else []
+        return {'primary': [primary], 'secondary': idx_secondary, 'accent': idx_accent}
+
+    def _contrast(self, roles):
+        others = roles['secondary'] + roles['accent']
+        if not others:
+            return 1.0
+        Lp = self.luminance[roles['primary'][0]]
+        Lo = self.luminance[others]
+        ratio = (np.maximum(Lp, Lo) + 0.05) / (np.minimum(Lp, Lo) + 0.05)
+        return float(np.mean(1 / (1 + np.exp(-1.5 * (ratio - 4.5)))))
+
+    def score(self):
+        """Returns (reward, components, roles) for the current palette."""
+        K, w = self.K, self.weights
+        n_pairs = K * (K - 1) / 2
+        roles = self.roles()
+        if n_pairs:
+            H = float(max(0.0, min(1.0, (self.hue_sum / n_pairs - 20.0) / (110.0 - 20.0))))
+            D = float(max(0.0, min(1.0, (self.lab_sum / n_pairs - 6) / (40 - 6))))
+        else:
+            H, D = 0.5, 0.0
+        P = float(np.exp(-(self.ab_sum / (K * K)) / 20))
+        # Like composite_reward, zero-weight components (above all the model forward) are skipped
+        components = {'H': H, 'D': D, 'P': P}
+        if w.get('W'):
+            components['W'] = weight_score(self.lab, roles)
+        if w.get('C'):
+            components['C'] = self._contrast(roles)
+        if w.get('L'):
+            components['L'] = 0.5 if self.model_L is None else \
+                learned_score(self.lab.astype(np.float32), self.model_L)
+        components = {k: v for k, v in components.items() if w.get(k)}
+        reward = sum(w[k] * components[k] for k in components)
+        return float(reward), components, roles
+
+def coordinate_moves(K, rng=random):
+    """
+    Yields (index, lab_noise) single-color moves, sweeping the palette in a
+    fresh random order each pass. Noise matches optimize_palette's per-color moves.
+    """
+    while True:
+        order = list(range(K))
+        rng.shuffle(order)
+        for i in order:
+            yield i, (rng.gauss(0, 5), rng.gauss(0, 10), rng.gauss(0, 10))
+
+# -------------------------- Palette Result --------------------------
+class PaletteResult:
+    """
+    A palette converted and scored exactly once.
+
+    Carries the Lab/RGB arrays, roles and reward components from extraction
+    through optimization to formatting, so the routes never re-run
+    assign_roles, composite_reward or the per-color hex conversions.
+    """
+    __slots__ = ('hex', 'rgb', 'lab', 'roles', 'score', 'components')
+
+    def __init__(self, hex, rgb, lab, roles, score, components):
+        self.hex = hex
+        self.rgb = rgb
+        self.lab = lab
+        self.roles = roles
+        self.score = score
+        self.components = components
+
+    @classmethod
+    def from_hex(cls, hex_palette, weights=None, model_L=None):
+        hex_palette = list(hex_palette)
+        rgb = np.array([hex_to_rgb(h) for h in hex_palette], dtype=np.uint8).reshape(-1, 3)
+        lab = np.array([xyz_to_lab(*rgb_to_xyz(c)) for c in rgb.tolist()], dtype=np.float32).reshape(-1, 3)
+        roles = assign_roles_lab(lab)
+        score, components = composite_reward_lab(lab, roles, weights=weights, model_L=model_L)
+        return cls(hex_palette, rgb, lab, roles, score, components)
+
+    def role_of(self, i):
+        for role in ('primary', 'secondary', 'accent'):
+            if i in self.roles.get(role, []):
+                return role
+        return 'neutral'
+
+    def __len__(self):
+        return len(self.hex)
+
+    def __repr__(self):
+        return f"PaletteResult(hex={self.hex!r}, score={self.score:.4f})"
 
 # -------------------------- Simple Optimization --------------------------
 def optimize_palette(init_hex, steps=100, episodes_per_step=4, lr=1e-3, 
-                    seed=42, model_L=None, **kwargs):
+                    seed=42, model_L=None, moves="all", time_limit=None, contrast=None, **kwargs):
+    best = optimize_palette_result(init_hex, steps=steps, episodes_per_step=episodes_per_step,
+                                   seed=seed, model_L=model_L, moves=moves, time_limit=time_limit,
+                                   contrast=contrast)
+    return best.hex, best.roles, best.score, best.components
+
+def optimize_palette_result(init_hex, steps=100, episodes_per_step=4, seed=42, model_L=None,
+                            moves="all", time_limit=None, contrast=None):
+    """
+    Random-search optimization returning a PaletteResult.
+
+    moves="all" perturbs every color of each candidate and rescores it in full;
+    moves="coordinate" perturbs one color per candidate and rescores it with an
+    IncrementalScorer, which is several times cheaper per evaluation and scales
+    to design-system sized palettes (K=16-32).
+    time_limit (seconds) stops the search early once the wall-clock budget is spent.
+
+    contrast (ContrastConstraint) makes WCAG contrast a hard constraint: every
+    candidate is repaired along Lab lightness before scoring and candidates that
+    cannot be repaired are discarded unscored, so only valid palettes compete.
+    An infeasible starting palette is replaced by the first feasible candidate.
+    """
+    best = None
+    for _, best in optimize_palette_steps(init_hex, steps=steps, episodes_per_step=episodes_per_step,
+                                          seed=seed, model_L=model_L, moves=moves,
+                                          time_limit=time_limit, contrast=contrast):
+        pass
+    return best
+
+def optimize_palette_steps(init_hex, steps=100, episodes_per_step=4, seed=42, model_L=None,
+                           moves="all", time_limit=None, contrast=None):
+    """
+    The search of optimize_palette_result, step by step: yields (step, best)
+    for the starting palette (step 0) and after each step, so callers can show
+    intermediate palettes of the very search whose last yield is the result.
+    moves="coordinate" yields only the start and the final palette.
+
+    Draws from its own seeded random.Random rather than the global generator,
+    so interleaved searches (e.g. streamed ones on other threads) stay reproducible.
+    """
     # Simplified palette optimization using random search with gradient-like improvements
-    random.seed(seed)
-    np.random.seed(seed)
+    rng = random.Random(seed)
     
-    K = len(init_hex)
-    best_palette = init_hex.copy()
-    best_roles = assign_roles(best_palette)
-    best_score, best_components = composite_reward(best_palette, best_roles, model_L=model_L)
+    deadline = time.perf_counter() + time_limit if time_limit else None
+    best_feasible = True
+    if contrast is not None:
+        init_hex, best_feasible = contrast.repair(init_hex.hex if isinstance(init_hex, PaletteResult) else init_hex)
+    best = init_hex if isinstance(init_hex, PaletteResult) else \
+        PaletteResult.from_hex(init_hex, model_L=model_L)
+    if moves not in ("all", "coordinate"):
+        raise ValueError(f"Unknown moves mode: {moves!r}")
+    yield 0, best
+    if moves == "coordinate":
+        yield steps, _optimize_coordinate(best, steps * episodes_per_step, model_L, deadline, contrast,
+                                          best_feasible, rng=rng)
+        return
     
     for step in range(steps):
+        step_start = time.perf_counter()
+        if deadline and step_start > deadline:
+            break
         for episode in range(episodes_per_step):
             # Create a variation of current best palette
             candidate_palette = []
-            for hex_color in best_palette:
-                lab = hex_to_lab(hex_color)
+            for hex_color, lab in zip(best.hex, best.lab.tolist()):
                 # Add small random variations
-                noise_L = random.gauss(0, 5)
-                noise_a = random.gauss(0, 10)
-                noise_b = random.gauss(0, 10)
+                noise_L = rng.gauss(0, 5)
+                noise_a = rng.gauss(0, 10)
+                noise_b = rng.gauss(0, 10)
                 
                 new_lab = (
                     max(0, min(100, lab[0] + noise_L)),
@@ -281,20 +778,137 @@ def optimize_palette(init_hex, steps=100, episodes_per_step=4, lr=1e-3,
                 except:
                     candidate_palette.append(hex_color)  # Keep original if conversion fails
             
+            if contrast is not None:
+                candidate_palette, feasible = contrast.repair(candidate_palette)
+                if not feasible:
+                    continue
+            
             # Evaluate candidate
-            candidate_roles = assign_roles(candidate_palette)
-            candidate_score, candidate_components = composite_reward(
-                candidate_palette, candidate_roles, model_L=model_L
-            )
+            with STAGE_SECONDS.time("optimize_evaluation"):
+                candidate = PaletteResult.from_hex(candidate_palette, model_L=model_L)
+            OPTIMIZE_EVALUATIONS.inc()
             
-            # Update if better
-            if candidate_score > best_score:
-                best_palette = candidate_palette
-                best_roles = candidate_roles
-                best_score = candidate_score
-                best_components = candidate_components
-    
-    return best_palette, best_roles, best_score, best_components
+            # Update if better (any feasible candidate beats an infeasible start)
+            if candidate.score > best.score or not best_feasible:
+                best = candidate
+                best_feasible = True
+        STAGE_SECONDS.observe(time.perf_counter() - step_start, "optimize_step")
+        yield step + 1, best
+
+def _optimize_coordinate(start, evaluations, model_L, deadline=None, contrast=None, feasible=True, rng=random):
+    palette = list(start.hex)
+    scorer = IncrementalScorer(start.lab, model_L=model_L)
+    best_score, _, _ = scorer.score()
+    moves = coordinate_moves(len(palette), rng=rng)
+
+    for _ in range(evaluations):
+        if deadline and time.perf_counter() > deadline:
+            break
+        i, (noise_L, noise_a, noise_b) = next(moves)
+        old_lab = scorer.lab[i].copy()
+        new_lab = (
+            max(0, min(100, old_lab[0] + noise_L)),
+            max(-128, min(127, old_lab[1] + noise_a)),
+            max(-128, min(127, old_lab[2] + noise_b))
+        )
+        # Quantize through hex so the scored color is exactly the one returned
+        candidate = list(palette)
+        candidate[i] = lab_to_hex(*new_lab)
+        if contrast is not None:
+            # Repair may move partners of color i too; only changed colors are rescored
+            candidate, candidate_feasible = contrast.repair(candidate)
+            if not candidate_feasible:
+                continue
+        changed = [j for j in range(len(palette)) if candidate[j] != palette[j]]
+        old_labs = {j: scorer.lab[j].copy() for j in changed}
+        with STAGE_SECONDS.time("optimize_evaluation"):
+            for j in changed:
+                scorer.update(j, np.array(hex_to_lab(candidate[j]), dtype=np.float32))
+            candidate_score, _, _ = scorer.score()
+        OPTIMIZE_EVALUATIONS.inc()
+
+        if candidate_score > best_score or not feasible:
+            best_score = candidate_score
+            palette = candidate
+            feasible = True
+        else:
+            for j in changed:
+                scorer.update(j, old_labs[j])
+
+    return PaletteResult.from_hex(palette, model_L=model_L)
+
+# -------------------------- Multi-start Optimization --------------------------
+_multistart_pool = None
+_multistart_pool_lock = threading.Lock()
+
+def _get_multistart_pool(workers=None):
+    global _multistart_pool
+    # Locked, so concurrent first requests share one pool instead of each creating their own
+    with _multistart_pool_lock:
+        if _multistart_pool is None:
+            from thread_governor import process_pool
+            _multistart_pool = process_pool(workers or os.cpu_count() or 1)
+        return _multistart_pool
+
+def _multistart_run(init_hex, image_input, seed, steps, time_limit, model_L, moves, contrast=None):
+    start = time.perf_counter()
+    if image_input is not None:
+        if isinstance(image_input, bytes):
+            # Uploads travel as their encoded bytes and are decoded here, in the worker
+            image_input = io.BytesIO(image_input)
+        # Start from an extraction variant: different pixel sample and k-means init
+        variant, _, _ = extract_palette_from_image(image_input, num_colors=len(init_hex),
+                                                   hex_only=True, random_state=seed)
+        if variant:
+            init_hex = variant
+    result = optimize_palette_result(init_hex, steps=steps, seed=seed, model_L=model_L,
+                                     moves=moves, time_limit=time_limit, contrast=contrast)
+    return seed, result, time.perf_counter() - start
+
+def optimize_palette_multistart(init_hex, starts=4, steps=100, time_limit=None, model_L=None,
+                                moves="all", image_input=None, seed=42, workers=None, contrast=None):
+    """
+    Runs `starts` independent optimizations with seeds seed, seed+1, ... across a
+    process pool and keeps the best.
+
+    Every run gets the same time_limit budget. With image_input (a path,
+    encoded bytes, a file-like object or a PIL image) runs after the first
+    start from an extract_palette variant sampled with their own seed instead
+    of init_hex. The first run always uses
+    init_hex and `seed`, so starts=1 reproduces optimize_palette_result.
+
+    Returns (best PaletteResult, spread) where spread summarises every run's score.
+    """
+    if isinstance(image_input, bytearray):
+        image_input = bytes(image_input)
+    elif hasattr(image_input, "read"):
+        # File-like objects don't pickle; their (still encoded) bytes do, and are far
+        # smaller than the decoded pixels each worker would otherwise receive
+        image_input = image_input.read()
+
+    pool = _get_multistart_pool(workers)
+    futures = [
+        pool.submit(_multistart_run, list(init_hex), image_input if i > 0 else None,
+                    seed + i, steps, time_limit, model_L, moves, contrast)
+        for i in range(starts)
+    ]
+    runs = [f.result() for f in futures]
+
+    scores = np.array([result.score for _, result, _ in runs])
+    # With a contrast constraint, a feasible run always beats an infeasible one
+    best_seed, best, _ = max(runs, key=lambda run: (contrast is None or contrast.satisfied(run[1].lab),
+                                                    run[1].score))
+    spread = {
+        "starts": starts,
+        "best_seed": best_seed,
+        "scores": [float(x) for x in scores],
+        "min": float(scores.min()),
+        "max": float(scores.max()),
+        "mean": float(scores.mean()),
+        "std": float(scores.std()),
+        "run_seconds": [round(seconds, 4) for _, _, seconds in runs],
+    }
+    return best, spread
 
 # -------------------------- Training Function --------------------------
 # 1. Load AADB metadata
@@ -330,10 +944,16 @@ def load_aadb_metadata(aadb_csv_path, images_dir):
 
 # 3. Dataset class
 class AADBBasedPaletteDataset(Dataset):
-    def __init__(self, metadata_df, K=5, transform=None):
+    """
+    Yields (lab_palette, score). With pad=True palettes are padded/truncated to
+    K for the fixed-K model; otherwise they keep their extracted size (which can
+    be smaller than K for low-color images) for PaletteSetNet.
+    """
+    def __init__(self, metadata_df, K=5, transform=None, pad=True):
         self.metadata = metadata_df
         self.K = K
         self.transform = transform
+        self.pad = pad
 
     def __len__(self):
         return len(self.metadata)
@@ -343,17 +963,36 @@ class AADBBasedPaletteDataset(Dataset):
         img_path = row['image_path']
         score = row['score_norm']
         try:
-            palette = extract_palette_from_image(img_path, K=self.K)
+            hex_palette, _, _ = extract_palette_from_image(img_path, num_colors=self.K, hex_only=True)
+            if not hex_palette:
+                # No vibrant pixels: same fallback as an unreadable image
+                raise ValueError(f"No colors extracted from {img_path}")
+            palette = palette_hexes_to_lab_array(hex_palette)
         except Exception as e:
             # if image read fails, fallback
             palette = np.zeros((self.K,3), dtype=np.float32)
+        if self.pad:
+            palette = fit_to_k(palette, self.K)
         return palette.astype(np.float32), np.float32(score)
 
+def pad_collate(batch):
+    """DataLoader collate for variable-size palettes: (palettes, mask, scores)."""
+    palettes, scores = zip(*batch)
+    padded, mask = pad_palettes(palettes)
+    return padded, mask, torch.tensor(scores, dtype=torch.float32)
+
 def train_model_aadb(aadb_csv, aadb_images_dir, K=8,
-                     batch_size=32, epochs=15, lr=1e-3, val_frac=0.1):
+                     batch_size=32, epochs=15, lr=1e-3, val_frac=0.1, arch="fixed", processes=1):
     """
-    Train PaletteAestheticNet on AADB dataset.
+    Train PaletteAestheticNet (arch="fixed") or PaletteSetNet (arch="set") on AADB dataset.
+
+    processes > 1 trains data-parallel across that many local processes (see
+    train_distributed.py), which also checkpoints to palette_aesthetic_model.pth.
     """
+    if processes > 1:
+        from train_distributed import train_model_distributed
+        return train_model_distributed(aadb_csv, aadb_images_dir, K=K, batch_size=batch_size, epochs=epochs,
+                                       lr=lr, val_frac=val_frac, arch=arch, processes=processes)
     # Load metadata
     df = load_aadb_metadata(aadb_csv, aadb_images_dir)
     if len(df) == 0:
@@ -365,17 +1004,21 @@ def train_model_aadb(aadb_csv, aadb_images_dir, K=8,
     df_val   = df.drop(df_train.index).reset_index(drop=True)
 
     # Create datasets
-    train_ds = AADBBasedPaletteDataset(df_train, K=K)
-    val_ds   = AADBBasedPaletteDataset(df_val, K=K)
+    pad = arch != "set"
+    train_ds = AADBBasedPaletteDataset(df_train, K=K, pad=pad)
+    val_ds   = AADBBasedPaletteDataset(df_val, K=K, pad=pad)
 
-    train_loader = DataLoader(train_ds, batch_size=batch_size, shuffle=True)
-    val_loader   = DataLoader(val_ds, batch_size=batch_size, shuffle=False)
+    train_loader = DataLoader(train_ds, batch_size=batch_size, shuffle=True, collate_fn=pad_collate)
+    val_loader   = DataLoader(val_ds, batch_size=batch_size, shuffle=False, collate_fn=pad_collate)
 
     # Device
     device = "mps" if torch.backends.mps.is_available() else "cpu"
 
     # Model
-    model = PaletteAestheticNet(K=K, hidden_dim=128).to(device)
+    if arch == "set":
+        model = PaletteSetNet(hidden_dim=128).to(device)
+    else:
+        model = PaletteAestheticNet(K=K, hidden_dim=128).to(device)
     optimizer = torch.optim.Adam(model.parameters(), lr=lr)
     loss_fn = nn.MSELoss()
 
@@ -383,10 +1026,10 @@ def train_model_aadb(aadb_csv, aadb_images_dir, K=8,
     for epoch in range(epochs):
         model.train()
         train_losses = []
-        for palettes, scores in train_loader:
+        for palettes, mask, scores in train_loader:
             palettes = palettes.to(device)
             scores = scores.to(device)
-            preds = model(palettes)
+            preds = model(palettes, mask.to(device)) if arch == "set" else model(palettes)
             loss = loss_fn(preds, scores)
             optimizer.zero_grad()
             loss.backward()
@@ -397,10 +1040,10 @@ def train_model_aadb(aadb_csv, aadb_images_dir, K=8,
         model.eval()
         val_losses = []
         with torch.no_grad():
-            for palettes, scores in val_loader:
+            for palettes, mask, scores in val_loader:
                 palettes = palettes.to(device)
                 scores = scores.to(device)
-                preds = model(palettes)
+                preds = model(palettes, mask.to(device)) if arch == "set" else model(palettes)
                 loss = loss_fn(preds, scores)
                 val_losses.append(loss.item())
 
@@ -1,231 +1,870 @@
 # ai/app.py - UNIFIED BACKEND
 import os
+import io
 import json
 import re
-import torch
-from flask import Flask, request, jsonify
+import time
+BOOT_START = time.perf_counter()
+from contextlib import ExitStack, contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, jsonify, g, Response, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
+import metrics
+from metrics import STAGE_SECONDS, REQUEST_SECONDS, FALLBACKS, ERRORS
+from model_registry import models
+from admission import ROUTE_BUDGETS, Overloaded, admission_state
+from http_cache import (make_etag, etag_matches, cache_headers, model_version, optimize_request_from_query,
+                        palettes_from_query)
+from weights import checkpoint_exists, safetensors_path
+from thread_governor import governor, governed
+from profiling import PROFILE_HEADER, RequestProfile, profiling_requested, run_maybe_profiled
 
 # --- Helper Module Imports ---
 try:
-    from image_to_palette import extract_palette
-    from text_to_image import generate_image_from_prompt 
-    from advanced_ai_palette import optimize_palette, PaletteAestheticNet, assign_roles, composite_reward
+    from image_to_palette import extract_palette, consensus_palette, extract_palette_progressive, detailed_palette
+    from video_to_palette import extract_animated_palette_from_upload
+    from text_to_image import generate_image_from_prompt, generate_images_from_prompt
+    from advanced_ai_palette import (optimize_palette, optimize_palette_result, optimize_palette_steps,
+                                     optimize_palette_multistart, PaletteAestheticNet, PaletteResult,
+                                     assign_roles, composite_reward, load_aesthetic_model, is_set_model,
+                                     DEFAULT_WEIGHTS, ContrastConstraint)
+    from bulk_scoring import (score_palettes, iter_ndjson_palettes, iter_arrow_palettes, to_ndjson,
+                              to_arrow_stream, arrow_schema_message, arrow_batch_message, ARROW_EOS,
+                              NDJSON_CONTENT_TYPE, ARROW_CONTENT_TYPE, CHUNK_SIZE as SCORE_CHUNK_SIZE)
+    import bulk_scoring
+    from palette_policy import optimize_palette_amortized, load_policy_model
 except ImportError as e:
     print(f"⚠️ Warning: Could not import helper modules: {e}. Some routes may not work.")
     extract_palette = None
+    consensus_palette = None
+    extract_palette_progressive = None
+    detailed_palette = None
+    extract_animated_palette_from_upload = None
     generate_image_from_prompt = None
+    generate_images_from_prompt = None
     optimize_palette = None
+    optimize_palette_result = None
+    optimize_palette_steps = None
+    optimize_palette_multistart = None
+    PaletteResult = None
     PaletteAestheticNet = None
     assign_roles = None
     composite_reward = None
+    load_aesthetic_model = None
+    is_set_model = None
+    DEFAULT_WEIGHTS = None
+    ContrastConstraint = None
+    score_palettes = None
+    iter_ndjson_palettes = None
+    iter_arrow_palettes = None
+    to_ndjson = None
+    to_arrow_stream = None
+    arrow_schema_message = None
+    arrow_batch_message = None
+    ARROW_EOS = b""
+    NDJSON_CONTENT_TYPE = "application/x-ndjson"
+    ARROW_CONTENT_TYPE = "application/vnd.apache.arrow.stream"
+    SCORE_CHUNK_SIZE = 1024
+    bulk_scoring = None
+    optimize_palette_amortized = None
+    load_policy_model = None
+
+IMPORT_SECONDS = time.perf_counter() - BOOT_START
 
 # --- Application Setup ---
 load_dotenv()
+governor.apply_process_limits()
 app = Flask(__name__)
 CORS(app)
 
 # --- Constants ---
 DEFAULT_PALETTE = ["#D92626", "#F27D16", "#F2B90C", "#8CBF68", "#2A8C82", "#2A578C", "#5E34A6", "#A64B95"]
 K_VALUE = 8
+MAX_COORDINATE_K = 32
+MAX_STARTS = int(os.getenv("CHROMA_MAX_STARTS", os.cpu_count() or 1))
+MAX_VARIANTS = int(os.getenv("CHROMA_MAX_VARIANTS", 4))
+# Per-upload bounds for mode=animated, so a long clip cannot hold an admission slot indefinitely
+ANIMATED_MAX_FRAMES = int(os.getenv("CHROMA_ANIMATED_MAX_FRAMES", 600))
+ANIMATED_FPS = float(os.getenv("CHROMA_ANIMATED_FPS", 2))
+ANIMATED_TIME_LIMIT = float(os.getenv("CHROMA_ANIMATED_SECONDS", 30))
 PINECONE_INDEX_NAME = "color-palettes" # <-- Added Pinecone index name
 
 # Aesthetic Model for Image Palette Optimization
-aesthetic_model = None
+MODEL_SAVE_PATH = "palette_aesthetic_model.pth"
+
+def load_app_aesthetic_model():
+    if checkpoint_exists(MODEL_SAVE_PATH):
+        print(f"✅ Loading pre-trained aesthetic model from {MODEL_SAVE_PATH}")
+        # Picks PaletteSetNet or the fixed-K PaletteAestheticNet from the checkpoint's keys;
+        # a palette_aesthetic_model.safetensors next to it is memory-mapped instead of read
+        model = load_aesthetic_model(MODEL_SAVE_PATH, K=K_VALUE)
+        print(f"✅ Model loaded successfully ({type(model).__name__}, {model.weights_source}).")
+        return model
+    print(f"⚠️ Model file not found at {MODEL_SAVE_PATH}. Using default untrained model.")
+    return PaletteAestheticNet(K=K_VALUE)
+
 if PaletteAestheticNet:
-    MODEL_SAVE_PATH = "palette_aesthetic_model.pth"
-    try:
-        aesthetic_model = PaletteAestheticNet(K=K_VALUE)
-        if os.path.exists(MODEL_SAVE_PATH):
-            print(f"✅ Loading pre-trained aesthetic model from {MODEL_SAVE_PATH}")
-            aesthetic_model.load_state_dict(torch.load(MODEL_SAVE_PATH, map_location=torch.device('cpu')))
-            aesthetic_model.eval()
-            print("✅ Model loaded successfully.")
-        else:
-            print(f"⚠️ Model file not found at {MODEL_SAVE_PATH}. Using default untrained model.")
-    except Exception as e:
-        print(f"❌ Could not load or create aesthetic model: {e}")
-        aesthetic_model = None
+    models.register("aesthetic", load_app_aesthetic_model)
 
-# --- API Routes ---
-@app.route('/health', methods=['GET'])
-def health_check():
-    return jsonify({
+# Pretrained policy for moves="amortized" (train with `python palette_policy.py`)
+POLICY_SAVE_PATH = os.path.join(os.path.dirname(MODEL_SAVE_PATH), "palette_policy.pth")
+
+def load_app_policy_model():
+    if not checkpoint_exists(POLICY_SAVE_PATH):
+        raise FileNotFoundError(f"No trained policy at {POLICY_SAVE_PATH}")
+    return load_policy_model(POLICY_SAVE_PATH)
+
+if load_policy_model:
+    models.register("policy", load_app_policy_model)
+
+@contextmanager
+def model_in_use(name, failure_message):
+    # Pinned through the registry for the whole block, so it cannot be evicted mid-request
+    with ExitStack() as stack:
+        try:
+            model = stack.enter_context(models.use(name))
+        except Exception as e:
+            print(f"{failure_message}: {e}")
+            model = None
+        yield model
+
+def aesthetic_model_in_use():
+    """Context manager yielding the aesthetic model, loaded on first use; None if it cannot be loaded."""
+    if not PaletteAestheticNet:
+        return nullcontext()
+    return model_in_use("aesthetic", "❌ Could not load or create aesthetic model")
+
+def policy_model_in_use():
+    """Context manager yielding the amortized optimization policy; None when it has not been trained."""
+    if not load_policy_model:
+        return nullcontext()
+    return model_in_use("policy", "⚠️ Amortized policy unavailable")
+
+# --- Startup ---
+# Models named in CHROMA_WARMUP_MODELS are loaded at boot (by `python app.py`,
+# the ASGI lifespan, or a server hook calling warm_start()) and run once, so the
+# boot log shows where startup time goes and the first request does not pay for it.
+WARMUP_MODELS = [m for m in os.getenv("CHROMA_WARMUP_MODELS", "aesthetic").split(",") if m.strip()]
+WARMUP_INFERENCE = {
+    "aesthetic": lambda model: PaletteResult.from_hex(DEFAULT_PALETTE, model_L=model),
+    "policy": lambda policy: optimize_palette_amortized(DEFAULT_PALETTE, policy),
+}
+startup_timings = {"imports_s": round(IMPORT_SECONDS, 3)}
+
+def warm_start():
+    for name in (m.strip() for m in WARMUP_MODELS):
+        try:
+            load_start = time.perf_counter()
+            model = models.get(name)
+            infer_start = time.perf_counter()
+            if name in WARMUP_INFERENCE:
+                WARMUP_INFERENCE[name](model)
+            startup_timings[name] = {
+                "weights": getattr(model, "weights_source", None),
+                "load_s": round(infer_start - load_start, 3),
+                "first_inference_s": round(time.perf_counter() - infer_start, 3),
+            }
+        except Exception as e:
+            print(f"⚠️ Warm-up of '{name}' failed: {e}")
+    startup_timings["total_s"] = round(time.perf_counter() - BOOT_START, 3)
+    print(f"🚀 Startup breakdown: {json.dumps(startup_timings)}")
+    return startup_timings
+
+# --- Request Pipelines ---
+# Framework-agnostic route bodies. Each returns (payload, status) so they can be
+# served by the Flask routes below and by the async surface in asgi_app.py.
+def aesthetic_model_status(model_state):
+    # "available" once loaded, "unavailable" when the last load failed, "not_loaded" until first use
+    aesthetic = model_state["models"].get("aesthetic")
+    if not PaletteAestheticNet or aesthetic is None:
+        return "unavailable"
+    if aesthetic["loaded"]:
+        return "available"
+    return "unavailable" if aesthetic["error"] else "not_loaded"
+
+def health_payload():
+    # Reports without loading anything
+    model_state = models.state()
+    return {
         "status": "healthy",
-        "aesthetic_model_status": "available" if aesthetic_model else "unavailable"
-    }), 200
+        "aesthetic_model_status": aesthetic_model_status(model_state),
+        "models": model_state,
+        "admission": admission_state(),
+        "startup": startup_timings,
+        "threads": governor.state()
+    }
 
-def format_palette_details(hex_colors):
+def format_palette_details(palette, model_L=None):
     """
-    Takes a list of HEX codes and enriches it with roles, scores, and color formats.
+    Takes a PaletteResult (or a list of HEX codes) and enriches it with roles, scores, and color formats.
+    Everything is read from the result's cached fields; a HEX list is converted and scored once,
+    with model_L or, when None, the aesthetic model.
     """
-    if not hex_colors or not assign_roles or not composite_reward:
+    if not palette or not PaletteResult:
         # Fallback for when helper modules aren't available
-        return [{"hex": h, "role": f"Color {i+1}"} for i, h in enumerate(hex_colors)]
+        return [{"hex": h, "role": f"Color {i+1}"} for i, h in enumerate(palette)]
 
-    roles = assign_roles(hex_colors)
-    _, components = composite_reward(hex_colors, roles, model_L=aesthetic_model)
+    format_start = time.perf_counter()
+    if not isinstance(palette, PaletteResult):
+        with nullcontext(model_L) if model_L is not None else aesthetic_model_in_use() as model:
+            palette = PaletteResult.from_hex(palette, model_L=model)
+    components = palette.components
 
     detailed_palette = []
-    for i, hex_code in enumerate(hex_colors):
-        role = 'primary' if i in roles.get('primary', []) else \
-               'secondary' if i in roles.get('secondary', []) else \
-               'accent' if i in roles.get('accent', []) else 'neutral'
-        
+    for i, (hex_code, rgb) in enumerate(zip(palette.hex, palette.rgb.tolist())):
         detailed_palette.append({
             "hex": hex_code,
-            "rgb": hex_to_rgb_string(hex_code),
-            "hsl": hex_to_hsl_string(hex_code),
-            "role": role,
+            "rgb": rgb_to_rgb_string(rgb),
+            "hsl": rgb_to_hsl_string(rgb),
+            "role": palette.role_of(i),
             "aesthetic_score": float(components.get('L', 0.5)),
             "harmony_score": float(components.get('H', 0.5)),
             "contrast_score": float(components.get('C', 0.5))
         })
+    STAGE_SECONDS.observe(time.perf_counter() - format_start, "format_palette_details")
     return detailed_palette
 
-@app.route('/api/generate-palette', methods=['POST'])
-def generate_palette_from_text():
-    # Generates an image from a text prompt using diffusion, extracts a color palette from the generated image, and optionally optimizes it.
-    data = request.get_json()
-    user_prompt = data.get('prompt', '')
-    optimize = data.get('optimize', False)  # True/False
-    if not user_prompt:
-        return jsonify({"error": "No 'prompt' provided"}), 400
+def diffusion_options(data):
+    """Optional generation knobs from a request body; a fixed seed makes results reproducible."""
+    options = {}
+    if data.get('seed') is not None:
+        options['seed'] = int(data['seed'])
+    if data.get('guidance_scale') is not None:
+        options['guidance_scale'] = float(data['guidance_scale'])
+    if data.get('negative_prompt'):
+        options['negative_prompt'] = str(data['negative_prompt'])
+    if data.get('variants') is not None:
+        options['num_images'] = max(1, min(int(data['variants']), MAX_VARIANTS))
+    return options
+
+@governor.limited("generate")
+def run_diffusion(user_prompt, options=None):
+    """
+    Runs the diffusion model and returns a list of PIL images (several when
+    options asks for variants), or None instead of raising on failure.
+    """
+    options = dict(options or {})
+    num_images = options.pop('num_images', 1)
+    try:
+        if num_images > 1:
+            # One batched call: the prompt is encoded once for every variant
+            return generate_images_from_prompt(user_prompt, num_images, **options)
+        return [generate_image_from_prompt(user_prompt, **options)]
+    except Exception as e:
+        print(f"⚠️ Failed to generate image from prompt: {e}")
+        return None
+
+def extract_variant_palettes(images):
+    """Extracts (palette, shares) from each image in parallel threads."""
+    def extract(image):
+        palette, _, _, shares = extract_palette(image, num_colors=K_VALUE, hex_only=True, return_shares=True)
+        return palette or [], shares or []
 
+    with ThreadPoolExecutor(max_workers=min(len(images), os.cpu_count() or 1)) as pool:
+        results = list(pool.map(extract, images))
+    return [p for p, _ in results], [s for _, s in results]
+
+@governor.limited("extract")
+def generated_palette_pipeline(generated_images, optimize=False):
+    # Extracts a color palette from diffusion images and optionally optimizes it.
     hex_colors = []
+    alternates = None
     source = "default"
 
     try:
-        # 1️⃣ Generate image from text prompt
-        generated_image = generate_image_from_prompt(user_prompt)  # returns PIL.Image
-        if not generated_image:
+        if not generated_images:
             raise Exception("Diffusion model failed to generate image")
 
-        # 2️⃣ Extract palette from generated image
-        hex_colors, _, _ = extract_palette(generated_image, num_colors=K_VALUE, hex_only=True)
+        # 2️⃣ Extract palette from generated image(s)
+        if len(generated_images) > 1:
+            palettes, shares = extract_variant_palettes(generated_images)
+            hex_colors, agreement = consensus_palette(palettes, shares, num_colors=K_VALUE)
+            # Variant palettes closest to the consensus first
+            ranked = sorted((d, i) for i, d in enumerate(agreement) if d is not None)
+            alternates = [{"palette": palettes[i], "distance": round(d, 2)} for d, i in ranked]
+        else:
+            hex_colors, _, _ = extract_palette(generated_images[0], num_colors=K_VALUE, hex_only=True)
         if not hex_colors:
             print("⚠️ Palette extraction failed, using default")
             hex_colors = DEFAULT_PALETTE
             source = "diffusion-image-fallback"
+            FALLBACKS.inc(source)
         else:
-            source = "diffusion-image"
+            source = "diffusion-consensus" if alternates is not None else "diffusion-image"
 
         # 3️⃣ Optional AI optimization
-        if optimize and aesthetic_model:
-            optimized, _, score, _ = optimize_palette(hex_colors, steps=50, model_L=aesthetic_model)
-            hex_colors = optimized
-            source += "-optimized"
+        with aesthetic_model_in_use() if optimize else nullcontext() as aesthetic_model:
+            if aesthetic_model:
+                hex_colors = optimize_palette_result(hex_colors, steps=50, model_L=aesthetic_model)
+                source += "-optimized"
 
     except Exception as e:
         print(f"⚠️ Failed to generate and extract palette: {e}")
         hex_colors = DEFAULT_PALETTE
         source = "default"
+        FALLBACKS.inc("default-palette")
+        ERRORS.inc("/api/generate-palette")
 
     # 4️⃣ Format and return
     detailed_palette = format_palette_details(hex_colors)
-    return jsonify({
+    payload = {
         "palette": detailed_palette,
         "source": source,
         "message": "Palette generated from text prompt"
-    })
+    }
+    if alternates is not None:
+        payload["alternates"] = alternates
+    return payload, 200
 
-@app.route('/api/extract', methods=['POST'])
-def extract_palette_api():
-    # Extracts a color palette from an uploaded image with optional advanced optimization.
-    if 'file' not in request.files:
-        return jsonify({"error": "No file part in the request"}), 400
-    
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({"error": "No file selected"}), 400
+@governor.limited("extract")
+def extract_pipeline(file, optimize_level='basic', starts=1):
+    # Extracts a color palette from an image file with optional advanced optimization.
     if not extract_palette or not optimize_palette:
-        return jsonify({"error": "Image processing modules not available"}), 503
+        return {"error": "Image processing modules not available"}, 503
 
-    optimize_level = request.form.get('optimize', 'basic')
-    
+    # Models entered here stay pinned until the pipeline returns
+    pins = ExitStack()
     try:
         # Advanced AI Optimization Flow
-        if optimize_level == 'advanced' and aesthetic_model:
+        aesthetic_model = pins.enter_context(aesthetic_model_in_use()) if optimize_level == 'advanced' else None
+        if aesthetic_model:
             print("Processing with Advanced AI Optimization...")
 
+            starts = max(1, min(int(starts), MAX_STARTS))
+            image_bytes = None
+            if starts > 1:
+                # Keep the upload so each multi-start run can extract its own variant
+                image_bytes = file.read()
+                file = io.BytesIO(image_bytes)
+
             # ✅ Unpack tuple correctly
             hex_palette, swatch, used_space = extract_palette(file, num_colors=K_VALUE, hex_only=True)
 
             if not hex_palette:
-                return jsonify({"error": "Could not extract initial colors"}), 500
+                return {"error": "Could not extract initial colors"}, 500
 
             # ✅ Ensure it's always a list
             initial_hex = list(hex_palette)
 
-            optimized, _, _, _ = optimize_palette(initial_hex, steps=50, model_L=aesthetic_model)
+            spread = None
+            if starts > 1:
+                optimized, spread = optimize_palette_multistart(
+                    initial_hex, starts=starts, steps=50, model_L=aesthetic_model, image_input=image_bytes)
+            else:
+                optimized = optimize_palette_result(initial_hex, steps=50, model_L=aesthetic_model)
             enhanced_palette = format_palette_details(optimized)
 
-            return jsonify({
+            payload = {
                 "palette": enhanced_palette,
                 "message": "Advanced AI-optimized palette extracted"
-            })
+            }
+            if spread:
+                payload["multistart"] = spread
+            return payload, 200
 
         # Basic Extraction Flow
-        else:
-            print("Processing with Basic Extraction...")
+        print("Processing with Basic Extraction...")
 
-            # Correctly unpack the tuple, we only need the first item
-            palette_list, _, _ = extract_palette(file, num_colors=10, hex_only=False)
+        # Correctly unpack the tuple, we only need the first item
+        palette_list, _, _ = extract_palette(file, num_colors=10, hex_only=False)
 
         if not palette_list:
-            return jsonify({"error": "Could not process the image"}), 500
+            return {"error": "Could not process the image"}, 500
 
-            # ✅ Return only the serializable palette list in the JSON
-        return jsonify({
-                "palette": palette_list,
+        # ✅ Return only the serializable palette list in the JSON
+        return {
+            "palette": palette_list,
             "message": "Basic palette extracted successfully"
-        })
+        }, 200
         
     except Exception as e:
         print(f"ERROR in /api/extract: {str(e)}")
+        ERRORS.inc("/api/extract")
         import traceback
         traceback.print_exc()
-        return jsonify({"error": "Internal server error during image processing."}), 500
+        return {"error": "Internal server error during image processing."}, 500
+    finally:
+        pins.close()
 
-@app.route('/api/optimize', methods=['POST'])
-def optimize_palette_api():
+# Progressive extraction streams snapshots of the optimization every few steps
+PROGRESSIVE_ROUNDS = 5
+PROGRESSIVE_STEPS = 50
+
+def wants_progressive(value):
+    return str(value or '').lower() in ('1', 'true', 'yes')
+
+def progressive_extract_events(file, optimize_level='basic'):
+    """
+    Generates the events of a progressive extraction, each a dict with the
+    stage, the palette so far, elapsed_ms and whether it is final:
+
+    * "coarse": K-Means on a tiny pixel sample, ready in tens of milliseconds
+    * "refined": a larger sample, warm-started from the coarse centroids
+    * "optimized" (optimize=advanced): snapshots of the seeded search
+      /api/extract runs, one per PROGRESSIVE_STEPS // PROGRESSIVE_ROUNDS steps
+      that improved the palette; the final one equals /api/extract's palette
+
+    An "error" event ends the stream early.
+    """
+    start = time.perf_counter()
+
+    def event(stage, palette, final=False, **extra):
+        return {"stage": stage, "palette": palette, "final": final,
+                "elapsed_ms": round((time.perf_counter() - start) * 1000, 1), **extra}
+
+    if not extract_palette_progressive:
+        yield {"stage": "error", "error": "Image processing modules not available", "final": True}
+        return
+    pins = ExitStack()
+    try:
+        # Pinned until the generator finishes or is closed
+        aesthetic_model = pins.enter_context(aesthetic_model_in_use()) if optimize_level == 'advanced' else None
+        hex_palette = None
+        stages = extract_palette_progressive(file, num_colors=K_VALUE if aesthetic_model else 10)
+        try:
+            for i, (sample_size, rgb, shares, last) in enumerate(stages):
+                palette = detailed_palette(rgb)
+                for color, share in zip(palette, shares):
+                    color["share"] = share
+                hex_palette = [color["hex"] for color in palette]
+                yield event("coarse" if i == 0 else "refined", palette, final=last and not aesthetic_model,
+                            sample_size=sample_size)
+        except (OSError, ValueError) as e:
+            # Undecodable uploads, as extract_palette reports them
+            print(f"Error opening or processing image: {e}")
+        if not hex_palette:
+            yield {"stage": "error", "error": "Could not process the image", "final": True}
+            return
+        if not aesthetic_model:
+            return
+
+        # The search /api/extract runs (same start, steps and seed), so the final palette matches it
+        file.seek(0)
+        initial_hex, _, _ = extract_palette(file, num_colors=K_VALUE, hex_only=True)
+        if not initial_hex:
+            yield {"stage": "error", "error": "Could not extract initial colors", "final": True}
+            return
+        round_steps = PROGRESSIVE_STEPS // PROGRESSIVE_ROUNDS
+        for step, best in optimize_palette_steps(list(initial_hex), steps=PROGRESSIVE_STEPS,
+                                                 model_L=aesthetic_model):
+            last = step == PROGRESSIVE_STEPS
+            if step == 0:
+                shown = best  # the unoptimized start
+            elif step % round_steps == 0 and (last or best is not shown):
+                shown = best
+                yield event("optimized", format_palette_details(best), final=last,
+                            round=step // round_steps, score=float(best.score))
+    except Exception as e:
+        print(f"ERROR in progressive /api/extract: {str(e)}")
+        ERRORS.inc("/api/extract")
+        yield {"stage": "error", "error": "Internal server error during image processing.", "final": True}
+    finally:
+        pins.close()
+
+@governor.limited("extract")
+def next_progressive_event(events):
+    """The next event of progressive_extract_events, or None; each step runs under the extract thread limit."""
+    return next(events, None)
+
+def progressive_lines(events):
+    for event in iter(lambda: next_progressive_event(events), None):
+        yield (json.dumps(event) + "\n").encode()
+
+@governor.limited("extract")
+def animated_pipeline(file, filename=""):
+    # Extracts a global palette plus per-scene palettes from an animated image or video.
+    if not extract_animated_palette_from_upload:
+        return {"error": "Image processing modules not available"}, 503
+    try:
+        # Video is resampled to ANIMATED_FPS; every upload stops at the frame and time caps
+        result = extract_animated_palette_from_upload(file, filename, num_colors=K_VALUE,
+                                                      max_frames=ANIMATED_MAX_FRAMES, fps=ANIMATED_FPS,
+                                                      time_limit=ANIMATED_TIME_LIMIT)
+        if not result["palette"]:
+            return {"error": "Could not extract colors from any frame"}, 500
+        return {
+            "palette": format_palette_details(result["palette"]),
+            "segments": result["segments"],
+            "frames_total": result["frames_total"],
+            "frames_sampled": result["frames_sampled"],
+            "truncated": result["truncated"],
+            "message": "Animated palette extracted successfully"
+        }, 200
+    except Exception as e:
+        print(f"ERROR in animated extraction: {str(e)}")
+        ERRORS.inc("/api/extract")
+        return {"error": "Internal server error during animation processing."}, 500
+
+@governor.limited("optimize")
+def optimize_pipeline(data):
     """Optimizes an existing palette with the aesthetic model."""
-    data = request.get_json()
     if not data or 'palette' not in data:
-        return jsonify({"error": "No palette provided"}), 400
-    if not aesthetic_model:
-        return jsonify({"error": "AI optimization model not available"}), 503
-    
+        return {"error": "No palette provided"}, 400
+    # Models entered here stay pinned until the pipeline returns
+    with ExitStack() as pins:
+        aesthetic_model = pins.enter_context(aesthetic_model_in_use())
+        if not aesthetic_model:
+            return {"error": "AI optimization model not available"}, 503
+        return _optimize_with(data, aesthetic_model, pins)
+
+def _optimize_with(data, aesthetic_model, pins):
     try:
-        hex_colors = data['palette'][:K_VALUE]
+        # 'all' perturbs every color per candidate; 'coordinate' moves one color with
+        # incremental scoring, which keeps design-system sized palettes affordable;
+        # 'amortized' applies the pretrained policy in one forward pass
+        moves = data.get('moves', 'all')
+        if moves not in ('all', 'coordinate', 'amortized'):
+            return {"error": "'moves' must be 'all', 'coordinate' or 'amortized'"}, 400
+        policy = None
+        if moves == 'amortized':
+            policy = pins.enter_context(policy_model_in_use())
+            if policy is None:
+                # Without a trained policy, fall back to the equivalent search
+                FALLBACKS.inc("amortized-policy")
+                moves = 'coordinate'
+        # A fixed-K model scores at most K_VALUE colors per candidate; set models take any K
+        variable_k = moves != 'all' or is_set_model(aesthetic_model)
+        hex_colors = data['palette'][:MAX_COORDINATE_K if variable_k else K_VALUE]
         # MODIFIED: Get steps from the request, with a default of 50
         steps = data.get('steps', 50)
+        # Optional multi-start: independent seeded runs across cores, each with the same time budget
+        try:
+            starts = max(1, min(int(data.get('starts', 1)), MAX_STARTS))
+            time_limit = float(data['time_limit']) if data.get('time_limit') is not None else None
+        except (TypeError, ValueError):
+            return {"error": "'starts' must be an integer and 'time_limit' a number of seconds"}, 400
+        if time_limit is not None and not time_limit > 0:
+            return {"error": "'time_limit' must be a positive number of seconds"}, 400
+        # Optional hard WCAG constraint, e.g. {"level": "AA", "pairs": "roles" | "all" | [[0, 1], ...]}
+        contrast = None
+        if data.get('contrast'):
+            try:
+                contrast = ContrastConstraint.from_spec(data['contrast'])
+            except (ValueError, TypeError, AttributeError) as e:
+                return {"error": f"Invalid 'contrast': {e}"}, 400
         
-        # MODIFIED: Capture all 4 return values from the function, including components
-        optimized, _, score, components = optimize_palette(hex_colors, steps=steps, model_L=aesthetic_model)
+        spread = None
+        if policy is not None:
+            # A handful of optional coordinate steps on top of the policy's proposal
+            refine_steps = max(0, min(int(data.get('refine_steps', 0)), steps))
+            optimized = optimize_palette_amortized(hex_colors, policy, model_L=aesthetic_model,
+                                                   refine_steps=refine_steps, contrast=contrast)
+        elif starts > 1:
+            optimized, spread = optimize_palette_multistart(
+                hex_colors, starts=starts, steps=steps, time_limit=time_limit,
+                model_L=aesthetic_model, moves=moves, contrast=contrast)
+        else:
+            optimized = optimize_palette_result(hex_colors, steps=steps, model_L=aesthetic_model,
+                                                moves=moves, time_limit=time_limit, contrast=contrast)
         
         # Format the palette with roles, RGB/HSL strings, etc.
         enhanced_palette = format_palette_details(optimized)
         
         # MODIFIED: Return the full data structure the frontend expects
-        return jsonify({
+        payload = {
             "palette": enhanced_palette, 
-            "aesthetic_score": float(score),
-            "components": {k: float(v) for k, v in components.items()} # Ensure components are JSON serializable
-        })
+            "aesthetic_score": float(optimized.score),
+            "components": {k: float(v) for k, v in optimized.components.items()} # Ensure components are JSON serializable
+        }
+        if spread:
+            payload["multistart"] = spread
+        if contrast:
+            payload["contrast"] = contrast.report(optimized.lab)
+        return payload, 200
     except Exception as e:
         print(f"Error optimizing palette: {str(e)}")
-        return jsonify({"error": "Failed to optimize palette"}), 500
+        ERRORS.inc("/api/optimize")
+        return {"error": "Failed to optimize palette"}, 500
+
+def parse_score_weights(raw):
+    """
+    Custom reward weights from a request, as a dict or its JSON string; raises ValueError.
+    They replace DEFAULT_WEIGHTS entirely, as in composite_reward: left-out components are skipped.
+    """
+    if raw in (None, ''):
+        return None
+    if isinstance(raw, str):
+        raw = json.loads(raw)
+    if not isinstance(raw, dict) or not set(raw) <= set(DEFAULT_WEIGHTS):
+        raise ValueError(f"'weights' must map a subset of {sorted(DEFAULT_WEIGHTS)} to numbers")
+    return {k: float(v) for k, v in raw.items()}
+
+def json_score_request(data):
+    """(palettes, weights) from a JSON body; palettes may be hex lists or {"id", "palette"} objects."""
+    palettes = (data or {}).get('palettes')
+    if not isinstance(palettes, list):
+        raise ValueError("No 'palettes' list provided")
+    palettes = [(p.get('id'), p.get('palette')) if isinstance(p, dict) else p for p in palettes]
+    return palettes, parse_score_weights(data.get('weights'))
+
+def arrow_supported():
+    return bulk_scoring is not None and bulk_scoring.pa is not None
+
+def _pinned_scores(palettes, weights):
+    # The model stays pinned while the response streams
+    with aesthetic_model_in_use() as model:
+        yield from score_palettes(palettes, weights=weights, model_L=model)
+
+def score_stream(palettes, weights, arrow=False):
+    """(content_type, iterator of bytes) scoring `palettes` chunk by chunk."""
+    results = _pinned_scores(palettes, weights)
+    # Scoring runs lazily while the response streams, so the thread limit wraps the iteration
+    if arrow:
+        return ARROW_CONTENT_TYPE, governed("score", to_arrow_stream(results))
+    return NDJSON_CONTENT_TYPE, governed("score", to_ndjson(results))
+
+@governor.limited("score")
+def score_body(palettes, weights, arrow=False):
+    """(content_type, bytes): score_stream for a small batch, buffered so it can be tagged."""
+    content_type, body = score_stream(palettes, weights, arrow)
+    return content_type, b"".join(body)
+
+@governor.limited("score")
+def encode_score_chunk(items, weights, start_index=0, arrow=False):
+    """Scores one chunk and encodes it as NDJSON lines or a single Arrow record-batch message."""
+    with aesthetic_model_in_use() as model:
+        results = list(score_palettes(items, weights=weights, model_L=model,
+                                      chunk_size=max(len(items), 1), start_index=start_index))
+    return arrow_batch_message(results) if arrow else b"".join(to_ndjson(results))
+
+# --- Conditional Caching ---
+# Responses are deterministic given the input, parameters and model weights (see http_cache.py)
+def response_version():
+    """
+    Version of the weights behind every response, or None when there is no trained
+    aesthetic checkpoint: the untrained fallback is randomly initialised per process,
+    so its responses are not byte-stable and must not be tagged.
+    """
+    if not checkpoint_exists(MODEL_SAVE_PATH):
+        return None
+    return model_version([MODEL_SAVE_PATH, safetensors_path(MODEL_SAVE_PATH),
+                          POLICY_SAVE_PATH, safetensors_path(POLICY_SAVE_PATH)])
+
+def _multistart(starts):
+    # Multi-start payloads carry wall-clock run_seconds
+    try:
+        return int(starts or 1) > 1
+    except (TypeError, ValueError):
+        return False
+
+def optimize_etag(data):
+    """ETag for an optimize request; None when the result depends on wall-clock time."""
+    if not isinstance(data, dict) or 'palette' not in data:
+        return None
+    if data.get('time_limit') or _multistart(data.get('starts')):
+        return None
+    version = response_version()
+    return make_etag("optimize", data, version=version) if version else None
+
+def extract_etag(content, params):
+    """ETag for an extract request; None when the result depends on wall-clock time."""
+    version = response_version()
+    if not version or params.get("mode") == 'animated':
+        # Animated extraction stops at ANIMATED_TIME_LIMIT, so its payload depends on machine load
+        return None
+    if params.get("optimize") == 'advanced' and _multistart(params.get("starts")):
+        return None
+    return make_etag("extract", dict(params, num_colors=K_VALUE), content, version=version)
+
+def score_etag(palettes, weights, arrow=False):
+    version = response_version()
+    if not version:
+        return None
+    return make_etag("score", {"palettes": palettes, "weights": weights, "arrow": arrow}, version=version)
+
+# --- API Routes ---
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.before_request
+def admit_request():
+    # Bounded concurrency + queue per expensive route; rejected requests get 503 fast
+    limiter = ROUTE_BUDGETS.get(request.path)
+    if limiter is None or request.method == 'OPTIONS':
+        return None
+    try:
+        limiter.acquire()
+    except Overloaded as e:
+        response = jsonify({"error": "Server busy, retry later", "budget": e.budget})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+    g.admission = (limiter, time.perf_counter())
+    return None
+
+@app.teardown_request
+def release_admission(exc=None):
+    admission = g.pop('admission', None)
+    if admission is not None:
+        limiter, admitted_at = admission
+        limiter.release(time.perf_counter() - admitted_at)
+
+@app.after_request
+def record_request_latency(response):
+    if request.url_rule is not None and hasattr(g, 'request_start'):
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_start,
+                                request.url_rule.rule, response.status_code)
+    return response
+
+def not_modified(etag, cacheable=False):
+    return Response(status=304, headers=cache_headers(etag, cacheable))
+
+def tag_response(response, etag, cacheable=False):
+    # Only successful responses are tagged: errors must not be served from a cache
+    if etag and response.status_code == 200:
+        response.headers.update(cache_headers(etag, cacheable))
+    return response
+
+def request_profile():
+    # Opt-in profiling: only built when the admin token is presented.
+    if not profiling_requested(request.headers.get(PROFILE_HEADER)):
+        return None
+    return RequestProfile(request.path)
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    return jsonify(health_payload()), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/api/generate-palette', methods=['POST'])
+def generate_palette_from_text():
+    # Generates an image from a text prompt using diffusion, extracts a color palette from the generated image, and optionally optimizes it.
+    data = request.get_json()
+    user_prompt = data.get('prompt', '')
+    optimize = data.get('optimize', False)  # True/False
+    if not user_prompt:
+        return jsonify({"error": "No 'prompt' provided"}), 400
+    try:
+        options = diffusion_options(data)
+    except (TypeError, ValueError):
+        return jsonify({"error": "'seed' and 'variants' must be integers and 'guidance_scale' a number"}), 400
+
+    profile = request_profile()
+    # 1️⃣ Generate image from text prompt
+    generated_images = run_maybe_profiled(profile, run_diffusion, user_prompt, options)
+    payload, status = run_maybe_profiled(profile, generated_palette_pipeline, generated_images, optimize)
+    if profile:
+        payload["profile"] = profile.report()
+    return jsonify(payload), status
+
+@app.route('/api/extract', methods=['POST'])
+def extract_palette_api():
+    # Extracts a color palette from an uploaded image with optional advanced optimization.
+    with STAGE_SECONDS.time("upload_read"):
+        files = request.files
+    if 'file' not in files:
+        return jsonify({"error": "No file part in the request"}), 400
+    
+    file = files['file']
+    if file.filename == '':
+        return jsonify({"error": "No file selected"}), 400
+
+    profile = request_profile()
+    content = file.read()
+    mode = request.form.get('mode')
+    optimize_level = request.form.get('optimize', 'basic')
+    starts = request.form.get('starts', 1, type=int)
+    if wants_progressive(request.form.get('progressive')) and mode != 'animated':
+        # NDJSON, one line per improved palette; stream_with_context holds the admission slot until the end
+        events = progressive_extract_events(io.BytesIO(content), optimize_level)
+        return Response(stream_with_context(progressive_lines(events)), content_type=NDJSON_CONTENT_TYPE)
+    etag = None
+    if not profile:
+        etag = extract_etag(content, {"mode": mode, "optimize": optimize_level, "starts": starts,
+                                      "ext": os.path.splitext(file.filename)[1].lower()})
+        if etag_matches(request.headers.get('If-None-Match'), etag):
+            return not_modified(etag)
+    if mode == 'animated':
+        payload, status = run_maybe_profiled(profile, animated_pipeline, io.BytesIO(content), file.filename)
+    else:
+        payload, status = run_maybe_profiled(profile, extract_pipeline, io.BytesIO(content), optimize_level, starts)
+    if profile:
+        payload["profile"] = profile.report()
+    response = jsonify(payload)
+    response.status_code = status
+    return tag_response(response, etag)
+
+@app.route('/api/score', methods=['POST', 'GET'])
+def score_palettes_api():
+    # Bulk scoring: JSON {"palettes": [...]}, NDJSON or Arrow IPC in; NDJSON (default) or Arrow out, streamed.
+    # GET /api/score?palette=FF6F61,FFD662&palette=...&weights={...} scores a few palettes cacheably.
+    if not score_palettes:
+        return jsonify({"error": "Scoring modules not available"}), 503
+    arrow_in = request.mimetype == ARROW_CONTENT_TYPE
+    arrow_out = ARROW_CONTENT_TYPE in request.headers.get('Accept', '')
+    if (arrow_in or arrow_out) and not arrow_supported():
+        return jsonify({"error": "Arrow IPC requires pyarrow on the server"}), 415
+    if request.method == 'GET':
+        try:
+            palettes = palettes_from_query(request.args.getlist('palette'))
+            weights = parse_score_weights(request.args.get('weights'))
+        except (ValueError, TypeError) as e:
+            return jsonify({"error": str(e)}), 400
+        etag = score_etag(palettes, weights, arrow_out)
+        if etag_matches(request.headers.get('If-None-Match'), etag):
+            response = not_modified(etag, cacheable=True)
+        else:
+            content_type, body = score_body(palettes, weights, arrow_out)
+            response = tag_response(Response(body, content_type=content_type), etag, cacheable=True)
+        response.headers['Vary'] = 'Accept'
+        return response
+    try:
+        if arrow_in:
+            palettes = iter_arrow_palettes(request.stream)
+            weights = parse_score_weights(request.args.get('weights'))
+        elif request.mimetype == NDJSON_CONTENT_TYPE:
+            palettes = iter_ndjson_palettes(request.stream)
+            weights = parse_score_weights(request.args.get('weights'))
+        else:
+            palettes, weights = json_score_request(request.get_json(silent=True))
+    except (ValueError, TypeError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    content_type, body = score_stream(palettes, weights, arrow_out)
+    # stream_with_context keeps the request (and its admission slot) open until the last chunk
+    return Response(stream_with_context(body), content_type=content_type)
+
+@app.route('/api/optimize', methods=['POST', 'GET'])
+def optimize_palette_api():
+    """Optimizes an existing palette with the aesthetic model (GET: /api/optimize?palette=FF6F61,...)."""
+    cacheable = request.method == 'GET'
+    if cacheable:
+        try:
+            data = optimize_request_from_query(request.args)
+        except (ValueError, TypeError) as e:
+            return jsonify({"error": str(e)}), 400
+    else:
+        data = request.get_json()
+    profile = request_profile()
+    etag = None if profile else optimize_etag(data)
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        return not_modified(etag, cacheable)
+    payload, status = run_maybe_profiled(profile, optimize_pipeline, data)
+    if profile:
+        payload["profile"] = profile.report()
+    response = jsonify(payload)
+    response.status_code = status
+    return tag_response(response, etag, cacheable)
 
 # --- Utility Functions ---
 def hex_to_rgb_string(hex_color):
     h = hex_color.lstrip('#')
-    return f"rgb({','.join(str(int(h[i:i+2], 16)) for i in (0, 2, 4))})"
+    return rgb_to_rgb_string([int(h[i:i+2], 16) for i in (0, 2, 4)])
+
+def rgb_to_rgb_string(rgb):
+    return f"rgb({','.join(str(int(c)) for c in rgb)})"
 
 def hex_to_hsl_string(hex_color):
     h = hex_color.lstrip('#')
-    r, g, b = [int(h[i:i+2], 16)/255.0 for i in (0, 2, 4)]
+    return rgb_to_hsl_string([int(h[i:i+2], 16) for i in (0, 2, 4)])
+
+def rgb_to_hsl_string(rgb):
+    r, g, b = [c / 255.0 for c in rgb]
     max_val, min_val = max(r, g, b), min(r, g, b)
     l = (max_val + min_val) / 2
     if max_val == min_val: h = s = 0
@@ -239,4 +878,5 @@ def hex_to_hsl_string(hex_color):
     return f"hsl({int(h*360)}, {int(s*100)}%, {int(l*100)}%)"
 
 if __name__ == '__main__':
+    warm_start()
     app.run(debug=True, port=5001)
\ No newline at end of file
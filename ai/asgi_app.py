@@ -0,0 +1,463 @@
+# ai/asgi_app.py - ASYNC BACKEND
+"""
+ASGI surface for the same routes served by app.py.
+
+Run with:  uvicorn asgi_app:app --port 5001   (uvicorn picks uvloop when installed)
+
+Lightweight routes (/health) are answered directly on the event loop. CPU-bound
+work never runs on the loop:
+  - diffusion goes to a dedicated single-slot executor, so at most one image is
+    generated at a time and it cannot hold up anything else;
+  - extraction and optimization go to a bounded CPU pool (threads by default,
+    processes with CHROMA_CPU_POOL=process). Process workers send the counters
+    and stage timings they record back with each result, so /metrics covers
+    them; worker gauges (e.g. resident model bytes) are not merged.
+Idle and long-polling connections only cost a coroutine each.
+"""
+import os
+import io
+import json
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import parse_qs
+
+from app import (
+    health_payload,
+    diffusion_options,
+    run_diffusion,
+    generated_palette_pipeline,
+    extract_pipeline,
+    animated_pipeline,
+    optimize_pipeline,
+    score_palettes,
+    parse_score_weights,
+    json_score_request,
+    arrow_supported,
+    encode_score_chunk,
+    iter_ndjson_palettes,
+    iter_arrow_palettes,
+    arrow_schema_message,
+    ARROW_EOS,
+    NDJSON_CONTENT_TYPE,
+    ARROW_CONTENT_TYPE,
+    SCORE_CHUNK_SIZE,
+    warm_start,
+    optimize_etag,
+    extract_etag,
+    score_etag,
+    score_body,
+    wants_progressive,
+    progressive_extract_events,
+    next_progressive_event,
+)
+import metrics
+from metrics import STAGE_SECONDS, REQUEST_SECONDS, ERRORS
+from admission import ROUTE_BUDGETS, Overloaded
+from thread_governor import process_pool
+from http_cache import etag_matches, cache_headers, optimize_request_from_query, palettes_from_query
+from profiling import PROFILE_HEADER, RequestProfile, profiling_requested, run_maybe_profiled
+
+# --- Executors ---
+CPU_WORKERS = int(os.getenv("CHROMA_CPU_WORKERS", os.cpu_count() or 1))
+CPU_POOL_KIND = os.getenv("CHROMA_CPU_POOL", "thread")
+MAX_UPLOAD_BYTES = int(os.getenv("CHROMA_MAX_UPLOAD_BYTES", 20 * 1024 * 1024))
+
+diffusion_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="diffusion")
+if CPU_POOL_KIND == "process":
+    # Each worker imports app (models still load lazily, on first use) and gets its share of the cores
+    cpu_executor = process_pool(CPU_WORKERS)
+else:
+    cpu_executor = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="cpu")
+# Profiled requests sample their own thread, so they never go to a process pool.
+profile_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="profile")
+# Generators cannot cross processes: progressive extraction steps through its events on threads
+stream_executor = None if CPU_POOL_KIND == "process" else cpu_executor
+
+async def run_in(executor, fn, *args):
+    loop = asyncio.get_running_loop()
+    if CPU_POOL_KIND == "process" and executor is cpu_executor:
+        # Stage timings are recorded in the worker; they come back with the result for /metrics
+        result, changes = await loop.run_in_executor(executor, metrics.run_recorded, fn, *args)
+        metrics.merge(changes)
+        return result
+    return await loop.run_in_executor(executor, fn, *args)
+
+# --- HTTP helpers ---
+CORS_HEADERS = [(b"access-control-allow-origin", b"*")]
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+async def read_body(receive, limit=MAX_UPLOAD_BYTES):
+    chunks, size = [], 0
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise HTTPError(400, "Client disconnected")
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > limit:
+            raise HTTPError(413, "Request body too large")
+        chunks.append(chunk)
+        more_body = message.get("more_body", False)
+    return b"".join(chunks)
+
+def read_json(body):
+    try:
+        return json.loads(body) if body else None
+    except ValueError:
+        raise HTTPError(400, "Invalid JSON body")
+
+def parse_multipart(content_type, body):
+    """Returns ({field: str}, {field: (filename, bytes)}) for a multipart/form-data body."""
+    message = BytesParser(policy=HTTP).parsebytes(
+        b"Content-Type: " + content_type + b"\r\n\r\n" + body
+    )
+    if not message.is_multipart():
+        raise HTTPError(400, "Expected multipart/form-data")
+    fields, files = {}, {}
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        if not name:
+            continue
+        filename = part.get_filename()
+        payload = part.get_payload(decode=True) or b""
+        if filename is not None:
+            files[name] = (filename, payload)
+        else:
+            fields[name] = payload.decode(part.get_content_charset() or "utf-8")
+    return fields, files
+
+def request_profile(scope, headers):
+    # Opt-in profiling: only built when the admin token is presented.
+    header_value = headers.get(PROFILE_HEADER.lower().encode(), b"").decode() or None
+    if not profiling_requested(header_value):
+        return None
+    return RequestProfile(scope["path"])
+
+async def run_work(profile, executor, fn, *args):
+    if profile is None:
+        return await run_in(executor, fn, *args)
+    if executor is cpu_executor:
+        executor = profile_executor
+    return await run_in(executor, run_maybe_profiled, profile, fn, *args)
+
+async def send_bytes(send, body, content_type, status=200, headers=()):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", content_type),
+            (b"content-length", str(len(body)).encode()),
+            *CORS_HEADERS,
+            *headers,
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+async def send_json(send, payload, status=200, headers=()):
+    await send_bytes(send, json.dumps(payload).encode(), b"application/json", status, headers)
+
+def etag_headers(etag, status=200, cacheable=False):
+    # Only successful responses are tagged: errors must not be served from a cache
+    if not etag or status not in (200, 304):
+        return []
+    return [(k.lower().encode(), v.encode()) for k, v in cache_headers(etag, cacheable).items()]
+
+def not_modified_if_matches(headers, etag):
+    return etag_matches(headers.get(b"if-none-match", b"").decode() or None, etag)
+
+async def send_not_modified(send, etag, cacheable=False, headers=()):
+    await send({"type": "http.response.start", "status": 304,
+                "headers": [*CORS_HEADERS, *etag_headers(etag, 304, cacheable), *headers]})
+    await send({"type": "http.response.body", "body": b""})
+
+def query_args(scope):
+    """{name: first value} from the query string."""
+    return {k: v[0] for k, v in parse_qs(scope.get("query_string", b"").decode()).items()}
+
+MAX_LINE_BYTES = 1024 * 1024
+
+async def iter_body_lines(receive):
+    """Yields request-body lines as they arrive, without buffering the whole body."""
+    pending = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise HTTPError(400, "Client disconnected")
+        pending += message.get("body", b"")
+        more_body = message.get("more_body", False)
+        *lines, pending = pending.split(b"\n")
+        if len(pending) > MAX_LINE_BYTES:
+            raise HTTPError(413, "NDJSON line too long")
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+# --- Routes ---
+async def health_check(scope, receive, send, headers):
+    # Served on the event loop: never queues behind executor work.
+    await send_json(send, health_payload())
+
+async def metrics_endpoint(scope, receive, send, headers):
+    await send_bytes(send, metrics.render().encode(), metrics.CONTENT_TYPE.encode())
+
+async def generate_palette_from_text(scope, receive, send, headers):
+    data = read_json(await read_body(receive)) or {}
+    user_prompt = data.get('prompt', '')
+    optimize = data.get('optimize', False)
+    if not user_prompt:
+        return await send_json(send, {"error": "No 'prompt' provided"}, 400)
+    try:
+        options = diffusion_options(data)
+    except (TypeError, ValueError):
+        return await send_json(send, {"error": "'seed' and 'variants' must be integers and 'guidance_scale' a number"}, 400)
+
+    profile = request_profile(scope, headers)
+    generated_images = await run_work(profile, diffusion_executor, run_diffusion, user_prompt, options)
+    payload, status = await run_work(profile, cpu_executor, generated_palette_pipeline, generated_images, optimize)
+    if profile:
+        payload["profile"] = profile.report()
+    await send_json(send, payload, status)
+
+async def extract_palette_api(scope, receive, send, headers):
+    content_type = headers.get(b"content-type", b"")
+    if not content_type.startswith(b"multipart/form-data"):
+        return await send_json(send, {"error": "No file part in the request"}, 400)
+    with STAGE_SECONDS.time("upload_read"):
+        fields, files = parse_multipart(content_type, await read_body(receive))
+    if 'file' not in files:
+        return await send_json(send, {"error": "No file part in the request"}, 400)
+
+    filename, content = files['file']
+    if filename == '':
+        return await send_json(send, {"error": "No file selected"}, 400)
+
+    profile = request_profile(scope, headers)
+    mode = fields.get('mode')
+    optimize_level = fields.get('optimize', 'basic')
+    try:
+        starts = int(fields.get('starts', 1))
+    except ValueError:
+        starts = 1
+    if wants_progressive(fields.get('progressive')) and mode != 'animated':
+        return await stream_progressive_extract(send, progressive_extract_events(io.BytesIO(content), optimize_level))
+    etag = None
+    if not profile:
+        etag = extract_etag(content, {"mode": mode, "optimize": optimize_level, "starts": starts,
+                                      "ext": os.path.splitext(filename)[1].lower()})
+        if not_modified_if_matches(headers, etag):
+            return await send_not_modified(send, etag)
+    if mode == 'animated':
+        payload, status = await run_work(profile, cpu_executor, animated_pipeline, io.BytesIO(content), filename)
+    else:
+        payload, status = await run_work(profile, cpu_executor, extract_pipeline, io.BytesIO(content),
+                                         optimize_level, starts)
+    if profile:
+        payload["profile"] = profile.report()
+    await send_json(send, payload, status, headers=etag_headers(etag, status))
+
+async def stream_progressive_extract(send, events):
+    # NDJSON, one line per improved palette, sent as soon as each stage finishes
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", NDJSON_CONTENT_TYPE.encode()), *CORS_HEADERS],
+    })
+    while True:
+        event = await run_in(stream_executor, next_progressive_event, events)
+        if event is None:
+            break
+        await send({"type": "http.response.body", "body": (json.dumps(event) + "\n").encode(), "more_body": True})
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+async def score_palettes_api(scope, receive, send, headers):
+    if not score_palettes:
+        return await send_json(send, {"error": "Scoring modules not available"}, 503)
+    content_type = headers.get(b"content-type", b"").split(b";")[0].strip().decode()
+    arrow_out = ARROW_CONTENT_TYPE.encode() in headers.get(b"accept", b"")
+    if (content_type == ARROW_CONTENT_TYPE or arrow_out) and not arrow_supported():
+        return await send_json(send, {"error": "Arrow IPC requires pyarrow on the server"}, 415)
+    query = parse_qs(scope.get("query_string", b"").decode())
+    if scope["method"] == "GET":
+        return await score_palettes_get(send, headers, query, arrow_out)
+    try:
+        if content_type == NDJSON_CONTENT_TYPE:
+            weights = parse_score_weights(query.get("weights", [None])[0])
+            lines = iter_body_lines(receive)
+        elif content_type == ARROW_CONTENT_TYPE:
+            weights = parse_score_weights(query.get("weights", [None])[0])
+            lines = None
+            palettes = iter_arrow_palettes(await read_body(receive))
+        else:
+            lines = None
+            palettes, weights = json_score_request(read_json(await read_body(receive)))
+    except (ValueError, TypeError) as e:
+        return await send_json(send, {"error": str(e)}, 400)
+
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", (ARROW_CONTENT_TYPE if arrow_out else NDJSON_CONTENT_TYPE).encode()),
+                    *CORS_HEADERS],
+    })
+    if arrow_out:
+        await send({"type": "http.response.body", "body": arrow_schema_message(), "more_body": True})
+
+    # Score one chunk at a time on the CPU pool, sending each as soon as it is ready
+    index, chunk = 0, []
+
+    async def flush():
+        nonlocal index, chunk
+        if chunk:
+            body = await run_in(cpu_executor, encode_score_chunk, chunk, weights, index, arrow_out)
+            index, chunk = index + len(chunk), []
+            await send({"type": "http.response.body", "body": body, "more_body": True})
+
+    try:
+        if lines is not None:
+            async for item in _aiter_ndjson(lines):
+                chunk.append(item)
+                if len(chunk) >= SCORE_CHUNK_SIZE:
+                    await flush()
+        else:
+            for item in palettes:
+                chunk.append(item)
+                if len(chunk) >= SCORE_CHUNK_SIZE:
+                    await flush()
+        await flush()
+    except HTTPError as e:
+        # Headers are already sent; end the stream early
+        print(f"⚠️ /api/score stream aborted: {e.message}")
+    except Exception as e:
+        # Anything else would abort the connection mid-stream; log it and end the stream cleanly
+        print(f"❌ /api/score stream failed: {type(e).__name__}: {e}")
+        ERRORS.inc("/api/score")
+    await send({"type": "http.response.body", "body": ARROW_EOS if arrow_out else b"", "more_body": False})
+
+async def score_palettes_get(send, headers, query, arrow_out):
+    # GET /api/score?palette=FF6F61,FFD662&palette=...: small, buffered and cacheable
+    try:
+        palettes = palettes_from_query(query.get("palette"))
+        weights = parse_score_weights(query.get("weights", [None])[0])
+    except (ValueError, TypeError) as e:
+        return await send_json(send, {"error": str(e)}, 400)
+    etag = score_etag(palettes, weights, arrow_out)
+    vary = [(b"vary", b"Accept")]
+    if not_modified_if_matches(headers, etag):
+        return await send_not_modified(send, etag, cacheable=True, headers=vary)
+    content_type, body = await run_in(cpu_executor, score_body, palettes, weights, arrow_out)
+    await send_bytes(send, body, content_type.encode(), headers=[*etag_headers(etag, 200, True), *vary])
+
+async def _aiter_ndjson(lines):
+    async for line in lines:
+        for item in iter_ndjson_palettes([line]):
+            yield item
+
+async def optimize_palette_api(scope, receive, send, headers):
+    cacheable = scope["method"] == "GET"
+    if cacheable:
+        try:
+            data = optimize_request_from_query(query_args(scope))
+        except (ValueError, TypeError) as e:
+            return await send_json(send, {"error": str(e)}, 400)
+    else:
+        data = read_json(await read_body(receive))
+    profile = request_profile(scope, headers)
+    etag = None if profile else optimize_etag(data)
+    if not_modified_if_matches(headers, etag):
+        return await send_not_modified(send, etag, cacheable)
+    payload, status = await run_work(profile, cpu_executor, optimize_pipeline, data)
+    if profile:
+        payload["profile"] = profile.report()
+    await send_json(send, payload, status, headers=etag_headers(etag, status, cacheable))
+
+ROUTES = {
+    "/health": (("GET",), health_check),
+    "/metrics": (("GET",), metrics_endpoint),
+    "/api/generate-palette": (("POST",), generate_palette_from_text),
+    "/api/extract": (("POST",), extract_palette_api),
+    "/api/optimize": (("POST", "GET"), optimize_palette_api),
+    "/api/score": (("POST", "GET"), score_palettes_api),
+}
+
+# --- ASGI Application ---
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # Default executor: cpu_executor may be a process pool, and models must load here
+            await asyncio.get_running_loop().run_in_executor(None, warm_start)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            diffusion_executor.shutdown(wait=False, cancel_futures=True)
+            cpu_executor.shutdown(wait=False, cancel_futures=True)
+            profile_executor.shutdown(wait=False, cancel_futures=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    headers = dict(scope.get("headers", []))
+    route = ROUTES.get(scope["path"])
+    if route is None:
+        return await send_json(send, {"error": "Not found"}, 404)
+
+    methods, handler = route
+    if scope["method"] == "OPTIONS":
+        # CORS preflight, mirroring flask_cors defaults
+        await send({
+            "type": "http.response.start",
+            "status": 204,
+            "headers": [
+                *CORS_HEADERS,
+                (b"access-control-allow-methods", ", ".join(methods).encode()),
+                (b"access-control-allow-headers",
+                 headers.get(b"access-control-request-headers", b"*")),
+            ],
+        })
+        return await send({"type": "http.response.body", "body": b""})
+    if scope["method"] not in methods:
+        return await send_json(send, {"error": "Method not allowed"}, 405)
+
+    request_start = time.perf_counter()
+    response_status = []
+
+    async def send_tracking_status(message):
+        if message["type"] == "http.response.start":
+            response_status.append(message["status"])
+        await send(message)
+
+    limiter = ROUTE_BUDGETS.get(scope["path"])
+    try:
+        if limiter is None:
+            await handler(scope, receive, send_tracking_status, headers)
+        else:
+            # Admitted before the body is read, so rejected uploads cost nothing
+            async with limiter.async_slot():
+                await handler(scope, receive, send_tracking_status, headers)
+    except Overloaded as e:
+        await send_json(send_tracking_status, {"error": "Server busy, retry later", "budget": e.budget}, 503,
+                        headers=[(b"retry-after", str(e.retry_after).encode())])
+    except HTTPError as e:
+        await send_json(send_tracking_status, {"error": e.message}, e.status)
+    finally:
+        REQUEST_SECONDS.observe(time.perf_counter() - request_start, scope["path"],
+                                response_status[0] if response_status else 500)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host="127.0.0.1", port=5001, loop="auto")
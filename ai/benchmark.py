@@ -0,0 +1,382 @@
+# ai/benchmark.py
+"""
+Offline micro-benchmarks for the color pipeline.
+
+Every input is synthetic (procedural images, seeded random palettes and a
+randomly initialized PaletteAestheticNet), so results are reproducible without
+network access or trained weights.
+
+Usage:
+    python benchmark.py                          # run everything, print a table
+    python benchmark.py -k extract --min-time 2  # only cases whose name contains 'extract'
+    python benchmark.py --save results.json      # write results as JSON
+    python benchmark.py --update-baseline        # store results as the baseline
+    python benchmark.py --compare                # fail (exit 1) on regressions vs the baseline
+
+Baselines are machine-specific, so none is committed: record one with
+--update-baseline on the machine that will run --compare.
+"""
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import statistics
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+import torch
+from PIL import Image
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+SEED = 1234
+K_VALUE = 8
+
+# -------------------------- Case registry --------------------------
+BENCHMARKS = {}
+
+def benchmark(name):
+    """
+    Registers a case. The decorated function does the (untimed) setup and
+    returns a zero-argument callable that performs one operation. A `teardown`
+    attribute on that callable, if set, is called once the case has run.
+    """
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return decorator
+
+def seed_everything(seed=SEED):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+# -------------------------- Synthetic inputs --------------------------
+def synthetic_image(size, seed=SEED):
+    """A smooth multi-hue gradient with noise, so k-means has real structure to find."""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:size, 0:size].astype(np.float32) / max(size - 1, 1)
+    r = 255 * (0.5 + 0.5 * np.sin(6.0 * xx + 1.0))
+    g = 255 * (0.5 + 0.5 * np.sin(4.0 * yy + 2.0))
+    b = 255 * (0.5 + 0.5 * np.cos(5.0 * (xx + yy)))
+    img = np.stack([r, g, b], axis=-1) + rng.normal(0, 12, (size, size, 3))
+    return Image.fromarray(img.clip(0, 255).astype(np.uint8))
+
+def random_palette(k=K_VALUE, seed=SEED):
+    rng = random.Random(seed)
+    return ['#{:02X}{:02X}{:02X}'.format(*(rng.randrange(256) for _ in range(3))) for _ in range(k)]
+
+def random_aesthetic_model(module):
+    torch.manual_seed(SEED)
+    model = module.PaletteAestheticNet(K=K_VALUE)
+    model.eval()
+    return model
+
+# -------------------------- Cases --------------------------
+for _size in (128, 512, 1024, 2048):
+    def _extract_case(size=_size):
+        from image_to_palette import extract_palette
+        img = synthetic_image(size)
+        return lambda: extract_palette(img, num_colors=K_VALUE, hex_only=True)
+    benchmark(f"extract_palette[{_size}px]")(_extract_case)
+
+@benchmark("extract_palette_progressive.coarse[1024px]")
+def _progressive_coarse():
+    from image_to_palette import extract_palette_progressive
+    img = synthetic_image(1024)
+    # Time to the first palette the editor can render
+    return lambda: next(extract_palette_progressive(img, num_colors=K_VALUE))
+
+@benchmark("advanced.hex_to_lab")
+def _hex_to_lab():
+    import advanced_ai_palette as ap
+    palette = random_palette(64)
+    return lambda: [ap.hex_to_lab(h) for h in palette]
+
+@benchmark("advanced.lab_to_hex")
+def _lab_to_hex():
+    import advanced_ai_palette as ap
+    labs = [ap.hex_to_lab(h) for h in random_palette(64)]
+    return lambda: [ap.lab_to_hex(*lab) for lab in labs]
+
+@benchmark("advanced.assign_roles")
+def _assign_roles():
+    import advanced_ai_palette as ap
+    palette = random_palette()
+    return lambda: ap.assign_roles(palette)
+
+@benchmark("advanced.composite_reward")
+def _advanced_composite_reward():
+    import advanced_ai_palette as ap
+    palette = random_palette()
+    roles = ap.assign_roles(palette)
+    model = random_aesthetic_model(ap)
+    return lambda: ap.composite_reward(list(palette), roles, model_L=model)
+
+@benchmark("advanced.composite_reward[weights=H,D]")
+def _advanced_composite_reward_screen():
+    import advanced_ai_palette as ap
+    palette = random_palette()
+    roles = ap.assign_roles(palette)
+    model = random_aesthetic_model(ap)
+    # A screening weight set: no roles-based terms and no model forward
+    return lambda: ap.composite_reward(list(palette), roles, weights={'H': 0.5, 'D': 0.5}, model_L=model)
+
+@benchmark("advanced.optimize_palette[steps=10]")
+def _advanced_optimize():
+    import advanced_ai_palette as ap
+    palette = random_palette()
+    model = random_aesthetic_model(ap)
+    return lambda: ap.optimize_palette(list(palette), steps=10, model_L=model)
+
+@benchmark("advanced.optimize_palette[contrast=AA,steps=10]")
+def _advanced_optimize_contrast():
+    import advanced_ai_palette as ap
+    palette = random_palette()
+    model = random_aesthetic_model(ap)
+    constraint = ap.ContrastConstraint(ap.WCAG_LEVELS['AA'])
+    return lambda: ap.optimize_palette(list(palette), steps=10, model_L=model, contrast=constraint)
+
+for _k in (8, 16, 32):
+    def _coordinate_case(k=_k):
+        import advanced_ai_palette as ap
+        palette = random_palette(k)
+        model = random_aesthetic_model(ap)
+        return lambda: ap.optimize_palette(list(palette), steps=10, model_L=model, moves="coordinate")
+    benchmark(f"advanced.optimize_palette[coordinate,K={_k},steps=10]")(_coordinate_case)
+
+@benchmark("policy.optimize_palette_amortized[samples=8]")
+def _policy_amortized():
+    # Untrained policy: the cost of one forward pass plus a batched scoring is the same
+    import advanced_ai_palette as ap
+    from palette_policy import PalettePolicyNet, optimize_palette_amortized
+    palette = random_palette()
+    model = random_aesthetic_model(ap)
+    policy = PalettePolicyNet().eval()
+    return lambda: optimize_palette_amortized(list(palette), policy, model_L=model)
+
+@benchmark("bulk.score_palettes[1000]")
+def _bulk_score():
+    import advanced_ai_palette as ap
+    from bulk_scoring import score_palettes
+    palettes = [random_palette(seed=SEED + i) for i in range(1000)]
+    model = random_aesthetic_model(ap)
+    return lambda: list(score_palettes(palettes, model_L=model))
+
+@benchmark("colors.hex_to_lab")
+def _colors_hex_to_lab():
+    import colors
+    palette = random_palette(64)
+    return lambda: [colors.hex_to_lab(h) for h in palette]
+
+@benchmark("colors.lab_to_hex")
+def _colors_lab_to_hex():
+    import colors
+    labs = [colors.hex_to_lab(h) for h in random_palette(64)]
+    return lambda: [colors.lab_to_hex(*lab) for lab in labs]
+
+@benchmark("colors.composite_reward")
+def _colors_composite_reward():
+    import colors
+    palette = random_palette()
+    roles = colors.assign_roles(palette)
+    model = random_aesthetic_model(colors)
+    return lambda: colors.composite_reward(list(palette), roles, model_L=model)
+
+@benchmark("colors.optimize_palette[steps=5]")
+def _colors_optimize():
+    import colors
+    palette = random_palette()
+    model = random_aesthetic_model(colors)
+    return lambda: colors.optimize_palette(list(palette), steps=5, episodes_per_step=4, model_L=model)
+
+@benchmark("app.format_palette_details")
+def _format_palette_details():
+    import app
+    import advanced_ai_palette as ap
+    if app.assign_roles is None:
+        raise RuntimeError("app.py helper modules unavailable; format_palette_details would only hit its fallback")
+    model = random_aesthetic_model(ap)
+    app.models.register("aesthetic", lambda: model)
+    palette = random_palette()
+    return lambda: app.format_palette_details(list(palette))
+
+# Throughput versus thread configuration: one op is `concurrency` extractions of a
+# 512px image running at once, each capped at `threads` OpenMP threads, so
+# images/s = ops/s x concurrency. threads=cpus with concurrency=cpus is the
+# ungoverned, oversubscribed default; threads=1 is what the governor applies.
+_CPUS = os.cpu_count() or 1
+for _concurrency, _threads in sorted({(1, _CPUS), (_CPUS, _CPUS), (_CPUS, 1), (max(1, _CPUS // 2), 2)}):
+    def _governor_case(concurrency=_concurrency, threads=_threads):
+        from concurrent.futures import ThreadPoolExecutor
+        from image_to_palette import extract_palette
+        from thread_governor import governor
+        img = synthetic_image(512)
+        pool = ThreadPoolExecutor(max_workers=concurrency)
+
+        def extract():
+            with governor.limit("extract", threads=threads):
+                return extract_palette(img, num_colors=K_VALUE, hex_only=True)
+        def op():
+            return [f.result() for f in [pool.submit(extract) for _ in range(concurrency)]]
+        op.teardown = pool.shutdown
+        return op
+    benchmark(f"governor.extract[concurrency={_concurrency},threads={_threads}]")(_governor_case)
+
+# One op is one 512x512 image, so median_s is seconds per image for the profile.
+# Needs diffusers and the model weights; opt in with CHROMA_BENCH_DIFFUSION=1.
+for _profile in ("gpu", "cpu-fp32", "cpu-bf16", "cpu-fast"):
+    def _diffusion_case(profile=_profile):
+        if os.getenv("CHROMA_BENCH_DIFFUSION") != "1":
+            raise RuntimeError("set CHROMA_BENCH_DIFFUSION=1 to run diffusion benchmarks")
+        from diffusion_profiles import default_device, resolve_profile, build_pipeline
+        from thread_governor import governor
+        device = default_device()
+        if (profile == "gpu") != (device != "cpu"):
+            raise RuntimeError(f"profile {profile} does not apply to device {device}")
+        settings = resolve_profile(device, profile)
+        pipe = build_pipeline(device, settings)
+
+        def generate():
+            generator = torch.Generator("cpu").manual_seed(SEED)
+            with torch.no_grad(), governor.limit("generate", threads=settings["threads"]):
+                pipe("a watercolor landscape at sunset", num_inference_steps=settings["steps"],
+                     generator=generator)
+        return generate
+    benchmark(f"diffusion[{_profile}]")(_diffusion_case)
+
+# -------------------------- Runner --------------------------
+def measure_allocations(fn):
+    """Peak traced bytes and number of new blocks for one call (Python + numpy heaps)."""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename") if stat.count_diff > 0)
+    return peak, blocks
+
+def run_case(fn, min_time=1.0, repeats=5, warmup=1):
+    for _ in range(warmup):
+        fn()
+
+    # Calibrate: how many calls fit into one repeat of roughly min_time / repeats.
+    start = time.perf_counter()
+    fn()
+    single = max(time.perf_counter() - start, 1e-9)
+    number = max(1, int((min_time / repeats) / single))
+
+    per_op = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        per_op.append((time.perf_counter() - start) / number)
+
+    peak, blocks = measure_allocations(fn)
+    median = statistics.median(per_op)
+    return {
+        "ops_per_sec": 1.0 / median,
+        "median_s": median,
+        "stdev_s": statistics.stdev(per_op) if len(per_op) > 1 else 0.0,
+        "iterations": number * repeats,
+        "alloc_peak_kb": peak / 1024.0,
+        "alloc_blocks": blocks,
+    }
+
+def environment_info():
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+    }
+
+def run_benchmarks(pattern=None, min_time=1.0, repeats=5):
+    results, skipped = {}, {}
+    for name, setup in BENCHMARKS.items():
+        if pattern and pattern not in name:
+            continue
+        seed_everything()
+        try:
+            fn = setup()
+        except Exception as e:
+            # e.g. colors.py needs open_clip; app.py needs its helper modules
+            skipped[name] = f"{type(e).__name__}: {e}"
+            print(f"⚠️ Skipping {name}: {skipped[name]}")
+            continue
+        try:
+            results[name] = run_case(fn, min_time=min_time, repeats=repeats)
+        finally:
+            if getattr(fn, "teardown", None):
+                fn.teardown()
+        r = results[name]
+        print(f"{name:<40} {r['ops_per_sec']:>12.2f} ops/s  {r['median_s']*1e3:>10.3f} ms  "
+              f"peak {r['alloc_peak_kb']:>9.1f} KiB  {r['alloc_blocks']:>7d} blocks")
+    return {"environment": environment_info(), "results": results, "skipped": skipped}
+
+def compare_to_baseline(report, baseline, threshold):
+    """Returns a list of (name, baseline_ops, current_ops, change) for cases slower than threshold."""
+    regressions = []
+    for name, current in report["results"].items():
+        reference = baseline.get("results", {}).get(name)
+        if not reference:
+            continue
+        change = current["ops_per_sec"] / reference["ops_per_sec"] - 1.0
+        marker = "REGRESSION" if change < -threshold else "ok"
+        print(f"{name:<40} {reference['ops_per_sec']:>12.2f} -> {current['ops_per_sec']:>12.2f} ops/s "
+              f"({change:+.1%}) {marker}")
+        if change < -threshold:
+            regressions.append((name, reference["ops_per_sec"], current["ops_per_sec"], change))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Color pipeline micro-benchmarks")
+    parser.add_argument("-k", dest="pattern", help="only run cases whose name contains this string")
+    parser.add_argument("--min-time", type=float, default=1.0, help="target seconds per case")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--save", help="write results JSON to this path")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline JSON path")
+    parser.add_argument("--update-baseline", action="store_true", help="overwrite the baseline with these results")
+    parser.add_argument("--compare", action="store_true",
+                        help="compare against the baseline (record one with --update-baseline first)")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="allowed fractional ops/sec drop before a case counts as a regression")
+    args = parser.parse_args(argv)
+    if args.compare and not args.update_baseline and not os.path.exists(args.baseline):
+        # Checked before running anything, so a missing baseline fails fast
+        parser.error(f"--compare needs a baseline, but {args.baseline} does not exist. "
+                     f"Record one on this machine first with --update-baseline.")
+
+    report = run_benchmarks(args.pattern, min_time=args.min_time, repeats=args.repeats)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"✅ Results saved to {args.save}")
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"✅ Baseline updated at {args.baseline}")
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(report, baseline, args.threshold)
+        if regressions:
+            print(f"❌ {len(regressions)} case(s) regressed by more than {args.threshold:.0%}")
+            return 1
+        print("✅ No regressions")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,296 @@
+# ai/bulk_extract.py
+"""
+Bulk palette extraction over an asset folder or manifest, written to Parquet.
+
+Files are processed across a process pool. Workers open the images
+themselves, and at most --in-flight paths are outstanding at once, so memory
+stays bounded however many files there are. Results are written to
+OUT/part-NNNNN.parquet every --part-size rows. Each part is written to a
+temporary name and renamed, so every part on disk is complete. The parts are
+the checkpoint: a rerun with the same OUT reads their `path` column and skips
+every file already recorded, so an interrupted run resumes where it stopped.
+Failed files are recorded too (status="error" plus the error), reported as
+they happen and retried only with --retry-failed.
+
+A file that crashes its worker (a decoder segfault, say) breaks the whole
+pool. The pool is then recreated and every file that was in flight is rerun
+alone, so only the file that actually crashed is recorded as failed.
+
+A retried file gets a new row in a later part and its old row stays, so the
+last row for a path wins. read_results() applies that rule for you.
+
+Usage:
+    python bulk_extract.py assets/ --out palettes/ --workers 8
+    python bulk_extract.py manifest.txt --out palettes/ --optimize --steps 50
+
+Read the result with read_results("palettes/"), or pyarrow.dataset.dataset("palettes/") /
+pandas.read_parquet when no file was retried.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from thread_governor import process_pool
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".bmp", ".gif", ".tif", ".tiff"}
+CHECKPOINT_FILE = "_checkpoint.json"
+
+SCHEMA = pa.schema([
+    ("path", pa.string()),
+    ("status", pa.string()),
+    ("palette", pa.list_(pa.string())),
+    ("shares", pa.list_(pa.float32())),
+    ("score", pa.float64()),
+    ("width", pa.int32()),
+    ("height", pa.int32()),
+    ("seconds", pa.float32()),
+    ("error", pa.string()),
+])
+
+# -------------------------- Inputs --------------------------
+def iter_sources(source):
+    """Image paths under a directory (sorted, recursive), or the lines of a manifest file."""
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                    yield os.path.join(root, name)
+    else:
+        with open(source) as f:
+            for line in f:
+                if line.strip() and not line.startswith("#"):
+                    yield line.strip()
+
+def part_files(out_dir):
+    """Part paths in the order they were written."""
+    return [os.path.join(out_dir, name) for name in sorted(os.listdir(out_dir))
+            if name.startswith("part-") and name.endswith(".parquet")]
+
+def completed_paths(out_dir, retry_failed=False):
+    """Paths recorded in existing parts; failures are left out with retry_failed."""
+    done = set()
+    for part in part_files(out_dir):
+        table = pq.read_table(part, columns=["path", "status"])
+        for path, status in zip(table.column("path").to_pylist(), table.column("status").to_pylist()):
+            if status == "ok" or not retry_failed:
+                done.add(path)
+    return done
+
+def read_results(out_dir):
+    """All parts as one pyarrow Table with a single row per path: the last one written."""
+    parts = part_files(out_dir)
+    if not parts:
+        return SCHEMA.empty_table()
+    table = pa.concat_tables([pq.read_table(part, schema=SCHEMA) for part in parts])
+    last = {path: i for i, path in enumerate(table.column("path").to_pylist())}
+    return table.take(sorted(last.values()))
+
+# -------------------------- Worker --------------------------
+_worker = {}
+
+def _worker_init(num_colors, optimize, steps, model_path):
+    _worker.update(num_colors=num_colors, optimize=optimize, steps=steps, model=None)
+    if optimize:
+        from advanced_ai_palette import load_aesthetic_model
+        from weights import checkpoint_exists
+        if checkpoint_exists(model_path):
+            # The checkpoint keeps the K it was trained with; scoring fits any palette size to it
+            _worker["model"] = load_aesthetic_model(model_path)
+
+def _extract_one(path):
+    from PIL import Image
+    from image_to_palette import extract_palette
+
+    start = time.perf_counter()
+    row = {"path": path, "status": "error", "palette": None, "shares": None, "score": None,
+           "width": None, "height": None, "error": None}
+    try:
+        with Image.open(path) as img:
+            img.load()
+            row["width"], row["height"] = img.size
+            palette, _, _, shares = extract_palette(img, num_colors=_worker["num_colors"],
+                                                    hex_only=True, return_shares=True)
+        if not palette:
+            raise ValueError("no colors extracted")
+        row.update(status="ok", palette=list(palette), shares=[float(s) for s in shares])
+        if _worker["optimize"]:
+            from advanced_ai_palette import optimize_palette_result
+            result = optimize_palette_result(list(palette), steps=_worker["steps"], model_L=_worker["model"])
+            # Optimized colors no longer map to pixel shares
+            row.update(palette=list(result.hex), shares=None, score=float(result.score))
+    except Exception as e:
+        row.update(status="error", error=f"{type(e).__name__}: {e}")
+    row["seconds"] = time.perf_counter() - start
+    return row
+
+# -------------------------- Driver --------------------------
+class PartWriter:
+    """Buffers rows and writes them as atomically renamed Parquet parts."""
+
+    def __init__(self, out_dir, part_size):
+        self.out_dir = out_dir
+        self.part_size = part_size
+        self.rows = []
+        self.next_part = sum(1 for n in os.listdir(out_dir) if n.startswith("part-") and n.endswith(".parquet"))
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.part_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        path = os.path.join(self.out_dir, f"part-{self.next_part:05d}.parquet")
+        table = pa.Table.from_pylist(self.rows, schema=SCHEMA)
+        pq.write_table(table, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        self.next_part += 1
+        self.rows = []
+
+def run(source, out_dir, workers=None, in_flight=None, num_colors=8, optimize=False, steps=50,
+        model_path="palette_aesthetic_model.pth", part_size=5000, retry_failed=False,
+        progress_every=10.0):
+    os.makedirs(out_dir, exist_ok=True)
+    options = {"source": os.path.abspath(source), "num_colors": num_colors, "optimize": optimize, "steps": steps}
+    checkpoint = os.path.join(out_dir, CHECKPOINT_FILE)
+    if os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            previous = json.load(f)["options"]
+        if previous != options:
+            raise ValueError(f"{out_dir} holds a run with different options ({previous}); use a new --out")
+
+    done = completed_paths(out_dir, retry_failed)
+    workers = workers or os.cpu_count() or 1
+    in_flight = in_flight or 2 * workers
+    writer = PartWriter(out_dir, part_size)
+    stats = {"processed": 0, "failed": 0, "skipped": 0}
+    if done:
+        print(f"Resuming: {len(done)} files already recorded in {out_dir}")
+
+    def new_pool():
+        # Each worker gets its share of the cores (torch, OpenMP and BLAS) from the governor
+        return process_pool(workers, initializer=_worker_init, initargs=(num_colors, optimize, steps, model_path))
+
+    def restart_pool():
+        nonlocal pool
+        pool.shutdown(wait=False, cancel_futures=True)
+        pool = new_pool()
+
+    def record(row):
+        writer.add(row)
+        stats["processed"] += 1
+        if row["status"] != "ok":
+            stats["failed"] += 1
+            print(f"❌ {row['path']}: {row['error']}")
+
+    def collect(futures):
+        """Records finished futures; after a pool crash, queues every in-flight path to rerun alone."""
+        broken = False
+        for future in futures:
+            path = pending.pop(future)
+            try:
+                record(future.result())
+            except BrokenProcessPool:
+                # Any in-flight file may have crashed the worker, so none is recorded yet
+                suspects.append(path)
+                broken = True
+        if broken:
+            # The rest of the in-flight futures fail with the pool; rerun them all
+            suspects.extend(pending.values())
+            pending.clear()
+            print(f"⚠️ A worker crashed; rerunning {len(suspects)} in-flight files one at a time")
+            restart_pool()
+        while suspects:
+            path = suspects.pop(0)
+            try:
+                record(pool.submit(_extract_one, path).result())
+            except BrokenProcessPool as e:
+                # Alone in the pool, so this file is the one that crashed it
+                record({"path": path, "status": "error", "error": f"{type(e).__name__}: worker crashed"})
+                restart_pool()
+
+    def submit(path):
+        try:
+            future = pool.submit(_extract_one, path)
+        except BrokenProcessPool:
+            # The pool broke before its futures were collected; sort those out first
+            collect(wait(pending).done)
+            future = pool.submit(_extract_one, path)
+        pending[future] = path
+
+    def save_checkpoint():
+        writer.flush()
+        with open(checkpoint + ".tmp", "w") as f:
+            json.dump({"options": options, "parts": writer.next_part,
+                       "recorded": len(done) + stats["processed"]}, f)
+        os.replace(checkpoint + ".tmp", checkpoint)
+
+    start = last_report = time.perf_counter()
+    pool = new_pool()
+    pending = {}
+    suspects = []
+    try:
+        for path in iter_sources(source):
+            if path in done:
+                stats["skipped"] += 1
+                continue
+            if len(pending) >= in_flight:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(finished)
+            submit(path)
+
+            now = time.perf_counter()
+            if now - last_report >= progress_every:
+                rate = stats["processed"] / (now - start)
+                print(f"… {stats['processed']} processed ({rate:.1f} images/s), "
+                      f"{stats['failed']} failed, {stats['skipped']} skipped")
+                last_report = now
+        while pending:
+            collect(wait(pending).done)
+    except KeyboardInterrupt:
+        print("Interrupted; saving completed results")
+        for future in list(pending):
+            # Unfinished files are not recorded, so the next run picks them up
+            if future.done() and not future.cancelled() and future.exception() is None:
+                record(future.result())
+        raise
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        save_checkpoint()
+        elapsed = time.perf_counter() - start
+        print(f"✅ {stats['processed']} files in {elapsed:.1f}s "
+              f"({stats['processed'] / max(elapsed, 1e-9):.1f} images/s), {stats['failed']} failed, "
+              f"{stats['skipped']} skipped; {writer.next_part} parts in {out_dir}")
+    return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract palettes from a folder or manifest into Parquet")
+    parser.add_argument("source", help="Directory of images, or a manifest file with one path per line")
+    parser.add_argument("--out", required=True, help="Output directory for Parquet parts")
+    parser.add_argument("--workers", type=int, help="Worker processes (default: CPU count)")
+    parser.add_argument("--in-flight", type=int, help="Files outstanding at once (default: 2x workers)")
+    parser.add_argument("--num-colors", type=int, default=8)
+    parser.add_argument("--optimize", action="store_true", help="Also run optimize_palette_result")
+    parser.add_argument("--steps", type=int, default=50, help="Optimization steps with --optimize")
+    parser.add_argument("--model", default="palette_aesthetic_model.pth", help="Aesthetic model for --optimize")
+    parser.add_argument("--part-size", type=int, default=5000, help="Rows per Parquet part")
+    parser.add_argument("--retry-failed", action="store_true", help="Reprocess files that failed before")
+    args = parser.parse_args(argv)
+    try:
+        run(args.source, args.out, workers=args.workers, in_flight=args.in_flight, num_colors=args.num_colors,
+            optimize=args.optimize, steps=args.steps, model_path=args.model, part_size=args.part_size,
+            retry_failed=args.retry_failed)
+    except KeyboardInterrupt:
+        sys.exit(130)
+
+if __name__ == "__main__":
+    main()
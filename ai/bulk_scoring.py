@@ -0,0 +1,256 @@
+# ai/bulk_scoring.py
+"""
+Bulk palette scoring for offline libraries (ranking, dedup, weight-set A/B).
+
+score_palettes() takes any iterable of palettes and yields one result per
+palette, working through the input in fixed-size chunks so memory stays
+bounded however long the stream is. Within a chunk the color conversions,
+WCAG luminances and the pairwise harmony / distinctness / cohesion terms are
+computed as numpy arrays (one batch per palette size), the learned score is a
+single model forward, and only role assignment runs per palette. Scores match
+advanced_ai_palette.composite_reward.
+
+Input/output helpers cover NDJSON and, when pyarrow is installed, Arrow IPC
+streams with a `palette` list<string> column (and an optional `id` column).
+"""
+import json
+import numpy as np
+
+from advanced_ai_palette import (DEFAULT_WEIGHTS, assign_roles_lab, learned_scores, weight_score,
+                                 wcag_luminance_array)
+from metrics import STAGE_SECONDS
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+ARROW_CONTENT_TYPE = "application/vnd.apache.arrow.stream"
+CHUNK_SIZE = 1024
+COMPONENTS = ('H', 'C', 'D', 'W', 'P', 'L')
+
+# sRGB (D65) -> XYZ, as in advanced_ai_palette.rgb_to_xyz
+_RGB_TO_XYZ = np.array([[0.4124564, 0.3575761, 0.1804375],
+                        [0.2126729, 0.7151522, 0.0721750],
+                        [0.0193339, 0.1191920, 0.9503041]])
+_WHITE = np.array([0.95047, 1.0, 1.08883])
+
+# -------------------------- Vectorized conversions --------------------------
+def hex_palette_to_rgb(hex_palette):
+    """(k, 3) uint8 array; raises ValueError on anything that is not #RRGGBB."""
+    digits = "".join(h.strip().lstrip('#') for h in hex_palette)
+    if len(digits) != 6 * len(hex_palette):
+        raise ValueError(f"Invalid hex color in {hex_palette!r}")
+    return np.frombuffer(bytes.fromhex(digits), dtype=np.uint8).reshape(-1, 3)
+
+def rgb_to_lab_array(rgb):
+    c = rgb.astype(np.float64) / 255.0
+    linear = np.where(c <= 0.04045, c / 12.92, ((c + 0.055) / 1.055) ** 2.4)
+    t = (linear @ _RGB_TO_XYZ.T) / _WHITE
+    f = np.where(t > 0.008856, np.cbrt(t), 7.787 * t + 16 / 116)
+    lab = np.stack([116 * f[:, 1] - 16, 500 * (f[:, 0] - f[:, 1]), 200 * (f[:, 1] - f[:, 2])], axis=1)
+    return lab.astype(np.float32)
+
+def _pair_terms(lab):
+    """Harmony, distinctness and cohesion for a (B, K, 3) batch of same-size palettes."""
+    B, K, _ = lab.shape
+    if K < 2:
+        return np.full(B, 0.5), np.zeros(B), np.ones(B)
+    angles = np.degrees(np.arctan2(lab[:, :, 2], lab[:, :, 1])) % 360
+    diff = np.abs(angles[:, :, None] - angles[:, None, :])
+    hue = np.minimum(diff, 360 - diff)
+    dist = np.linalg.norm(lab[:, :, None, :] - lab[:, None, :, :], axis=3)
+    ab = np.linalg.norm(lab[:, :, None, 1:] - lab[:, None, :, 1:], axis=3)
+    iu = np.triu_indices(K, 1)
+    H = np.clip((hue[:, iu[0], iu[1]].mean(axis=1) - 20.0) / (110.0 - 20.0), 0.0, 1.0)
+    D = np.clip((dist[:, iu[0], iu[1]].mean(axis=1) - 6) / (40 - 6), 0.0, 1.0)
+    P = np.exp(-ab.mean(axis=(1, 2)) / 20)
+    return H, D, P
+
+def _contrast(luminance, roles):
+    others = roles['secondary'] + roles['accent']
+    if not others:
+        return 1.0
+    Lp = luminance[roles['primary'][0]]
+    Lo = luminance[others]
+    ratio = (np.maximum(Lp, Lo) + 0.05) / (np.minimum(Lp, Lo) + 0.05)
+    return float(np.mean(1 / (1 + np.exp(-1.5 * (ratio - 4.5)))))
+
+# -------------------------- Scoring --------------------------
+def _score_chunk(items, weights, model_L):
+    """items: list of (index, id, hex palette). Returns results in input order."""
+    results = [None] * len(items)
+    labs = {}
+    for pos, (index, pid, palette) in enumerate(items):
+        try:
+            if not palette:
+                raise ValueError("Missing, empty or unparseable palette")
+            labs[pos] = rgb_to_lab_array(hex_palette_to_rgb(palette))
+        except (ValueError, TypeError, AttributeError) as e:
+            results[pos] = {"index": index, "id": pid, "error": str(e)}
+
+    positions = list(labs)
+    if not positions:
+        return results
+    # As in composite_reward, zero-weight components are neither computed nor reported
+    active = [k for k in COMPONENTS if weights.get(k)]
+    learned = {}
+    if 'L' in active:
+        learned = learned_scores([labs[p] for p in positions], model_L) if model_L is not None \
+            else [0.5] * len(positions)
+        learned = dict(zip(positions, learned))
+
+    by_size = {}
+    for pos in positions:
+        by_size.setdefault(len(labs[pos]), []).append(pos)
+    for group in by_size.values():
+        batch = np.stack([labs[p] for p in group])
+        if {'H', 'D', 'P'} & set(active):
+            H, D, P = _pair_terms(batch)
+        if 'C' in active:
+            luminance = wcag_luminance_array(batch.reshape(-1, 3)).reshape(len(group), -1)
+        for j, pos in enumerate(group):
+            index, pid, palette = items[pos]
+            roles = assign_roles_lab(labs[pos])
+            terms = {
+                'H': lambda: float(H[j]), 'D': lambda: float(D[j]), 'P': lambda: float(P[j]),
+                'C': lambda: _contrast(luminance[j], roles), 'W': lambda: weight_score(labs[pos], roles),
+                'L': lambda: learned[pos],
+            }
+            components = {k: terms[k]() for k in active}
+            score = sum(weights[k] * components[k] for k in active)
+            results[pos] = {"index": index, "id": pid, "palette": list(palette), "score": float(score),
+                            "components": components, "roles": roles}
+    return results
+
+def score_palettes(palettes, weights=None, model_L=None, chunk_size=CHUNK_SIZE, start_index=0):
+    """
+    Scores a stream of palettes, yielding one dict per input in order.
+
+    Args:
+        palettes: Iterable of hex lists, or of (id, hex list) pairs.
+        weights (dict): The complete set of component weights, as in composite_reward
+            (DEFAULT_WEIGHTS when None). Components weighted 0 or left out are skipped
+            and omitted from "components".
+        model_L: Aesthetic model for the learned term; 0.5 when None.
+        chunk_size (int): Palettes scored per vectorized batch.
+        start_index (int): Index reported for the first palette (when scoring a stream piecewise).
+
+    Yields:
+        {"index", "id", "palette", "score", "components", "roles"}, or
+        {"index", "id", "error"} for a palette that could not be parsed.
+    """
+    weights = DEFAULT_WEIGHTS if weights is None else weights
+    chunk = []
+    for index, item in enumerate(palettes, start_index):
+        pid, palette = item if isinstance(item, tuple) else (None, item)
+        chunk.append((index, pid, palette))
+        if len(chunk) >= chunk_size:
+            with STAGE_SECONDS.time("bulk_score_chunk"):
+                results = _score_chunk(chunk, weights, model_L)
+            yield from results
+            chunk = []
+    if chunk:
+        with STAGE_SECONDS.time("bulk_score_chunk"):
+            results = _score_chunk(chunk, weights, model_L)
+        yield from results
+
+# -------------------------- NDJSON / Arrow I/O --------------------------
+def iter_ndjson_palettes(lines):
+    """
+    Parses NDJSON lines (str or bytes). Each line is a JSON array of hex
+    colors or an object {"palette": [...], "id": ...}; blank lines are skipped.
+    Unparseable lines come through as (None, None) and are reported as errors.
+    """
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield (None, None)
+            continue
+        if isinstance(record, dict):
+            yield (record.get('id'), record.get('palette'))
+        else:
+            yield (None, record)
+
+def iter_arrow_palettes(source):
+    """
+    Opens an Arrow IPC stream and returns an iterator of (id, palette) pairs,
+    read batch by batch. The stream header and schema are checked here, before
+    anything is read lazily, so a malformed body or a missing `palette` column
+    raises ValueError while the caller can still answer 400.
+    """
+    if pa is None:
+        raise RuntimeError("pyarrow is not installed")
+    try:
+        reader = pa.ipc.open_stream(source)
+    except pa.ArrowInvalid as e:
+        raise ValueError(f"Invalid Arrow IPC stream: {e}")
+    if 'palette' not in reader.schema.names:
+        raise ValueError("Arrow input needs a 'palette' list<string> column")
+    return _iter_arrow_batches(reader)
+
+def _iter_arrow_batches(reader):
+    for batch in reader:
+        palettes = batch.column('palette').to_pylist()
+        ids = batch.column('id').to_pylist() if 'id' in batch.schema.names else [None] * len(palettes)
+        yield from zip(ids, palettes)
+
+def to_ndjson(results):
+    """Encodes results as NDJSON, one bytes chunk per line."""
+    for result in results:
+        if result.get("id") is None:
+            result = {k: v for k, v in result.items() if k != "id"}
+        yield (json.dumps(result) + "\n").encode()
+
+def arrow_schema():
+    fields = [("index", pa.int64()), ("id", pa.string()), ("score", pa.float64())]
+    fields += [(k, pa.float64()) for k in COMPONENTS]
+    fields += [("primary", pa.list_(pa.int32())), ("secondary", pa.list_(pa.int32())),
+               ("accent", pa.list_(pa.int32())), ("error", pa.string())]
+    return pa.schema(fields)
+
+ARROW_EOS = b"\xff\xff\xff\xff\x00\x00\x00\x00"
+
+def arrow_schema_message():
+    return arrow_schema().serialize().to_pybytes()
+
+def arrow_batch_message(rows):
+    """One encapsulated IPC record-batch message; concatenate after arrow_schema_message()."""
+    return _arrow_batch(rows, arrow_schema()).serialize().to_pybytes()
+
+def to_arrow_stream(results, chunk_size=CHUNK_SIZE):
+    """
+    Encodes results as an Arrow IPC stream, yielding the schema message, then
+    one message per record batch, then the end-of-stream marker. Nothing is
+    buffered beyond the current batch.
+    """
+    if pa is None:
+        raise RuntimeError("pyarrow is not installed")
+    yield arrow_schema_message()
+    rows = []
+    for result in results:
+        rows.append(result)
+        if len(rows) >= chunk_size:
+            yield arrow_batch_message(rows)
+            rows = []
+    if rows:
+        yield arrow_batch_message(rows)
+    yield ARROW_EOS
+
+def _arrow_batch(rows, schema):
+    columns = {
+        "index": [r["index"] for r in rows],
+        "id": [None if r.get("id") is None else str(r["id"]) for r in rows],
+        "score": [r.get("score") for r in rows],
+        "error": [r.get("error") for r in rows],
+    }
+    for k in COMPONENTS:
+        # Zero-weight components are absent from "components" and come out as nulls
+        columns[k] = [r["components"].get(k) if "components" in r else None for r in rows]
+    for role in ("primary", "secondary", "accent"):
+        columns[role] = [r["roles"][role] if "roles" in r else None for r in rows]
+    return pa.RecordBatch.from_pydict(columns, schema=schema)
@@ -12,6 +12,7 @@ import torch.nn.functional as F
 from torch.utils.data import Dataset, DataLoader, random_split
 from itertools import combinations
 from open_clip import create_model_and_transforms
+from reward_components import RewardRegistry
 
 # 1. Load AADB metadata
 def load_aadb_metadata(aadb_csv_path, images_dir):
@@ -382,25 +383,27 @@ def learned_aesthetic_score(lab_palette, model, device=None):
     return float(max(0.0, min(1.0, score)))
 
 # -------------------------- Composite Reward --------------------------
-def composite_reward(hex_palette, roles, weights=None, dataset=None, prompt_emb=None, model_L=None):
+DEFAULT_WEIGHTS = {'H':0.2,'C':0.25,'D':0.15,'W':0.15,'S':0.05,'N':0.1,'P':0.05,'L':0.05}
+
+# Only components with a non-zero weight are computed (see reward_components.py)
+REWARD_COMPONENTS = RewardRegistry()
+REWARD_COMPONENTS.intermediate('roles', requires=('hex',))(lambda hex_palette: assign_roles(hex_palette))
+REWARD_COMPONENTS.component('H', requires=('lab',))(harmony_score)
+REWARD_COMPONENTS.component('D', requires=('lab',))(distinctness_score)
+REWARD_COMPONENTS.component('P', requires=('lab',))(cohesion_score)
+REWARD_COMPONENTS.component('W', requires=('lab','roles'))(weight_score)
+REWARD_COMPONENTS.component('C', requires=('lab','roles'))(contrast_score)
+REWARD_COMPONENTS.component('N', requires=('lab','dataset'))(novelty_score)
+REWARD_COMPONENTS.component('S', requires=('lab','prompt_emb','clip_model'))(semantic_score)
+REWARD_COMPONENTS.component('L', requires=('lab','model_L'))(learned_aesthetic_score)
+
+def composite_reward(hex_palette, roles, weights=None, dataset=None, prompt_emb=None, model_L=None,
+                     clip_model=None, **inputs):
+    # Zero-weight components are skipped (no CLIP or model forward) and left out of the components
     lab_palette = np.array(palette_hexes_to_lab_array(hex_palette))
-    H = harmony_score(lab_palette)
-    D = distinctness_score(lab_palette)
-    P = cohesion_score(lab_palette)
-    W = weight_score(lab_palette, roles)
-    C = contrast_score(lab_palette, roles)
-    N = novelty_score(lab_palette, dataset)
-    S = semantic_score(lab_palette, prompt_emb)
-    L = learned_aesthetic_score(lab_palette, model_L)
-
-    if weights is None:
-        weights = {'H':0.2,'C':0.25,'D':0.15,'W':0.15,'S':0.05,'N':0.1,'P':0.05,'L':0.05}
-
-    reward = (weights['H']*H + weights['C']*C + weights['D']*D + weights['W']*W +
-              weights['S']*S + weights['N']*N + weights['P']*P + weights['L']*L)
-
-    components = {'H':H,'C':C,'D':D,'W':W,'S':S,'N':N,'P':P,'L':L}
-    return float(reward), components
+    return REWARD_COMPONENTS.evaluate(DEFAULT_WEIGHTS if weights is None else weights,
+                                      hex=list(hex_palette), lab=lab_palette, roles=roles, dataset=dataset, prompt_emb=prompt_emb,
+                                      model_L=model_L, clip_model=clip_model, **inputs)
 
 # -------------------------- Role assignment --------------------------
 def assign_roles(hex_palette):
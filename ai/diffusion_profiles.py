@@ -0,0 +1,89 @@
+# ai/diffusion_profiles.py
+"""
+Inference profiles for the Stable Diffusion pipeline.
+
+The original setup loaded float16 weights with the default 50-step scheduler
+on every device. float16 is unsupported or very slow on CPU, so CPU profiles
+load float32 or bfloat16 weights, switch to DPM-Solver++ (good results in
+10-20 steps), slice attention to bound peak memory and use channels-last
+tensors for the convolutions.
+
+Threads go through the thread governor: generation runs under
+governor.limit("generate", threads=settings["threads"]), which caps only the
+generating thread. The process-wide torch thread count (CHROMA_TORCH_THREADS)
+that every other route runs with is left alone.
+
+Select a profile with CHROMA_DIFFUSION_PROFILE; individual settings can be
+overridden with CHROMA_DIFFUSION_STEPS, CHROMA_DIFFUSION_COMPILE=1 and
+CHROMA_DIFFUSION_THREADS (default: the governor's "generate" limit). `python benchmark.py -k diffusion` reports seconds
+per image for each profile (opt in with CHROMA_BENCH_DIFFUSION=1).
+"""
+import os
+import time
+
+import torch
+
+from thread_governor import governor
+
+MODEL_ID = "runwayml/stable-diffusion-v1-5"
+
+DIFFUSION_PROFILES = {
+    "gpu": {"dtype": "float16", "scheduler": "default", "steps": 50,
+            "attention_slicing": False, "channels_last": False, "compile": False},
+    "cpu-fp32": {"dtype": "float32", "scheduler": "dpm", "steps": 20,
+                 "attention_slicing": True, "channels_last": True, "compile": False},
+    "cpu-bf16": {"dtype": "bfloat16", "scheduler": "dpm", "steps": 20,
+                 "attention_slicing": True, "channels_last": True, "compile": False},
+    "cpu-fast": {"dtype": "float32", "scheduler": "dpm", "steps": 12,
+                 "attention_slicing": True, "channels_last": True, "compile": False},
+}
+
+DTYPES = {"float16": torch.float16, "float32": torch.float32, "bfloat16": torch.bfloat16}
+
+def default_device():
+    return "cuda" if torch.cuda.is_available() else "mps" if torch.backends.mps.is_available() else "cpu"
+
+def resolve_profile(device, name=None):
+    """Profile settings for `device`, with environment overrides applied."""
+    name = name or os.getenv("CHROMA_DIFFUSION_PROFILE") or ("cpu-fp32" if device == "cpu" else "gpu")
+    if name not in DIFFUSION_PROFILES:
+        raise ValueError(f"Unknown diffusion profile '{name}'. Choose from {sorted(DIFFUSION_PROFILES)}")
+    settings = dict(DIFFUSION_PROFILES[name], name=name)
+    if device == "cpu" and settings["dtype"] == "float16":
+        print("⚠️ float16 is not supported for CPU inference, using float32")
+        settings["dtype"] = "float32"
+    if os.getenv("CHROMA_DIFFUSION_STEPS"):
+        settings["steps"] = int(os.getenv("CHROMA_DIFFUSION_STEPS"))
+    if os.getenv("CHROMA_DIFFUSION_COMPILE"):
+        settings["compile"] = os.getenv("CHROMA_DIFFUSION_COMPILE") == "1"
+    if device == "cpu":
+        settings["threads"] = int(os.getenv("CHROMA_DIFFUSION_THREADS") or governor.threads_for("generate"))
+    else:
+        settings["threads"] = None
+    return settings
+
+def build_pipeline(device, settings):
+    """Loads the pipeline and applies the profile's dtype, scheduler and memory settings."""
+    from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
+
+    start = time.perf_counter()
+    # safetensors weights are memory-mapped instead of unpickled into private memory
+    pipe = StableDiffusionPipeline.from_pretrained(MODEL_ID, torch_dtype=DTYPES[settings["dtype"]],
+                                                   use_safetensors=True, low_cpu_mem_usage=True)
+    if settings["scheduler"] == "dpm":
+        pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
+    pipe = pipe.to(device)
+    if settings["attention_slicing"]:
+        pipe.enable_attention_slicing()
+    if settings["channels_last"]:
+        pipe.unet.to(memory_format=torch.channels_last)
+        pipe.vae.to(memory_format=torch.channels_last)
+    if settings["compile"]:
+        # The first call pays the compilation cost; later calls reuse the graph
+        pipe.unet = torch.compile(pipe.unet)
+    pipe.set_progress_bar_config(disable=True)
+
+    print(f"✅ Diffusion pipeline ready in {time.perf_counter() - start:.1f}s "
+          f"(profile={settings['name']}, dtype={settings['dtype']}, scheduler={settings['scheduler']}, "
+          f"steps={settings['steps']}, threads={settings['threads']}, compile={settings['compile']})")
+    return pipe
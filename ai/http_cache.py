@@ -0,0 +1,118 @@
+# ai/http_cache.py
+"""
+HTTP conditional caching for deterministic palette responses.
+
+Extraction seeds K-Means and its pixel sample with random_state=42, and
+optimization seeds its search with 42. A response is therefore a pure
+function of the input bytes, the request parameters and the model weights.
+The strong ETag is a hash of those three things plus CACHE_FORMAT_VERSION:
+a request whose If-None-Match matches is answered 304 before any work
+runs. Retraining or converting a model changes the model version, and
+with it every ETag.
+
+The GET variants of /api/optimize and /api/score carry everything in the
+URL, so they also get an explicit Cache-Control and can be served from a
+CDN or the browser cache without reaching Python. Requests that are not
+deterministic (a wall-clock time_limit, animated extraction with its
+wall-clock frame budget, multi-start runs that report their run times, any
+response from an untrained fallback model) or that carry a profile are
+never tagged.
+
+    CHROMA_CACHE_CONTROL   Cache-Control for GET responses (default: public, max-age=86400)
+"""
+import os
+import json
+import hashlib
+import threading
+
+CACHE_CONTROL = os.getenv("CHROMA_CACHE_CONTROL", "public, max-age=86400")
+# Bump when a response format changes, so old cached entries stop matching
+CACHE_FORMAT_VERSION = "1"
+MAX_GET_PALETTES = 100
+
+_versions = {}
+_versions_lock = threading.Lock()
+
+def model_version(paths):
+    """
+    Short content hash of the model checkpoints in `paths` that exist. It is
+    recomputed only when a file's size or mtime changes.
+    """
+    signature = tuple((p, os.path.getsize(p), os.path.getmtime(p)) for p in paths if os.path.exists(p))
+    with _versions_lock:
+        if signature not in _versions:
+            h = hashlib.sha256()
+            for path, _, _ in signature:
+                with open(path, "rb") as f:
+                    for block in iter(lambda: f.read(1 << 20), b""):
+                        h.update(block)
+            _versions[signature] = h.hexdigest()[:16]
+        return _versions[signature]
+
+def make_etag(kind, params, content=b"", version=""):
+    """Strong ETag over the operation, its canonicalized parameters, the input bytes and the model version."""
+    h = hashlib.sha256()
+    h.update(f"{CACHE_FORMAT_VERSION}|{kind}|{version}|".encode())
+    h.update(json.dumps(params, sort_keys=True, separators=(",", ":"), default=str).encode())
+    h.update(b"|")
+    h.update(content)
+    return f'"{h.hexdigest()[:32]}"'
+
+def etag_matches(if_none_match, etag):
+    """If-None-Match semantics: '*' or any listed tag (weak comparison) matches."""
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = (t.strip() for t in if_none_match.split(","))
+    return any((t[2:] if t.startswith("W/") else t) == etag for t in tags)
+
+def cache_headers(etag, cacheable=False):
+    """Headers for a tagged response; Cache-Control only for GET-able (URL-addressed) variants."""
+    headers = {"ETag": etag}
+    if cacheable:
+        headers["Cache-Control"] = CACHE_CONTROL
+    return headers
+
+# -------------------------- GET variants --------------------------
+def parse_hex_list(raw):
+    """'FF6F61,#FFD662,...' -> ['#FF6F61', '#FFD662', ...]; raises ValueError."""
+    colors = []
+    for part in raw.split(","):
+        digits = part.strip().lstrip("#")
+        if len(digits) != 6:
+            raise ValueError(f"Invalid hex color {part!r}")
+        int(digits, 16)
+        colors.append("#" + digits.upper())
+    return colors
+
+def optimize_request_from_query(args):
+    """
+    Builds the /api/optimize JSON body from query parameters:
+    palette=FF6F61,FFD662,... plus optional moves, steps, starts, refine_steps,
+    contrast (AA | AAA | a minimum ratio) and contrast_pairs (roles | all).
+    `args` is any mapping of name -> first value.
+    """
+    if not args.get("palette"):
+        raise ValueError("No 'palette' provided")
+    data = {"palette": parse_hex_list(args["palette"])}
+    for name in ("steps", "starts", "refine_steps"):
+        if args.get(name) is not None:
+            data[name] = int(args[name])
+    if args.get("moves"):
+        data["moves"] = args["moves"]
+    if args.get("contrast"):
+        level = args["contrast"].upper()
+        spec = {"level": level} if not level.replace(".", "", 1).isdigit() else {"min_ratio": float(level)}
+        if args.get("contrast_pairs"):
+            spec["pairs"] = args["contrast_pairs"]
+        data["contrast"] = spec
+    return data
+
+def palettes_from_query(values):
+    """Palettes for GET /api/score, one per repeated palette=... value."""
+    if not values:
+        raise ValueError("No 'palette' provided")
+    if len(values) > MAX_GET_PALETTES:
+        raise ValueError(f"At most {MAX_GET_PALETTES} palettes per GET; POST larger batches")
+    return [parse_hex_list(v) for v in values]
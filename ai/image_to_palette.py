@@ -3,6 +3,7 @@ import numpy as np
 import colorsys
 from sklearn.cluster import KMeans
 from skimage.color import rgb2hsv, rgb2lab, lab2rgb
+from metrics import STAGE_SECONDS
 
 # ------------------------
 # Utility Functions (Unchanged)
@@ -31,6 +32,44 @@ def make_swatch_image(rgb_array, sw=100, sh=100):
         draw.rectangle([i * sw, 0, (i + 1) * sw, sh], fill=tuple(int(x) for x in col))
     return img
 
+def detailed_palette(rgb_array):
+    # Hex, rgb() and hsl() strings plus a role for each color, most prominent first.
+    roles = ["Primary", "Secondary", "Accent 1", "Accent 2", "Background"]
+    detailed_output = []
+    for i, c in enumerate(rgb_array):
+        hex_code = rgb_to_hex(c)
+        role = roles[i] if i < len(roles) else f"Color {i + 1}"
+        detailed_output.append({
+            "hex": hex_code,
+            "rgb": hex_to_rgb_string(hex_code),
+            "hsl": rgb_to_hsl_string(c),
+            "role": role
+        })
+    return detailed_output
+
+def thumbnail_pixels(image_input):
+    # Decodes an image (path, file-like or PIL Image) and returns its 600px thumbnail as (N, 3) RGB.
+    with STAGE_SECONDS.time("decode"):
+        if isinstance(image_input, Image.Image):
+            img = image_input.convert("RGB")
+        else:
+            img = Image.open(image_input).convert("RGB")
+
+    with STAGE_SECONDS.time("thumbnail"):
+        img.thumbnail((600, 600))               # Resize for performance
+        return np.array(img).reshape(-1, 3)
+
+def vibrant_mask(pixels, min_saturation=0.15, value_low=0.1, value_high=0.95):
+    # Boolean mask of the (N, 3) RGB pixels within the saturation/value range.
+    with STAGE_SECONDS.time("hsv_mask"):
+        # Convert pixels to HSV color space in a single, fast operation.
+        pixels_hsv = rgb2hsv(pixels / 255.0)
+        return (
+            (pixels_hsv[:, 1] > min_saturation) &
+            (pixels_hsv[:, 2] > value_low) &
+            (pixels_hsv[:, 2] < value_high)
+        )
+
 # ------------------------
 # Main Extraction Function (Improved)
 # ------------------------
@@ -41,7 +80,9 @@ def extract_palette(
     min_saturation=0.15,
     value_low=0.1,
     value_high=0.95,
-    sample_size=5000
+    sample_size=5000,
+    random_state=42,
+    return_shares=False
 ):
     """
     Extracts a vibrant, representative color palette from an image using
@@ -56,31 +97,21 @@ def extract_palette(
         value_low (float): Minimum value/brightness for a pixel to be considered.
         value_high (float): Maximum value/brightness for a pixel to be considered.
         sample_size (int): Number of pixels to sample before clustering for performance.
+        random_state (int): Seed for pixel sampling and K-Means, so results are reproducible.
+        return_shares (bool): If True, also return each color's share of the sampled pixels.
 
     Returns:
-        A tuple containing (palette, swatch_image, color_space_used).
+        A tuple containing (palette, swatch_image, color_space_used), plus
+        `shares` (fractions summing to 1, in palette order) when return_shares is set.
         - palette: A list of hex strings or detailed dictionaries.
         - swatch_image: A PIL Image object showing the palette.
         - color_space_used: 'lab' or 'rgb', indicating the clustering method.
     """
     try:
-        if isinstance(image_input, Image.Image):
-            img = image_input.convert("RGB")
-        else:
-            img = Image.open(image_input).convert("RGB")
-        
-        img.thumbnail((600, 600))               # Resize for performance
-        pixels = np.array(img).reshape(-1, 3)
-        # Convert pixels to HSV color space in a single, fast operation.
-        pixels_hsv = rgb2hsv(pixels / 255.0)
+        pixels = thumbnail_pixels(image_input)
 
-        # Create a boolean mask to find pixels within our desired saturation/value range.
-        mask = (
-            (pixels_hsv[:, 1] > min_saturation) &
-            (pixels_hsv[:, 2] > value_low) &
-            (pixels_hsv[:, 2] < value_high)
-        )
-        vibrant_pixels = pixels[mask]
+        # Keep only pixels within our desired saturation/value range.
+        vibrant_pixels = pixels[vibrant_mask(pixels, min_saturation, value_low, value_high)]
 
         # If filtering removed too many pixels, fall back to using all pixels.
         if len(vibrant_pixels) < num_colors:
@@ -90,7 +121,7 @@ def extract_palette(
         # Use a random sample to speed up K-Means.
         n_samples = len(vibrant_pixels)
         if n_samples > sample_size:
-            idx = np.random.choice(n_samples, sample_size, replace=False)
+            idx = np.random.default_rng(random_state).choice(n_samples, sample_size, replace=False)
             sample_pixels = vibrant_pixels[idx]
         else:
             sample_pixels = vibrant_pixels
@@ -98,21 +129,22 @@ def extract_palette(
         # Ensure we don't request more clusters than available pixels.
         num_clusters = min(num_colors, len(np.unique(sample_pixels, axis=0)))
         if num_clusters == 0:
-            return [], None, "none"
-
-        # 1. Try clustering in CIELAB space (perceptually uniform, often better results)
-        try:
-            used_space = "lab"
-            lab_pixels = rgb2lab(sample_pixels / 255.0)
-            kmeans = KMeans(n_clusters=num_clusters, random_state=42, n_init=10).fit(lab_pixels)
-            # Convert cluster centers back to RGB
-            centers_rgb = lab2rgb(kmeans.cluster_centers_) * 255.0
-
-        # 2. Fallback to RGB space if Lab clustering fails
-        except Exception:
-            used_space = "rgb"
-            kmeans = KMeans(n_clusters=num_clusters, random_state=42, n_init=10).fit(sample_pixels)
-            centers_rgb = kmeans.cluster_centers_
+            return ([], None, "none", []) if return_shares else ([], None, "none")
+
+        with STAGE_SECONDS.time("kmeans"):
+            # 1. Try clustering in CIELAB space (perceptually uniform, often better results)
+            try:
+                used_space = "lab"
+                lab_pixels = rgb2lab(sample_pixels / 255.0)
+                kmeans = KMeans(n_clusters=num_clusters, random_state=random_state, n_init=10).fit(lab_pixels)
+                # Convert cluster centers back to RGB
+                centers_rgb = lab2rgb(kmeans.cluster_centers_) * 255.0
+
+            # 2. Fallback to RGB space if Lab clustering fails
+            except Exception:
+                used_space = "rgb"
+                kmeans = KMeans(n_clusters=num_clusters, random_state=random_state, n_init=10).fit(sample_pixels)
+                centers_rgb = kmeans.cluster_centers_
 
         # Sort colors by prominence (number of pixels in each cluster)
         counts = np.bincount(kmeans.labels_)
@@ -122,24 +154,129 @@ def extract_palette(
         # --- FORMAT AND RETURN OUTPUT ---
         final_palette_rgb = centers_rgb_sorted[:num_colors]
         swatch = make_swatch_image(final_palette_rgb)
+        extra = (list(counts[order][:num_colors] / counts.sum()),) if return_shares else ()
 
         if hex_only:
             palette_output = [rgb_to_hex(c) for c in final_palette_rgb]
-            return palette_output, swatch, used_space
+            return (palette_output, swatch, used_space) + extra
         else:
             # Assign roles more robustly for any number of colors
-            roles = ["Primary", "Secondary", "Accent 1", "Accent 2", "Background"]
-            detailed_output = []
-            for i, c in enumerate(final_palette_rgb):
-                hex_code = rgb_to_hex(c)
-                role = roles[i] if i < len(roles) else f"Color {i + 1}"
-                detailed_output.append({
-                    "hex": hex_code,
-                    "rgb": hex_to_rgb_string(hex_code),
-                    "hsl": rgb_to_hsl_string(c),
-                    "role": role
-                })
-            return detailed_output, swatch, used_space
+            return (detailed_palette(final_palette_rgb), swatch, used_space) + extra
     except Exception as e:
         print(f"Error opening or processing image: {e}")
-        return None, None, None
\ No newline at end of file
+        return (None, None, None, None) if return_shares else (None, None, None)
+
+# ------------------------
+# Progressive Extraction
+# ------------------------
+PROGRESSIVE_SAMPLE_SIZES = (256, 5000)
+
+def extract_palette_progressive(
+    image_input,
+    num_colors=8,
+    sample_sizes=PROGRESSIVE_SAMPLE_SIZES,
+    min_saturation=0.15,
+    value_low=0.1,
+    value_high=0.95,
+    random_state=42
+):
+    """
+    Yields increasingly accurate palettes for an image, one per sample size.
+
+    Pixels are visited in one seeded random order and only as many are
+    HSV-filtered as each sample needs, so the first palette comes from a few
+    hundred pixels in milliseconds. Samples are nested (each larger sample
+    contains the previous one), and each later K-Means starts from the
+    previous centroids with a single init, so refining converges in a few
+    iterations instead of restarting n_init=10 times like extract_palette.
+
+    Yields:
+        (sample_size, rgb_array, shares, last): the pixels clustered, int RGB
+        centers sorted by prominence, their share of the sampled pixels, and
+        whether this is the last palette (refining stops early once a sample
+        holds every vibrant pixel).
+    """
+    pixels = thumbnail_pixels(image_input)
+    pixels = pixels[np.random.default_rng(random_state).permutation(len(pixels))]
+    vibrant, checked = [], 0
+    centers = None
+    for stage, sample_size in enumerate(sample_sizes):
+        # Filter pixels in order until the sample is full (twice the shortfall per pass)
+        while sum(len(v) for v in vibrant) < sample_size and checked < len(pixels):
+            batch = pixels[checked:checked + 2 * (sample_size - sum(len(v) for v in vibrant))]
+            vibrant.append(batch[vibrant_mask(batch, min_saturation, value_low, value_high)])
+            checked += len(batch)
+        sample_pixels = np.concatenate(vibrant)[:sample_size]
+        exhausted = checked == len(pixels) and len(sample_pixels) < sample_size
+        # If filtering removed too many pixels, fall back to using all pixels.
+        if exhausted and len(sample_pixels) < num_colors:
+            sample_pixels = pixels[:sample_size]
+
+        num_clusters = min(num_colors, len(np.unique(sample_pixels, axis=0)))
+        if num_clusters == 0:
+            return
+        # A larger sample can hold more distinct colors than the coarse one had clusters
+        init = centers if centers is not None and len(centers) == num_clusters else "k-means++"
+        with STAGE_SECONDS.time("kmeans"):
+            kmeans = KMeans(n_clusters=num_clusters, init=init, n_init=1,
+                            random_state=random_state).fit(rgb2lab(sample_pixels / 255.0))
+        centers = kmeans.cluster_centers_
+
+        counts = np.bincount(kmeans.labels_, minlength=num_clusters)
+        ranked = np.argsort(counts)[::-1]
+        rgb = (lab2rgb(centers[ranked]) * 255.0).clip(0, 255).astype(int)
+        last = exhausted or stage == len(sample_sizes) - 1
+        yield len(sample_pixels), rgb, [float(c) for c in counts[ranked] / counts.sum()], last
+        if last:
+            return
+
+# ------------------------
+# Consensus Across Images
+# ------------------------
+def consensus_palette(palettes, shares, num_colors=8, random_state=42):
+    """
+    Merges palettes extracted from several images of the same subject (e.g.
+    diffusion variants of one prompt) into one palette.
+
+    Every color is a point in Lab weighted by its share of its own image, and
+    each image contributes equal total weight. A weighted K-Means over all
+    points keeps colors that recur across images and drops one-off outliers.
+
+    Args:
+        palettes (list[list[str]]): Hex palettes, one per image.
+        shares (list[list[float]]): Matching per-color pixel shares.
+        num_colors (int): Size of the consensus palette.
+
+    Returns:
+        (consensus, agreement): the consensus hex palette sorted by total weight,
+        and per-input mean Lab distance to it (lower = closer to the consensus;
+        None for empty inputs).
+    """
+    labs, weights = [], []
+    for palette, palette_shares in zip(palettes, shares):
+        if not palette:
+            labs.append(None)
+            weights.append(None)
+            continue
+        rgb = np.array([[int(h.lstrip('#')[i:i + 2], 16) for i in (0, 2, 4)] for h in palette])
+        labs.append(rgb2lab(rgb.reshape(-1, 1, 3) / 255.0).reshape(-1, 3))
+        w = np.asarray(palette_shares, dtype=np.float64)
+        weights.append(w / max(w.sum(), 1e-12))
+    if all(lab is None for lab in labs):
+        return [], [None] * len(labs)
+
+    points = np.vstack([lab for lab in labs if lab is not None])
+    point_weights = np.concatenate([w for w in weights if w is not None])
+    # No larger than the richest input, so the same color seen in every image is one cluster
+    k = min(num_colors, max(len(lab) for lab in labs if lab is not None), len(np.unique(points.round(3), axis=0)))
+    kmeans = KMeans(n_clusters=k, random_state=random_state, n_init=4).fit(points, sample_weight=point_weights)
+    mass = np.bincount(kmeans.labels_, weights=point_weights, minlength=k)
+    centers = kmeans.cluster_centers_[np.argsort(mass)[::-1]]
+    consensus = [rgb_to_hex(c) for c in (lab2rgb(centers.reshape(-1, 1, 3)).reshape(-1, 3) * 255.0).clip(0, 255)]
+
+    agreement = [
+        None if lab is None else
+        float(np.linalg.norm(lab[:, None, :] - centers[None, :, :], axis=2).min(axis=1).mean())
+        for lab in labs
+    ]
+    return consensus, agreement
\ No newline at end of file
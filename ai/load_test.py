@@ -0,0 +1,337 @@
+# ai/load_test.py
+"""
+Load generator for the palette API.
+
+Drives /api/generate-palette, /api/extract, /api/optimize and /api/score
+with a weighted request mix and reports throughput, status codes and
+latency percentiles per route. Every input is synthetic and seeded
+(procedural PNG uploads, random hex palettes, numbered prompts), so runs
+are repeatable and comparable.
+
+The default is a closed loop: each of --concurrency clients sends its next
+request as soon as the previous one returns. --rate switches to an open
+loop with Poisson arrivals at that many requests/s, still capped at
+--concurrency in flight. Latency is then measured from each request's
+scheduled start, so queueing under overload shows up in the percentiles
+instead of quietly slowing the generator down.
+
+Generation needs Stable Diffusion. Start the server with
+CHROMA_DIFFUSION_BACKEND=stub (latency set by CHROMA_STUB_DIFFUSION_SECONDS)
+to load test it without the model. --in-process serves the ASGI app inside
+this process instead of over the network, with the stub backend unless
+CHROMA_DIFFUSION_BACKEND says otherwise; client and server then share the
+CPU, so use it for regressions rather than capacity numbers.
+
+Usage:
+    python load_test.py --url http://127.0.0.1:5001 --duration 60 --concurrency 8
+    python load_test.py --in-process --mix extract=4,optimize=3,score=2,generate=1 --requests 200
+    python load_test.py --rate 20 --duration 60 --save run.json
+    python load_test.py --duration 60 --compare run.json  # exit 1 on regressions
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+from datetime import datetime, timezone
+
+import numpy as np
+import httpx
+from PIL import Image
+
+ROUTES = {
+    "generate": ("POST", "/api/generate-palette"),
+    "extract": ("POST", "/api/extract"),
+    "optimize": ("POST", "/api/optimize"),
+    "score": ("POST", "/api/score"),
+}
+DEFAULT_MIX = "extract=4,optimize=3,score=2,generate=1"
+PERCENTILES = (50, 90, 99)
+
+# -------------------------- Synthetic inputs --------------------------
+def synthetic_upload(size, seed):
+    """PNG bytes of a few random hues blended over a smooth field, plus noise."""
+    rng = np.random.default_rng(seed)
+    colors = rng.integers(0, 256, size=(int(rng.integers(3, 7)), 3)).astype(np.float32)
+    # A coarse random grid of color weights, upsampled so regions blend smoothly
+    coarse = rng.random((6, 6, len(colors))).astype(np.float32) ** 4
+    coarse /= coarse.sum(axis=-1, keepdims=True)
+    channels = [np.asarray(Image.fromarray(coarse[..., i]).resize((size, size), Image.BILINEAR))
+                for i in range(len(colors))]
+    pixels = np.stack(channels, axis=-1) @ colors + rng.normal(0, 8, (size, size, 3))
+    buffer = io.BytesIO()
+    Image.fromarray(pixels.clip(0, 255).astype(np.uint8)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def random_palette(rng, k=None):
+    k = k or rng.randint(4, 8)
+    return ['#{:02X}{:02X}{:02X}'.format(*(rng.randrange(256) for _ in range(3))) for _ in range(k)]
+
+class RequestFactory:
+    """Builds the keyword arguments of the i-th request to each route."""
+
+    def __init__(self, args):
+        self.args = args
+        self.uploads = [synthetic_upload(args.image_size, args.seed + i) for i in range(args.uploads)]
+
+    def build(self, route, i, rng):
+        args = self.args
+        if route == "generate":
+            body = {"prompt": f"load test scene {i % 97}, soft light", "seed": i,
+                    "optimize": args.generate_optimize}
+            if args.variants > 1:
+                body["variants"] = args.variants
+            return {"json": body}
+        if route == "extract":
+            return {"files": {"file": (f"upload-{i}.png", self.uploads[i % len(self.uploads)], "image/png")},
+                    "data": {"optimize": args.extract_optimize}}
+        if route == "optimize":
+            return {"json": {"palette": random_palette(rng), "steps": args.optimize_steps,
+                             "moves": args.optimize_moves}}
+        if route == "score":
+            return {"json": {"palettes": [random_palette(rng) for _ in range(args.score_batch)]}}
+        raise ValueError(f"Unknown route '{route}'")
+
+def parse_mix(spec):
+    """'extract=4,optimize=3' -> {'extract': 4.0, 'optimize': 3.0}; raises ValueError."""
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.strip().partition("=")
+        if name not in ROUTES:
+            raise ValueError(f"Unknown route '{name}' in --mix. Choose from {sorted(ROUTES)}")
+        mix[name] = float(weight or 1)
+    if not any(w > 0 for w in mix.values()):
+        raise ValueError("--mix needs at least one positive weight")
+    return {name: w for name, w in mix.items() if w > 0}
+
+# -------------------------- Driver --------------------------
+class LoadRun:
+    def __init__(self, client, factory, mix, args):
+        self.client = client
+        self.factory = factory
+        self.routes = list(mix)
+        self.weights = list(mix.values())
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.issued = 0
+        self.samples = []   # (route, status, latency_s); status 0 is a transport error
+        self.errors = {}
+
+    def next_request(self):
+        """The next (route, kwargs), or None once --requests have been issued."""
+        if self.args.requests and self.issued >= self.args.requests:
+            return None
+        i = self.issued
+        self.issued += 1
+        route = self.rng.choices(self.routes, self.weights)[0]
+        return route, self.factory.build(route, i, self.rng)
+
+    async def send(self, route, kwargs, scheduled=None, record=True):
+        method, path = ROUTES[route]
+        start = scheduled or time.perf_counter()
+        try:
+            response = await self.client.request(method, path, **kwargs)
+            await response.aread()
+            status = response.status_code
+        except httpx.HTTPError as e:
+            status = 0
+            self.errors[f"{route}: {type(e).__name__}"] = self.errors.get(f"{route}: {type(e).__name__}", 0) + 1
+        if record:
+            self.samples.append((route, status, time.perf_counter() - start))
+
+    async def warmup(self):
+        # Loads models and fills caches; not recorded
+        for route in self.routes:
+            for i in range(self.args.warmup):
+                await self.send(route, self.factory.build(route, -1 - i, self.rng), record=False)
+
+    async def closed_loop(self, deadline):
+        async def client():
+            while time.perf_counter() < deadline:
+                request = self.next_request()
+                if request is None:
+                    return
+                await self.send(*request)
+        await asyncio.gather(*(client() for _ in range(self.args.concurrency)))
+
+    async def open_loop(self, deadline):
+        slots = asyncio.Semaphore(self.args.concurrency)
+        arrivals = random.Random(self.args.seed + 1)
+        tasks = set()
+
+        async def fire(request, scheduled):
+            async with slots:
+                await self.send(*request, scheduled=scheduled)
+
+        scheduled = time.perf_counter()
+        while scheduled < deadline:
+            request = self.next_request()
+            if request is None:
+                break
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            task = asyncio.create_task(fire(request, scheduled))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            scheduled += arrivals.expovariate(self.args.rate)
+        await asyncio.gather(*tasks)
+
+    async def run(self):
+        if self.args.warmup:
+            await self.warmup()
+        start = time.perf_counter()
+        deadline = start + self.args.duration if self.args.duration else float("inf")
+        if self.args.rate:
+            await self.open_loop(deadline)
+        else:
+            await self.closed_loop(deadline)
+        return time.perf_counter() - start
+
+def summarize(samples, elapsed):
+    """Per-route and overall counts, statuses, throughput and latency percentiles (ms)."""
+    groups = {}
+    for route, status, latency in samples:
+        groups.setdefault(route, []).append((status, latency))
+    groups["all"] = [(status, latency) for _, status, latency in samples]
+
+    summary = {}
+    for route, rows in groups.items():
+        latencies = np.array([latency for _, latency in rows]) * 1e3
+        statuses = {}
+        for status, _ in rows:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        ok = sum(1 for status, _ in rows if 200 <= status < 400)
+        summary[route] = {
+            "requests": len(rows),
+            "ok": ok,
+            "throughput_rps": ok / elapsed if elapsed else 0.0,
+            "statuses": statuses,
+            **{f"p{p}_ms": float(np.percentile(latencies, p)) for p in PERCENTILES},
+            "mean_ms": float(latencies.mean()),
+            "max_ms": float(latencies.max()),
+        }
+    return summary
+
+def print_summary(summary, elapsed):
+    print(f"\n{'route':<10} {'requests':>8} {'ok':>7} {'req/s':>8} "
+          + " ".join(f"{f'p{p} ms':>9}" for p in PERCENTILES) + f" {'max ms':>9}  statuses")
+    for route, r in summary.items():
+        statuses = ", ".join(f"{s}×{n}" for s, n in sorted(r["statuses"].items()))
+        print(f"{route:<10} {r['requests']:>8d} {r['ok']:>7d} {r['throughput_rps']:>8.2f} "
+              + " ".join(f"{r[f'p{p}_ms']:>9.1f}" for p in PERCENTILES) + f" {r['max_ms']:>9.1f}  {statuses}")
+    print(f"\n{sum(r['requests'] for k, r in summary.items() if k != 'all')} requests in {elapsed:.1f}s")
+
+def compare_to_baseline(summary, baseline, threshold, open_loop=False):
+    """
+    Returns (route, metric, baseline, current, change) for metrics worse than
+    threshold. Throughput is only compared between closed-loop runs; in an
+    open loop it is set by --rate.
+    """
+    metrics = [("p50_ms", True), ("p99_ms", True)]
+    if not open_loop and not baseline.get("environment", {}).get("options", {}).get("rate"):
+        metrics.append(("throughput_rps", False))
+    regressions = []
+    for route, current in summary.items():
+        reference = baseline.get("routes", {}).get(route)
+        if not reference:
+            continue
+        for metric, higher_is_worse in metrics:
+            if not reference.get(metric):
+                continue
+            change = current[metric] / reference[metric] - 1.0
+            worse = change > threshold if higher_is_worse else change < -threshold
+            print(f"{route:<10} {metric:<15} {reference[metric]:>10.2f} -> {current[metric]:>10.2f} "
+                  f"({change:+.1%}) {'REGRESSION' if worse else 'ok'}")
+            if worse:
+                regressions.append((route, metric, reference[metric], current[metric], change))
+    return regressions
+
+def environment_info(args):
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "target": "in-process" if args.in_process else args.url,
+        "diffusion_backend": os.getenv("CHROMA_DIFFUSION_BACKEND"),
+        "options": {k: v for k, v in vars(args).items() if k not in ("save", "compare")},
+    }
+
+def make_client(args):
+    timeout = httpx.Timeout(args.timeout)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    if args.in_process:
+        os.environ.setdefault("CHROMA_DIFFUSION_BACKEND", "stub")
+        from asgi_app import app
+        return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://chroma",
+                                 timeout=timeout)
+    return httpx.AsyncClient(base_url=args.url, timeout=timeout, limits=limits)
+
+async def run_load(args):
+    mix = parse_mix(args.mix)
+    factory = RequestFactory(args)
+    async with make_client(args) as client:
+        load = LoadRun(client, factory, mix, args)
+        mode = f"open loop at {args.rate:g} req/s" if args.rate else "closed loop"
+        print(f"🚀 {mode}, concurrency {args.concurrency}, mix {mix}")
+        elapsed = await load.run()
+    for error, count in sorted(load.errors.items()):
+        print(f"❌ {error} ×{count}")
+    if not load.samples:
+        raise RuntimeError("No requests completed")
+    return summarize(load.samples, elapsed), elapsed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the palette API")
+    parser.add_argument("--url", default="http://127.0.0.1:5001", help="server base URL")
+    parser.add_argument("--in-process", action="store_true",
+                        help="serve asgi_app in this process (stub diffusion unless configured)")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="route weights, e.g. extract=4,score=1")
+    parser.add_argument("--concurrency", type=int, default=4, help="requests in flight at once")
+    parser.add_argument("--rate", type=float, help="open loop: Poisson arrivals at this many requests/s")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to run (0: until --requests)")
+    parser.add_argument("--requests", type=int, default=0, help="stop after this many requests")
+    parser.add_argument("--warmup", type=int, default=1, help="unrecorded requests per route first")
+    parser.add_argument("--timeout", type=float, default=120.0, help="per-request timeout in seconds")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--uploads", type=int, default=16, help="distinct synthetic images for extract")
+    parser.add_argument("--image-size", type=int, default=512, help="synthetic upload size in pixels")
+    parser.add_argument("--extract-optimize", default="basic", choices=("basic", "advanced"))
+    parser.add_argument("--optimize-steps", type=int, default=20)
+    parser.add_argument("--optimize-moves", default="all")
+    parser.add_argument("--score-batch", type=int, default=50, help="palettes per score request")
+    parser.add_argument("--variants", type=int, default=1, help="images per generate request")
+    parser.add_argument("--generate-optimize", action="store_true", help="optimize generated palettes")
+    parser.add_argument("--save", help="write results JSON to this path")
+    parser.add_argument("--compare", help="baseline results JSON; exit 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=0.20,
+                        help="allowed fractional latency rise or throughput drop per route")
+    args = parser.parse_args(argv)
+    if not args.duration and not args.requests:
+        parser.error("set --duration or --requests")
+
+    summary, elapsed = asyncio.run(run_load(args))
+    print_summary(summary, elapsed)
+    report = {"environment": environment_info(args), "elapsed_s": elapsed, "routes": summary}
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"✅ Results saved to {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(summary, baseline, args.threshold, open_loop=bool(args.rate))
+        if regressions:
+            print(f"❌ {len(regressions)} metric(s) regressed by more than {args.threshold:.0%}")
+            return 1
+        print("✅ No regressions")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
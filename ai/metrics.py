@@ -0,0 +1,255 @@
+# ai/metrics.py
+"""
+Minimal in-process metrics rendered in the Prometheus text exposition format.
+
+Kept dependency-free and cheap enough to sit on the hot path: an observation is
+a bisect over the bucket bounds plus a few additions under a per-metric lock.
+
+Metrics live in the process that records them. Work sent to a process pool
+runs through run_recorded(), which returns the worker's counter and
+histogram changes with the result for the parent to merge(). Gauges are
+point-in-time values of the worker itself and stay there.
+"""
+import time
+import threading
+from bisect import bisect_left
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Spans sub-millisecond color math up to multi-minute CPU diffusion runs.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+REGISTRY = []
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    body = ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in pairs)
+    return "{" + body + "}"
+
+def _format_value(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        REGISTRY.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._render_series(items))
+        return lines
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def _merge(self, labelvalues, delta):
+        self.inc(*labelvalues, amount=delta)
+
+    def _render_series(self, items):
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}"
+                for k, v in items]
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = value
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def dec(self, *labelvalues, amount=1):
+        self.inc(*labelvalues, amount=-amount)
+
+    def _render_series(self, items):
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}"
+                for k, v in items]
+
+class _Timer:
+    __slots__ = ("_histogram", "_labelvalues", "_start")
+
+    def __init__(self, histogram, labelvalues):
+        self._histogram = histogram
+        self._labelvalues = labelvalues
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._start, *self._labelvalues)
+        return False
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelvalues):
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labelvalues)
+            if series is None:
+                # [per-bucket counts..., +Inf count, sum]
+                series = self._values[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[idx] += 1
+            series[-1] += value
+
+    def time(self, *labelvalues):
+        """Context manager observing the wall-clock duration of its block."""
+        return _Timer(self, labelvalues)
+
+    def _merge(self, labelvalues, delta):
+        with self._lock:
+            series = self._values.setdefault(labelvalues, [0] * (len(self.buckets) + 1) + [0.0])
+            for i, value in enumerate(delta):
+                series[i] += value
+
+    def _render_series(self, items):
+        lines = []
+        for labelvalues, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += count
+                labels = _format_labels(self.labelnames, labelvalues, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {series[-1]!r}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+def render():
+    """Returns every registered metric as Prometheus exposition text."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# -------------------------- Process Pools --------------------------
+_reported = {}  # (metric name, labelvalues) -> value as of the last take_changes()
+_reported_lock = threading.Lock()
+
+def take_changes():
+    """
+    Counter and histogram changes since the previous call in this process,
+    as {metric name: {labelvalues: delta}}, for merge() in another process.
+    """
+    changes = {}
+    with _reported_lock:
+        for metric in REGISTRY:
+            if not hasattr(metric, "_merge"):
+                continue
+            with metric._lock:
+                current = {k: list(v) if isinstance(v, list) else v for k, v in metric._values.items()}
+            for labelvalues, value in current.items():
+                previous = _reported.get((metric.name, labelvalues))
+                if isinstance(value, list):
+                    delta = [a - b for a, b in zip(value, previous)] if previous else value
+                    changed = any(delta[:-1])
+                else:
+                    delta = value - (previous or 0)
+                    changed = delta != 0
+                if changed:
+                    changes.setdefault(metric.name, {})[labelvalues] = delta
+                    _reported[(metric.name, labelvalues)] = value
+    return changes
+
+def merge(changes):
+    """Adds another process's take_changes() to this process's metrics."""
+    metrics = {metric.name: metric for metric in REGISTRY}
+    for name, series in changes.items():
+        for labelvalues, delta in series.items():
+            metrics[name]._merge(labelvalues, delta)
+
+def run_recorded(fn, *args):
+    """Runs fn(*args) in a pool worker; returns (result, take_changes()) so the parent can merge()."""
+    result = fn(*args)
+    return result, take_changes()
+
+# -------------------------- Pipeline Metrics --------------------------
+STAGE_SECONDS = Histogram(
+    "chroma_stage_seconds",
+    "Latency of individual color pipeline stages.",
+    ["stage"],
+)
+REQUEST_SECONDS = Histogram(
+    "chroma_request_seconds",
+    "End-to-end latency of API requests.",
+    ["route", "status"],
+)
+OPTIMIZE_EVALUATIONS = Counter(
+    "chroma_optimize_evaluations_total",
+    "Candidate palettes scored by optimize_palette.",
+)
+FALLBACKS = Counter(
+    "chroma_fallbacks_total",
+    "Responses served from a fallback path.",
+    ["kind"],
+)
+CACHE_HITS = Counter(
+    "chroma_cache_hits_total",
+    "Cache lookups answered without recomputation.",
+    ["cache"],
+)
+CACHE_MISSES = Counter(
+    "chroma_cache_misses_total",
+    "Cache lookups that had to recompute.",
+    ["cache"],
+)
+ERRORS = Counter(
+    "chroma_errors_total",
+    "Errors raised while handling requests.",
+    ["route"],
+)
+MODEL_RESIDENT_BYTES = Gauge(
+    "chroma_model_resident_bytes",
+    "Measured parameter and buffer bytes of each loaded model.",
+    ["model"],
+)
+MODEL_LOADS = Counter(
+    "chroma_model_loads_total",
+    "Model loads performed by the model registry.",
+    ["model"],
+)
+MODEL_EVICTIONS = Counter(
+    "chroma_model_evictions_total",
+    "Models unloaded by the model registry.",
+    ["model", "reason"],
+)
+ADMISSION_IN_FLIGHT = Gauge(
+    "chroma_admission_in_flight",
+    "Requests currently holding an admission slot.",
+    ["budget"],
+)
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "chroma_admission_queue_depth",
+    "Requests waiting for an admission slot.",
+    ["budget"],
+)
+ADMISSION_REJECTIONS = Counter(
+    "chroma_admission_rejections_total",
+    "Requests rejected with 503 by admission control.",
+    ["budget", "reason"],
+)
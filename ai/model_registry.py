@@ -0,0 +1,225 @@
+# ai/model_registry.py
+"""
+Lazy, memory-budgeted model registry.
+
+Models are registered with a zero-argument loader and only loaded on first
+use. After loading, the registry measures each model's resident size
+(parameters + buffers of every torch module it holds) and evicts the
+least-recently-used idle models whenever the total exceeds the budget.
+A background reaper also unloads models that have not been used for the
+idle timeout, so multi-GB diffusion weights do not sit in memory for hours
+between text-to-palette requests.
+
+Configuration:
+    CHROMA_MODEL_BUDGET_MB      total resident budget (0 = unlimited)
+    CHROMA_MODEL_IDLE_SECONDS   unload after this long unused (0 = never)
+"""
+import gc
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+from metrics import MODEL_RESIDENT_BYTES, MODEL_LOADS, MODEL_EVICTIONS
+
+BUDGET_MB = float(os.getenv("CHROMA_MODEL_BUDGET_MB", 0))
+IDLE_SECONDS = float(os.getenv("CHROMA_MODEL_IDLE_SECONDS", 1800))
+
+def resident_bytes(obj):
+    """Bytes held by the torch modules in obj (a module, or a pipeline exposing .components)."""
+    try:
+        import torch
+    except ImportError:
+        return 0
+    if isinstance(obj, torch.nn.Module):
+        modules = [obj]
+    elif isinstance(getattr(obj, "components", None), dict):
+        modules = [m for m in obj.components.values() if isinstance(m, torch.nn.Module)]
+    else:
+        return 0
+    seen, total = set(), 0
+    for module in modules:
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            # Tied weights are shared between modules; count each storage once
+            if tensor.data_ptr() in seen:
+                continue
+            seen.add(tensor.data_ptr())
+            total += tensor.numel() * tensor.element_size()
+    return total
+
+class _Entry:
+    __slots__ = ("name", "loader", "idle_seconds", "model", "size", "last_used",
+                 "in_use", "loads", "error", "load_lock")
+
+    def __init__(self, name, loader, idle_seconds):
+        self.name = name
+        self.loader = loader
+        self.idle_seconds = idle_seconds
+        self.model = None
+        self.size = 0               # last measured size, used to make room before a reload
+        self.last_used = 0.0
+        self.in_use = 0
+        self.loads = 0
+        self.error = None           # message of the last failed load, cleared by a successful one
+        # Held while loading and pinning; unloading skips an entry whose lock is taken
+        self.load_lock = threading.Lock()
+
+class ModelRegistry:
+    def __init__(self, budget_mb=BUDGET_MB, idle_seconds=IDLE_SECONDS):
+        self.budget = int(budget_mb * 1024 * 1024)
+        self.idle_seconds = idle_seconds
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def register(self, name, loader, idle_seconds=None):
+        """Adds (or replaces) a model. Nothing is loaded until get()/use()."""
+        with self._lock:
+            old = self._entries.get(name)
+            self._entries[name] = _Entry(name, loader, self.idle_seconds if idle_seconds is None else idle_seconds)
+        if old is not None and old.model is not None:
+            self._unload(old, "replaced")
+
+    def get(self, name):
+        """
+        Returns the model, loading it if needed. Concurrent callers share one load.
+        The model is not pinned and may be evicted as soon as this returns, so
+        request code should hold use() for as long as it works with the model.
+        """
+        with self.use(name) as model:
+            return model
+
+    @contextmanager
+    def use(self, name):
+        """Loads the model if needed and pins it: it cannot be evicted until the block exits."""
+        entry = self._entries[name]
+        with entry.load_lock:
+            if entry.model is None:
+                self._load(entry)
+            # Unloading skips entries whose load_lock is held, so the model is still here
+            with self._lock:
+                entry.in_use += 1
+                model = entry.model
+        try:
+            yield model
+        finally:
+            with self._lock:
+                entry.in_use -= 1
+                entry.last_used = time.monotonic()
+
+    def _load(self, entry):
+        # Make room using the size seen on the previous load, so reloads do not overshoot
+        self._evict_for(entry.size, keep=entry.name)
+        start = time.perf_counter()
+        try:
+            model = entry.loader()
+        except Exception as e:
+            entry.error = f"{type(e).__name__}: {e}"
+            raise
+        entry.size = resident_bytes(model)
+        entry.loads += 1
+        with self._lock:
+            entry.model = model
+            entry.error = None
+        MODEL_LOADS.inc(entry.name)
+        MODEL_RESIDENT_BYTES.set(entry.size, entry.name)
+        print(f"✅ Loaded model '{entry.name}' ({entry.size / 2**20:.1f} MiB) in {time.perf_counter() - start:.1f}s")
+        self._evict_for(0, keep=entry.name)
+        self._start_reaper()
+
+    def _resident_total(self):
+        return sum(e.size for e in self._entries.values() if e.model is not None)
+
+    def _evict_for(self, incoming, keep):
+        """Unloads LRU models not in use until `incoming` more bytes fit in the budget."""
+        if not self.budget:
+            return
+        busy = set()
+        while True:
+            with self._lock:
+                if self._resident_total() + incoming <= self.budget:
+                    return
+                candidates = [e for e in self._entries.values()
+                              if e.model is not None and e.in_use == 0
+                              and e.name != keep and e.name not in busy]
+                if not candidates:
+                    print(f"⚠️ Model budget of {self.budget / 2**20:.0f} MiB exceeded; every other model is in use")
+                    return
+                victim = min(candidates, key=lambda e: e.last_used)
+            if not self._unload(victim, "budget"):
+                busy.add(victim.name)
+
+    def _unload(self, entry, reason):
+        """Unloads entry unless it is being loaded, pinned or (for "idle") used since; True if unloaded."""
+        # Never blocks: waiting while the caller holds another entry's load_lock could deadlock
+        if not entry.load_lock.acquire(blocking=False):
+            return False
+        try:
+            with self._lock:
+                if entry.model is None or entry.in_use:
+                    return False
+                if reason == "idle" and time.monotonic() - entry.last_used <= entry.idle_seconds:
+                    return False
+                entry.model = None
+        finally:
+            entry.load_lock.release()
+        MODEL_EVICTIONS.inc(entry.name, reason)
+        MODEL_RESIDENT_BYTES.set(0, entry.name)
+        print(f"♻️ Unloaded model '{entry.name}' ({reason})")
+        gc.collect()
+        try:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except ImportError:
+            pass
+        return True
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self._lock:
+            idle = [e for e in self._entries.values()
+                    if e.model is not None and e.in_use == 0 and e.idle_seconds
+                    and now - e.last_used > e.idle_seconds]
+        for entry in idle:
+            self._unload(entry, "idle")
+
+    def _start_reaper(self):
+        timeouts = [e.idle_seconds for e in self._entries.values() if e.idle_seconds]
+        if self._reaper is not None or not timeouts:
+            return
+        interval = max(1.0, min(60.0, min(timeouts) / 4))
+
+        def reap():
+            while True:
+                time.sleep(interval)
+                self.evict_idle()
+
+        self._reaper = threading.Thread(target=reap, name="chroma-model-reaper", daemon=True)
+        self._reaper.start()
+
+    def state(self):
+        """Per-model status for /health."""
+        now = time.monotonic()
+        with self._lock:
+            models = {
+                e.name: {
+                    "loaded": e.model is not None,
+                    "resident_mb": round(e.size / 2**20, 1) if e.model is not None else 0.0,
+                    "idle_s": round(now - e.last_used, 1) if e.last_used else None,
+                    "in_use": e.in_use,
+                    "loads": e.loads,
+                    "error": e.error,
+                }
+                for e in self._entries.values()
+            }
+            resident = self._resident_total()
+        return {
+            "budget_mb": round(self.budget / 2**20, 1) if self.budget else None,
+            "resident_mb": round(resident / 2**20, 1),
+            "idle_timeout_s": self.idle_seconds or None,
+            "models": models,
+        }
+
+# Process-wide registry shared by app.py and text_to_image.py
+models = ModelRegistry()
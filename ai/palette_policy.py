@@ -0,0 +1,235 @@
+# ai/palette_policy.py
+"""
+Amortized palette optimization with a pretrained conditional policy.
+
+optimize_palette_result searches from scratch on every request, paying for
+hundreds of reward evaluations. PalettePolicyNet is trained once, offline,
+with REINFORCE over many input palettes. It learns a per-color Lab
+adjustment conditioned on the whole palette, so improving a new palette
+takes one forward pass. That pass scores a few candidates (the mean action
+plus a handful of samples) in a single batch, with optional coordinate
+refinement steps on top. The result is never worse than the input.
+
+Train and save next to palette_aesthetic_model.pth:
+    python palette_policy.py --palettes library.ndjson --images photos/ --steps 2000
+    python palette_policy.py --synthetic 5000                # no data needed
+"""
+import os
+import time
+import random
+import argparse
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from advanced_ai_palette import (LAB_SCALE, PaletteResult, lab_to_hex, palette_hexes_to_lab_array,
+                                 pad_palettes, load_aesthetic_model, optimize_palette_result)
+from bulk_scoring import score_palettes
+from metrics import STAGE_SECONDS, OPTIMIZE_EVALUATIONS
+from weights import load_state_dict, build_module, checkpoint_exists, convert_to_safetensors
+
+POLICY_SAVE_PATH = "palette_policy.pth"
+# Largest per-color move the policy's mean can make, in Lab units
+MAX_STEP = torch.tensor([25.0, 40.0, 40.0])
+LAB_MIN = torch.tensor([0.0, -128.0, -128.0])
+LAB_MAX = torch.tensor([100.0, 127.0, 127.0])
+
+# -------------------------- Policy --------------------------
+class PalettePolicyNet(nn.Module):
+    """
+    Permutation-equivariant Gaussian policy over per-color Lab moves.
+
+    Each color is embedded by phi and concatenated with the masked mean of
+    all embeddings (the palette context); the head maps that to the mean move
+    for the color. Like PaletteSetNet, one model handles any palette size.
+    """
+    variable_k = True
+
+    def __init__(self, hidden_dim=128):
+        super().__init__()
+        self.phi = nn.Sequential(
+            nn.Linear(3, hidden_dim), nn.ReLU(),
+            nn.Linear(hidden_dim, hidden_dim), nn.ReLU(),
+        )
+        self.head = nn.Sequential(
+            nn.Linear(2 * hidden_dim, hidden_dim), nn.ReLU(),
+            nn.Linear(hidden_dim, 3),
+        )
+        # Exploration noise as a fraction of MAX_STEP, shared by all colors
+        self.log_std = nn.Parameter(torch.full((3,), -1.5))
+
+    def forward(self, palette_lab, mask=None):
+        # palette_lab: (B, K, 3); mask: (B, K) bool. Returns mean and std of the move, in Lab units
+        if mask is None:
+            mask = torch.ones(palette_lab.shape[:2], dtype=torch.bool, device=palette_lab.device)
+        h = self.phi(palette_lab / LAB_SCALE.to(palette_lab.device))
+        m = mask.unsqueeze(-1)
+        context = (h * m).sum(dim=1, keepdim=True) / m.sum(dim=1, keepdim=True).clamp(min=1)
+        x = torch.cat([h, context.expand_as(h)], dim=2)
+        step = MAX_STEP.to(palette_lab.device)
+        mu = torch.tanh(self.head(x)) * step
+        std = torch.exp(self.log_std) * step
+        return mu, std
+
+def load_policy_model(path):
+    state_dict, source = load_state_dict(path)
+    hidden_dim = state_dict['phi.0.weight'].shape[0]
+    policy = build_module(lambda: PalettePolicyNet(hidden_dim=hidden_dim), state_dict)
+    policy.weights_source = source
+    return policy
+
+def _to_hex(lab):
+    """Clips a (K, 3) Lab tensor into gamut and quantizes it through hex."""
+    lab = torch.max(torch.min(lab, LAB_MAX), LAB_MIN)
+    return [lab_to_hex(*c) for c in lab.tolist()]
+
+# -------------------------- Offline Training --------------------------
+def synthetic_palettes(n, k_range=(3, 8), seed=42):
+    """Random palettes spread over the Lab gamut, for training without a library."""
+    rng = np.random.default_rng(seed)
+    palettes = []
+    for _ in range(n):
+        k = int(rng.integers(k_range[0], k_range[1] + 1))
+        lab = np.column_stack([rng.uniform(5, 95, k), rng.uniform(-80, 80, k), rng.uniform(-80, 80, k)])
+        palettes.append([lab_to_hex(*c) for c in lab])
+    return palettes
+
+def train_policy(palettes, model_L=None, weights=None, steps=1000, batch_size=32, samples=4,
+                 lr=1e-3, seed=42, log_every=50):
+    """
+    Trains a PalettePolicyNet with REINFORCE over a library of hex palettes.
+
+    Each step draws batch_size palettes, samples `samples` moves per palette
+    and scores every resulting palette in one bulk_scoring batch. The
+    advantage of a sample is its reward minus the mean reward of its
+    palette's samples, so the policy learns relative improvements whatever
+    the palette's absolute score.
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    labs = [palette_hexes_to_lab_array(p) for p in palettes if p]
+    if not labs:
+        raise ValueError("No training palettes")
+
+    policy = PalettePolicyNet()
+    optimizer = torch.optim.Adam(policy.parameters(), lr=lr)
+    start = time.perf_counter()
+    for step in range(1, steps + 1):
+        batch = random.sample(labs, min(batch_size, len(labs)))
+        pal, mask = pad_palettes(batch)
+        mu, std = policy(pal, mask)
+        dist = torch.distributions.Normal(mu.unsqueeze(1).expand(-1, samples, -1, -1), std)
+        actions = dist.sample()                                          # (B, S, K, 3)
+        logp = (dist.log_prob(actions).sum(dim=3) * mask.unsqueeze(1)).sum(dim=2)
+
+        candidates = [_to_hex(pal[i, :len(lab)] + actions[i, s, :len(lab)])
+                      for i, lab in enumerate(batch) for s in range(samples)]
+        rewards = torch.tensor([r.get("score", 0.0) for r in
+                                score_palettes(candidates, weights=weights, model_L=model_L,
+                                               chunk_size=len(candidates))]).view(len(batch), samples)
+        advantage = rewards - rewards.mean(dim=1, keepdim=True)
+        loss = -(advantage * logp).mean()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+        if log_every and step % log_every == 0:
+            print(f"Step {step}/{steps}, mean_reward={rewards.mean():.4f}, "
+                  f"std={torch.exp(policy.log_std).mean():.3f}, {time.perf_counter() - start:.0f}s")
+    policy.eval()
+    return policy
+
+# -------------------------- Amortized Optimization --------------------------
+def optimize_palette_amortized(init_hex, policy, model_L=None, samples=8, refine_steps=0,
+                               seed=42, contrast=None, weights=None):
+    """
+    Improves a palette with one policy forward pass instead of a search.
+
+    Candidates are the input, the policy's mean move and samples - 1 sampled
+    moves; all are scored in a single batch and the best is kept, so the
+    result never scores below the input. refine_steps > 0 follows up with
+    that many coordinate-move steps from the winner. With a contrast
+    constraint every candidate is repaired first and infeasible ones dropped.
+    Returns a PaletteResult.
+    """
+    init_hex = list(init_hex.hex if isinstance(init_hex, PaletteResult) else init_hex)
+    generator = torch.Generator().manual_seed(seed)
+    lab = torch.from_numpy(palette_hexes_to_lab_array(init_hex)).unsqueeze(0)
+    with torch.no_grad(), STAGE_SECONDS.time("policy_forward"):
+        mu, std = policy(lab)
+        noise = torch.randn((max(samples - 1, 0),) + mu.shape[1:], generator=generator) * std
+        moves = torch.cat([mu, mu + noise])
+    candidates = [init_hex] + [_to_hex(lab[0] + move) for move in moves]
+
+    feasible = [True] * len(candidates)
+    if contrast is not None:
+        repaired = [contrast.repair(c) for c in candidates]
+        candidates = [c for c, _ in repaired]
+        feasible = [ok for _, ok in repaired]
+    with STAGE_SECONDS.time("optimize_evaluation"):
+        scored = list(score_palettes(candidates, weights=weights, model_L=model_L,
+                                     chunk_size=len(candidates)))
+    OPTIMIZE_EVALUATIONS.inc(amount=len(candidates))
+    # A feasible candidate always beats an infeasible one
+    best = max(range(len(candidates)), key=lambda i: (feasible[i], scored[i].get("score", float("-inf"))))
+    best = PaletteResult.from_hex(candidates[best], weights=weights, model_L=model_L)
+
+    if refine_steps:
+        best = optimize_palette_result(best, steps=refine_steps, seed=seed, model_L=model_L,
+                                       moves="coordinate", contrast=contrast)
+    return best
+
+# -------------------------- Training CLI --------------------------
+def _library_palettes(args):
+    palettes = []
+    if args.palettes:
+        from bulk_scoring import iter_ndjson_palettes
+        with open(args.palettes, "rb") as f:
+            palettes += [p for _, p in iter_ndjson_palettes(f) if p]
+    if args.images:
+        from image_to_palette import extract_palette
+        for name in sorted(os.listdir(args.images)):
+            try:
+                hex_palette, _, _ = extract_palette(os.path.join(args.images, name),
+                                                    num_colors=args.k, hex_only=True)
+            except Exception as e:
+                print(f"⚠️ Skipping {name}: {e}")
+                continue
+            if hex_palette:
+                palettes.append(list(hex_palette))
+    if args.synthetic or not palettes:
+        palettes += synthetic_palettes(args.synthetic or 2000, seed=args.seed)
+    return palettes
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train the amortized palette policy")
+    parser.add_argument("--palettes", help="NDJSON palette library (bulk scoring format)")
+    parser.add_argument("--images", help="Directory of images to extract training palettes from")
+    parser.add_argument("--synthetic", type=int, default=0,
+                        help="Add N random palettes (used alone when no library is given)")
+    parser.add_argument("--model", default="palette_aesthetic_model.pth",
+                        help="Aesthetic model for the learned reward term")
+    parser.add_argument("--out", help=f"Output path (default: {POLICY_SAVE_PATH} next to --model)")
+    parser.add_argument("--k", type=int, default=8, help="Colors per extracted palette")
+    parser.add_argument("--steps", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--samples", type=int, default=4, help="Sampled moves per palette per step")
+    parser.add_argument("--lr", type=float, default=1e-3)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args(argv)
+
+    model_L = load_aesthetic_model(args.model) if checkpoint_exists(args.model) else None
+    if model_L is None:
+        print(f"⚠️ {args.model} not found; the learned term is scored as 0.5")
+    palettes = _library_palettes(args)
+    print(f"Training on {len(palettes)} palettes")
+    policy = train_policy(palettes, model_L=model_L, steps=args.steps, batch_size=args.batch_size,
+                          samples=args.samples, lr=args.lr, seed=args.seed)
+    out = args.out or os.path.join(os.path.dirname(args.model), POLICY_SAVE_PATH)
+    torch.save(policy.state_dict(), out)
+    print(f"✅ Policy saved to {out} and {convert_to_safetensors(out)}")
+
+if __name__ == "__main__":
+    main()
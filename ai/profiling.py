@@ -0,0 +1,157 @@
+# ai/profiling.py
+"""
+Opt-in, per-request profiling.
+
+A request is profiled only when CHROMA_PROFILE_TOKEN is configured and the
+caller presents it in the `X-Chroma-Profile` header. It is never read from the
+query string, where it would end up in access, proxy and CDN logs. Unprofiled
+requests never construct a RequestProfile, so the feature costs nothing when
+the flag is off.
+
+A profiled request is sampled by a background thread walking the worker
+thread's stack (stdlib only, no tracing hooks) and, when torch is importable,
+by the torch CPU profiler. The response carries a compact top-N summary and
+the path of a folded-stacks file that flamegraph.pl, speedscope or inferno can
+render directly.
+"""
+import os
+import sys
+import time
+import uuid
+import hmac
+import threading
+from collections import Counter
+
+PROFILE_TOKEN = os.getenv("CHROMA_PROFILE_TOKEN")
+PROFILE_DIR = os.getenv("CHROMA_PROFILE_DIR", "profiles")
+PROFILE_HEADER = "X-Chroma-Profile"
+SAMPLE_INTERVAL = float(os.getenv("CHROMA_PROFILE_INTERVAL", 0.005))
+TOP_N = 15
+
+def profiling_requested(header_value=None):
+    """True only when profiling is enabled and the caller presented the admin token in the header."""
+    if not PROFILE_TOKEN or not header_value:
+        return False
+    return hmac.compare_digest(header_value.encode(), PROFILE_TOKEN.encode())
+
+def _frame_label(code):
+    return f"{os.path.basename(code.co_filename)}:{code.co_firstlineno}:{code.co_name}"
+
+class _StackSampler(threading.Thread):
+    """Periodically records the stack of one target thread as a root-first tuple."""
+
+    def __init__(self, target_ident, interval, stacks):
+        super().__init__(name="chroma-profiler", daemon=True)
+        self.target_ident = target_ident
+        self.interval = interval
+        self.stacks = stacks
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.target_ident)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+class RequestProfile:
+    """
+    Accumulates samples across one or more sequential calls made for a request
+    (e.g. the diffusion step and the extraction step of /api/generate-palette).
+    """
+
+    def __init__(self, route, interval=SAMPLE_INTERVAL):
+        self.id = uuid.uuid4().hex[:12]
+        self.route = route
+        self.interval = interval
+        self.stacks = Counter()
+        self.torch_ops = {}
+        self.duration = 0.0
+
+    def run(self, fn, *args, **kwargs):
+        """Calls fn in the current thread while sampling it; returns fn's result."""
+        sampler = _StackSampler(threading.get_ident(), self.interval, self.stacks)
+        torch_profiler = self._torch_profiler()
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            if torch_profiler is None:
+                return fn(*args, **kwargs)
+            with torch_profiler:
+                return fn(*args, **kwargs)
+        finally:
+            sampler.stopped.set()
+            sampler.join()
+            self.duration += time.perf_counter() - start
+            if torch_profiler is not None:
+                self._collect_torch(torch_profiler)
+
+    @staticmethod
+    def _torch_profiler():
+        try:
+            from torch.profiler import profile, ProfilerActivity
+        except ImportError:
+            return None
+        return profile(activities=[ProfilerActivity.CPU])
+
+    def _collect_torch(self, torch_profiler):
+        try:
+            events = torch_profiler.key_averages()
+        except Exception as e:
+            print(f"⚠️ Could not read torch profiler results: {e}")
+            return
+        for event in events:
+            self_us, count = self.torch_ops.get(event.key, (0.0, 0))
+            self.torch_ops[event.key] = (self_us + event.self_cpu_time_total, count + event.count)
+
+    def write_folded(self, directory=PROFILE_DIR):
+        """Writes Brendan Gregg's folded-stack format: 'frame;frame;frame count'."""
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{self.route.strip('/').replace('/', '_')}-{self.id}.folded")
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(";".join(stack) + f" {count}\n")
+        return path
+
+    def summary(self, top_n=TOP_N):
+        total = sum(self.stacks.values()) or 1
+        self_samples, inclusive_samples = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            self_samples[stack[-1]] += count
+            for label in set(stack):
+                inclusive_samples[label] += count
+
+        def top(counter):
+            return [{"function": label, "samples": n, "pct": round(100.0 * n / total, 1)}
+                    for label, n in counter.most_common(top_n)]
+
+        torch_top = sorted(self.torch_ops.items(), key=lambda kv: kv[1][0], reverse=True)[:top_n]
+        return {
+            "id": self.id,
+            "duration_s": round(self.duration, 4),
+            "samples": sum(self.stacks.values()),
+            "interval_ms": self.interval * 1000.0,
+            "top_self": top(self_samples),
+            "top_cumulative": top(inclusive_samples),
+            "torch_top": [{"op": op, "self_cpu_ms": round(us / 1000.0, 3), "count": count}
+                          for op, (us, count) in torch_top],
+        }
+
+    def report(self):
+        """Summary plus the path of the stored flame-graph file."""
+        result = self.summary()
+        try:
+            result["flamegraph"] = self.write_folded()
+        except OSError as e:
+            print(f"⚠️ Could not store profile {self.id}: {e}")
+            result["flamegraph"] = None
+        return result
+
+def run_maybe_profiled(profile, fn, *args):
+    """Calls fn directly when profile is None, otherwise under the profiler."""
+    if profile is None:
+        return fn(*args)
+    return profile.run(fn, *args)
@@ -0,0 +1,78 @@
+# ai/reward_components.py
+"""
+Weight-aware evaluation of composite palette rewards.
+
+A reward is a weighted sum of components (harmony, contrast, the learned
+aesthetic term, ...). Each component declares the inputs it needs by name,
+e.g. ("lab", "roles"). An input is either passed by the caller (the palette's
+Lab array, the aesthetic model) or is an intermediate derived from other
+inputs (roles from Lab, WCAG luminance from Lab). Functions receive their
+inputs positionally, in the declared order, so existing scoring functions
+register as they are. evaluate() computes only the components with a
+non-zero weight and each intermediate at most once, shared by every
+component that asks for it. A screening pass that weights only the cheap
+terms never pays for the model forward or the roles.
+
+    rewards = RewardRegistry()
+    rewards.intermediate("roles", requires=("lab",))(assign_roles_lab)
+
+    @rewards.component("D", requires=("lab_dist",))
+    def distinctness(lab_dist): ...
+
+    reward, components = rewards.evaluate({"D": 0.5, "L": 0.5}, lab=lab, model_L=model)
+
+Callers add their own terms with component(), and pass whatever extra inputs
+those terms need as keyword arguments to evaluate().
+"""
+
+
+class RewardRegistry:
+    def __init__(self):
+        self.intermediates = {}   # name -> (fn, requires)
+        self.components = {}      # key -> (fn, requires)
+
+    def intermediate(self, name, requires=()):
+        """Decorator registering fn(*requires) as the derived input `name`."""
+        def decorator(fn):
+            self.intermediates[name] = (fn, tuple(requires))
+            return fn
+        return decorator
+
+    def component(self, key, requires=()):
+        """Decorator registering fn(*requires) -> float as reward component `key`; replaces any existing one."""
+        def decorator(fn):
+            self.components[key] = (fn, tuple(requires))
+            return fn
+        return decorator
+
+    def evaluate(self, weights, **inputs):
+        """
+        Returns (reward, components) for the components with a non-zero weight.
+
+        inputs are the caller's values (e.g. lab=..., roles=..., model_L=...).
+        An input passed as None is derived instead when an intermediate of that
+        name exists. Zero-weight components are skipped and left out of
+        `components`. Raises ValueError for a weight on an unknown component.
+        """
+        values = {k: v for k, v in inputs.items() if v is not None or k not in self.intermediates}
+
+        def resolve(name, chain=()):
+            if name not in values:
+                if name not in self.intermediates:
+                    raise ValueError(f"Reward input '{name}' was not provided")
+                if name in chain:
+                    raise ValueError(f"Reward inputs depend on each other: {' -> '.join(chain + (name,))}")
+                fn, requires = self.intermediates[name]
+                values[name] = fn(*[resolve(r, chain + (name,)) for r in requires])
+            return values[name]
+
+        components = {}
+        for key, weight in weights.items():
+            if not weight:
+                continue
+            if key not in self.components:
+                raise ValueError(f"Unknown reward component '{key}'. Choose from {sorted(self.components)}")
+            fn, requires = self.components[key]
+            components[key] = float(fn(*[resolve(r) for r in requires]))
+        reward = sum(weights[k] * v for k, v in components.items())
+        return float(reward), components
@@ -0,0 +1,28 @@
+# ai/test_bulk_extract.py
+import os
+
+import numpy as np
+from PIL import Image
+
+from bulk_extract import run, read_results
+
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "palette_aesthetic_model.pth")
+
+def test_optimize_with_palette_size_other_than_checkpoint_k(tmp_path):
+    assets = tmp_path / "assets"
+    assets.mkdir()
+    rng = np.random.default_rng(0)
+    for name in ("a.png", "b.png"):
+        Image.fromarray(rng.integers(0, 256, (32, 32, 3), dtype=np.uint8)).save(assets / name)
+
+    out = tmp_path / "out"
+    stats = run(str(assets), str(out), workers=1, num_colors=5, optimize=True, steps=2,
+                model_path=MODEL_PATH)
+
+    assert stats["failed"] == 0
+    rows = read_results(str(out)).to_pylist()
+    assert sorted(os.path.basename(row["path"]) for row in rows) == ["a.png", "b.png"]
+    for row in rows:
+        assert row["status"] == "ok", row["error"]
+        assert len(row["palette"]) == 5
+        assert row["score"] is not None
@@ -1,31 +1,184 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
 import torch
-from diffusers import StableDiffusionPipeline
 from PIL import Image
+from metrics import STAGE_SECONDS, CACHE_HITS, CACHE_MISSES
+from diffusion_profiles import default_device, resolve_profile, build_pipeline
+from model_registry import models
+from thread_governor import governor
+
+# CHROMA_DIFFUSION_BACKEND selects the image generator: "diffusers" (Stable
+# Diffusion) or "stub", a deterministic procedural stand-in that sleeps
+# CHROMA_STUB_DIFFUSION_SECONDS per image, for load tests without the model.
+DIFFUSION_BACKEND = os.getenv("CHROMA_DIFFUSION_BACKEND", "diffusers")
+STUB_SECONDS_PER_IMAGE = float(os.getenv("CHROMA_STUB_DIFFUSION_SECONDS", 0.5))
+STUB_IMAGE_SIZE = 512
 
-# Load the Stable Diffusion pipeline once (so you can reuse it)
-device = "cuda" if torch.cuda.is_available() else "mps" if torch.backends.mps.is_available() else "cpu"
+# The Stable Diffusion pipeline is loaded on first use and may be unloaded by
+# the model registry when idle or over the memory budget.
+device = default_device()
 print(f"Using device: {device}")
 
-model_id = "runwayml/stable-diffusion-v1-5"
-pipe = StableDiffusionPipeline.from_pretrained(model_id, torch_dtype=torch.float16)
-pipe = pipe.to(device)
+diffusion_profile = resolve_profile(device)
+if DIFFUSION_BACKEND == "diffusers":
+    models.register("diffusion", lambda: build_pipeline(device, diffusion_profile))
+
+PROMPT_CACHE_SIZE = int(os.getenv("CHROMA_PROMPT_CACHE_SIZE", 256))
+LATENT_CACHE_SIZE = int(os.getenv("CHROMA_LATENT_CACHE_SIZE", 64))
+
+class LRUCache:
+    """Small thread-safe LRU map that reports hits/misses to /metrics under `name`."""
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_create(self, key, factory):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                CACHE_HITS.inc(self.name)
+                return self._data[key]
+        CACHE_MISSES.inc(self.name)
+        # Computed outside the lock; a concurrent miss on the same key just recomputes
+        value = factory()
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+prompt_embeds_cache = LRUCache("prompt_embeds", PROMPT_CACHE_SIZE)
+latents_cache = LRUCache("initial_latents", LATENT_CACHE_SIZE)
+
+def normalize_prompt(prompt: str) -> str:
+    # The CLIP tokenizer lowercases and splits on whitespace, so these spellings encode identically
+    return " ".join(prompt.split()).lower()
 
-def generate_image_from_prompt(prompt: str, guidance_scale: float = 7.5, num_inference_steps: int = 50) -> Image.Image:
+def encode_prompt_cached(pipe, prompt: str, negative_prompt: str = ""):
+    """
+    Returns (prompt_embeds, negative_prompt_embeds) for classifier-free guidance,
+    running the CLIP text encoder only on a cache miss.
+    """
+    key = (normalize_prompt(prompt), normalize_prompt(negative_prompt))
+
+    def encode():
+        with torch.no_grad(), STAGE_SECONDS.time("text_encode"):
+            return pipe.encode_prompt(
+                prompt,
+                device,
+                num_images_per_prompt=1,
+                do_classifier_free_guidance=True,
+                negative_prompt=negative_prompt or None,
+            )
+
+    return prompt_embeds_cache.get_or_create(key, encode)
+
+def initial_latents(pipe, seed: int, height: Optional[int] = None, width: Optional[int] = None):
+    """Deterministic starting noise for `seed`, cached so repeat requests skip sampling."""
+    height = height or pipe.unet.config.sample_size * pipe.vae_scale_factor
+    width = width or pipe.unet.config.sample_size * pipe.vae_scale_factor
+    shape = (1, pipe.unet.config.in_channels, height // pipe.vae_scale_factor, width // pipe.vae_scale_factor)
+
+    def sample():
+        # Sampled on CPU so a seed gives the same latents on every device
+        generator = torch.Generator("cpu").manual_seed(seed)
+        return torch.randn(shape, generator=generator, dtype=torch.float32).to(device, pipe.unet.dtype)
+
+    return latents_cache.get_or_create((seed, height, width), sample)
+
+def generate_images_from_prompt(prompt: str, num_images: int = 1, guidance_scale: float = 7.5,
+                                num_inference_steps: Optional[int] = None, seed: Optional[int] = None,
+                                negative_prompt: str = "") -> List[Image.Image]:
+    """
+    Generates `num_images` variants of a prompt in one batched pipeline call.
+
+    The prompt is encoded once and repeated across the batch. With a seed,
+    variant i starts from the cached latents of seed + i, so variant 0 matches
+    the single-image result for the same seed.
+    """
+    if not prompt:
+        raise ValueError("Prompt cannot be empty.")
+    backend = DIFFUSION_BACKENDS.get(DIFFUSION_BACKEND)
+    if backend is None:
+        raise ValueError(f"Unknown diffusion backend '{DIFFUSION_BACKEND}'. Choose from {sorted(DIFFUSION_BACKENDS)}")
+    return backend(prompt, num_images, guidance_scale, num_inference_steps, seed, negative_prompt)
+
+def _generate_diffusers(prompt, num_images, guidance_scale, num_inference_steps, seed, negative_prompt):
+    with models.use("diffusion") as pipe:
+        prompt_embeds, negative_prompt_embeds = encode_prompt_cached(pipe, prompt, negative_prompt)
+        latents = None
+        if seed is not None:
+            latents = torch.cat([initial_latents(pipe, seed + i) for i in range(num_images)])
+
+        # Caps this thread only; the process-wide torch thread count stays the governor's
+        with STAGE_SECONDS.time("diffusion"), governor.limit("generate", threads=diffusion_profile["threads"]):
+            images = pipe(
+                prompt_embeds=prompt_embeds,
+                negative_prompt_embeds=negative_prompt_embeds,
+                latents=latents,
+                num_images_per_prompt=num_images,
+                guidance_scale=guidance_scale,
+                num_inference_steps=num_inference_steps or diffusion_profile["steps"],
+            ).images
+
+    return images
+
+# --------------------------
+# Stub Backend
+# --------------------------
+def stub_image(prompt: str, seed: int = 0, negative_prompt: str = "", size: int = STUB_IMAGE_SIZE) -> Image.Image:
+    """
+    A procedural image that depends only on (prompt, negative_prompt, seed):
+    a few hues picked from a hash of the inputs, blended across smooth
+    gradients and noise so extraction has real clusters to find.
+    """
+    key = f"{normalize_prompt(prompt)}|{normalize_prompt(negative_prompt)}|{seed}".encode()
+    rng = np.random.default_rng(int.from_bytes(hashlib.sha256(key).digest()[:8], "little"))
+    colors = rng.integers(0, 256, size=(4, 3)).astype(np.float32)
+    yy, xx = np.mgrid[0:size, 0:size].astype(np.float32) / (size - 1)
+    phase = rng.uniform(0, 2 * np.pi, 2)
+    wx = 0.5 + 0.5 * np.sin(3 * np.pi * xx + phase[0])
+    wy = 0.5 + 0.5 * np.cos(2 * np.pi * yy + phase[1])
+    weights = np.stack([wx * wy, (1 - wx) * wy, wx * (1 - wy), (1 - wx) * (1 - wy)], axis=-1)
+    pixels = weights @ colors + rng.normal(0, 6, (size, size, 3))
+    return Image.fromarray(pixels.clip(0, 255).astype(np.uint8))
+
+def _generate_stub(prompt, num_images, guidance_scale, num_inference_steps, seed, negative_prompt):
+    with STAGE_SECONDS.time("diffusion"):
+        time.sleep(STUB_SECONDS_PER_IMAGE * num_images)
+        return [stub_image(prompt, (seed or 0) + i, negative_prompt) for i in range(num_images)]
+
+DIFFUSION_BACKENDS = {"diffusers": _generate_diffusers, "stub": _generate_stub}
+
+def generate_image_from_prompt(prompt: str, guidance_scale: float = 7.5, num_inference_steps: Optional[int] = None,
+                               seed: Optional[int] = None, negative_prompt: str = "") -> Image.Image:
     """
     Generates an image from a text prompt using Stable Diffusion.
 
     Args:
         prompt (str): The text prompt describing the image.
         guidance_scale (float): How strictly the image follows the prompt.
-        num_inference_steps (int): Number of denoising steps (more -> better quality).
+        num_inference_steps (int, optional): Number of denoising steps (more -> better quality).
+            Defaults to the active profile's step count (50 on GPU, 20 or fewer on CPU).
+        seed (int, optional): Reuse the cached initial latents for this seed, making the
+            result deterministic (e.g. to regenerate with a different guidance_scale).
+        negative_prompt (str): Text to steer away from; encoded once and cached.
 
     Returns:
         PIL.Image.Image: The generated image.
     """
-    if not prompt:
-        raise ValueError("Prompt cannot be empty.")
-
-    # New, simplified code
-    image = pipe(prompt, guidance_scale=guidance_scale, num_inference_steps=num_inference_steps).images[0]
-
-    return image
+    return generate_images_from_prompt(prompt, 1, guidance_scale, num_inference_steps, seed, negative_prompt)[0]
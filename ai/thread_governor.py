@@ -0,0 +1,164 @@
+# ai/thread_governor.py
+"""
+CPU thread governor for torch, OpenMP and BLAS.
+
+By default every layer sizes itself to "all cores": torch intra-op threads,
+the OpenMP pool behind sklearn's KMeans, BLAS, and on top of that every
+concurrent request thread. Under load, N requests each fan out to N threads
+and p99 latency explodes. The governor keeps concurrency x threads <= cores:
+
+* At startup it sets torch's intra-op and inter-op thread counts and the
+  BLAS pool size for the process. BLAS pools (OpenBLAS) are process-global,
+  so BLAS defaults to the smallest per-request limit.
+* Around each request's CPU work, limit(request_class) caps the OpenMP pool
+  (KMeans, and torch ops, which run on OpenMP) for the calling thread.
+  OpenMP thread counts are per-thread settings, so concurrent requests of
+  different classes do not disturb each other.
+
+A class's default thread count is cores // its admission concurrency
+(see admission.py). Generation, which runs one request at a time, gets every
+core; the CPU routes, which admit one request per core, get one thread each.
+
+Configuration:
+    CHROMA_TORCH_THREADS          torch intra-op threads for the process
+    CHROMA_TORCH_INTEROP_THREADS  torch inter-op threads (set once, before any work)
+    CHROMA_BLAS_THREADS           BLAS threads for the process
+    CHROMA_<CLASS>_THREADS        OpenMP threads per request, for CLASS in
+                                  {GENERATE, EXTRACT, OPTIMIZE, SCORE}
+
+`python benchmark.py -k governor` compares throughput across thread configurations.
+"""
+import os
+import functools
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from multiprocessing import get_context
+
+from admission import BUDGETS
+
+try:
+    from threadpoolctl import ThreadpoolController
+except ImportError:
+    ThreadpoolController = None
+
+CPUS = os.cpu_count() or 1
+
+def _env_int(name):
+    value = os.getenv(name)
+    return int(value) if value else None
+
+class ThreadGovernor:
+    def __init__(self, budgets=BUDGETS, cpus=CPUS):
+        self.cpus = cpus
+        self.limits = {
+            name: _env_int(f"CHROMA_{name.upper()}_THREADS") or max(1, cpus // limiter.concurrency)
+            for name, limiter in budgets.items()
+        }
+        self.torch_threads = _env_int("CHROMA_TORCH_THREADS")
+        self.torch_interop_threads = _env_int("CHROMA_TORCH_INTEROP_THREADS")
+        self.blas_threads = _env_int("CHROMA_BLAS_THREADS") or min(self.limits.values(), default=cpus)
+        self._controller = None
+        self._controller_lock = threading.Lock()
+
+    def _threadpools(self):
+        # Built lazily: inspecting the loaded libraries needs sklearn/torch imported first
+        if ThreadpoolController is None:
+            return None
+        with self._controller_lock:
+            if self._controller is None:
+                self._controller = ThreadpoolController()
+            return self._controller
+
+    def apply_process_limits(self):
+        """Sets torch's and BLAS's process-wide thread counts; call once at startup."""
+        import torch
+        controller = self._threadpools()
+        if controller is not None:
+            # Not used as a context manager, so the limit stays in effect
+            controller.limit(limits=self.blas_threads, user_api="blas")
+        if self.torch_threads:
+            torch.set_num_threads(self.torch_threads)
+        if self.torch_interop_threads:
+            try:
+                torch.set_num_interop_threads(self.torch_interop_threads)
+            except RuntimeError as e:
+                # Only allowed before the first inter-op parallel work
+                print(f"⚠️ Could not set torch inter-op threads: {e}")
+
+    def threads_for(self, request_class):
+        return self.limits.get(request_class, self.cpus)
+
+    def limit(self, request_class, threads=None):
+        """Caps OpenMP threads for the calling thread while the block runs (threads overrides the class)."""
+        controller = self._threadpools()
+        if controller is None:
+            return nullcontext()
+        return controller.limit(limits=threads or self.threads_for(request_class), user_api="openmp")
+
+    def limited(self, request_class):
+        """Decorator running the function under limit(request_class)."""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.limit(request_class):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def state(self):
+        """Thread configuration for /health."""
+        import torch
+        controller = self._threadpools()
+        return {
+            "cpus": self.cpus,
+            "torch_threads": torch.get_num_threads(),
+            "torch_interop_threads": torch.get_num_interop_threads(),
+            "blas_threads": self.blas_threads,
+            "request_threads": dict(self.limits),
+            "threadpools": [
+                {"user_api": lib.user_api, "internal_api": lib.internal_api, "num_threads": lib.num_threads}
+                for lib in controller.lib_controllers
+            ] if controller is not None else None,
+        }
+
+def init_worker_process(threads):
+    """
+    ProcessPoolExecutor initializer: caps a worker's torch, OpenMP, BLAS and
+    per-request threads at `threads`, so a pool of N workers never
+    oversubscribes the cores.
+    """
+    # Runtimes loaded later in the worker (sklearn's KMeans, say) read these at startup
+    for name in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[name] = str(threads)
+    governor.torch_threads = threads
+    governor.blas_threads = min(governor.blas_threads, threads)
+    governor.limits = {name: min(limit, threads) for name, limit in governor.limits.items()}
+    governor.apply_process_limits()
+    controller = governor._threadpools()
+    if controller is not None:
+        # Tasks run on the thread that ran the initializer, so this per-thread limit covers them
+        controller.limit(limits=threads, user_api="openmp")
+
+def _init_pool_worker(threads, initializer, initargs):
+    init_worker_process(threads)
+    if initializer is not None:
+        initializer(*initargs)
+
+def process_pool(workers, initializer=None, initargs=()):
+    """
+    A ProcessPoolExecutor of `workers` spawned processes, each capped at its
+    share of the cores by init_worker_process before initializer(*initargs) runs.
+    """
+    # spawn, not fork: forking after torch/OpenMP threads have started can deadlock
+    return ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"),
+                               initializer=_init_pool_worker,
+                               initargs=(max(1, governor.cpus // workers), initializer, initargs))
+
+def governed(request_class, iterable):
+    """Iterates under governor.limit(request_class), for lazily streamed responses."""
+    with governor.limit(request_class):
+        yield from iterable
+
+# Process-wide governor shared by app.py and the benchmarks
+governor = ThreadGovernor()
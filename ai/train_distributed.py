@@ -0,0 +1,273 @@
+# ai/train_distributed.py
+"""
+Data-parallel CPU training of the palette aesthetic model across local processes.
+
+train_model_aadb runs in one process, and almost all of its time goes to
+extracting a palette from every image, again in every epoch. Here N
+processes form a gloo process group:
+
+* Palette extraction runs once. Rank r extracts rows r, r+N, ... and the
+  shards are all-gathered, so every rank ends up holding the whole
+  (palette, score) dataset in memory and extraction scales with N.
+* Training wraps the model in DistributedDataParallel. A DistributedSampler
+  gives each rank a disjoint shard of every epoch, and gradients are
+  all-reduced (averaged) after each backward. Each rank takes
+  batch_size / N samples per step, so the global batch, and with it the
+  learning-rate behaviour, matches single-process training.
+* Each process gets cores // N torch, OpenMP and BLAS threads
+  (thread_governor.init_worker_process), so N processes never
+  oversubscribe the machine.
+* Rank 0 validates, logs and checkpoints after every epoch. Checkpoints are
+  written atomically to palette_aesthetic_model.pth, with a .safetensors copy
+  at the end.
+
+Usage:
+    python train_distributed.py --csv AADB.csv --images AADB/ --processes 8 --epochs 15
+    python train_distributed.py --benchmark 1,2,4,8 --synthetic 50000 --epochs 3
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+
+from advanced_ai_palette import (PaletteAestheticNet, PaletteSetNet, AADBBasedPaletteDataset,
+                                 load_aadb_metadata, load_aesthetic_model, pad_collate)
+from weights import convert_to_safetensors
+from thread_governor import init_worker_process
+
+MODEL_SAVE_PATH = "palette_aesthetic_model.pth"
+CPUS = os.cpu_count() or 1
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def build_model(arch, K):
+    # Seeded, so every rank starts from the same weights (DDP also broadcasts rank 0's)
+    torch.manual_seed(42)
+    return PaletteSetNet(hidden_dim=128) if arch == "set" else PaletteAestheticNet(K=K, hidden_dim=128)
+
+# -------------------------- Data --------------------------
+def split_metadata(df, val_frac=0.1, seed=42):
+    """Disjoint (train, val) frames; the same split on every rank and every run."""
+    n_val = int(len(df) * val_frac)
+    df_train = df.sample(n=len(df) - n_val, random_state=seed)
+    df_val = df.drop(df_train.index)
+    return df_train.reset_index(drop=True), df_val.reset_index(drop=True)
+
+def extract_sharded(dataset, rank, world_size):
+    """Extracts rows rank, rank + world_size, ... and all-gathers them back into dataset order."""
+    shard = [dataset[i] for i in range(rank, len(dataset), world_size)]
+    shards = [None] * world_size
+    dist.all_gather_object(shards, shard)
+    items = [None] * len(dataset)
+    for r, part in enumerate(shards):
+        items[r::world_size] = part
+    return items
+
+def synthetic_dataset(n, K=8, seed=42):
+    """
+    Random palettes labelled with their heuristic composite reward (the
+    learned term fixed at 0.5): a learnable target for benchmarking without AADB.
+    """
+    from palette_policy import synthetic_palettes
+    from bulk_scoring import score_palettes, hex_palette_to_rgb, rgb_to_lab_array
+    palettes = synthetic_palettes(n, k_range=(K, K), seed=seed)
+    scores = [r["score"] for r in score_palettes(palettes)]
+    return [(rgb_to_lab_array(hex_palette_to_rgb(p)), np.float32(s)) for p, s in zip(palettes, scores)]
+
+# -------------------------- Worker --------------------------
+def _mean_loss(total, count):
+    # Global mean over every rank's samples
+    stats = torch.tensor([total, count], dtype=torch.float64)
+    dist.all_reduce(stats)
+    return (stats[0] / stats[1].clamp(min=1)).item()
+
+def _train_worker(rank, world_size, port, data, options):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    threads = options["threads"]
+    init_worker_process(threads)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+        arch, K = options["arch"], options["K"]
+        start = time.perf_counter()
+        if "metadata" in data:
+            pad = arch != "set"
+            train_ds, val_ds = (AADBBasedPaletteDataset(df, K=K, pad=pad) for df in data["metadata"])
+            train_items = extract_sharded(train_ds, rank, world_size)
+            val_items = extract_sharded(val_ds, rank, world_size)
+        else:
+            train_items, val_items = data["items"]
+        extract_seconds = time.perf_counter() - start
+
+        model = build_model(arch, K)
+        ddp = DistributedDataParallel(model)
+        optimizer = torch.optim.Adam(ddp.parameters(), lr=options["lr"])
+        loss_fn = nn.MSELoss()
+        sampler = DistributedSampler(train_items, num_replicas=world_size, rank=rank, shuffle=True, seed=42)
+        loader = DataLoader(train_items, batch_size=max(1, options["batch_size"] // world_size),
+                            sampler=sampler, collate_fn=pad_collate)
+        val_loader = DataLoader(val_items, batch_size=options["batch_size"], collate_fn=pad_collate)
+
+        history = []
+        train_start = time.perf_counter()
+        for epoch in range(options["epochs"]):
+            # Reshuffles the shards every epoch
+            sampler.set_epoch(epoch)
+            epoch_start = time.perf_counter()
+            ddp.train()
+            total, count = 0.0, 0
+            for palettes, mask, scores in loader:
+                preds = ddp(palettes, mask) if arch == "set" else ddp(palettes)
+                loss = loss_fn(preds, scores)
+                optimizer.zero_grad()
+                loss.backward()          # gradients are all-reduced here
+                optimizer.step()
+                total += loss.item() * len(scores)
+                count += len(scores)
+            train_loss = _mean_loss(total, count)
+            epoch_seconds = time.perf_counter() - epoch_start
+
+            if rank == 0:
+                model.eval()
+                val_total, val_count = 0.0, 0
+                with torch.no_grad():
+                    for palettes, mask, scores in val_loader:
+                        preds = model(palettes, mask) if arch == "set" else model(palettes)
+                        val_total += loss_fn(preds, scores).item() * len(scores)
+                        val_count += len(scores)
+                val_loss = val_total / val_count if val_count else float("nan")
+                history.append({"epoch": epoch + 1, "train_loss": train_loss, "val_loss": val_loss,
+                                "seconds": epoch_seconds})
+                print(f"Epoch {epoch + 1}/{options['epochs']}, train_loss={train_loss:.4f}, "
+                      f"val_loss={val_loss:.4f}, {epoch_seconds:.1f}s "
+                      f"({len(train_items) / epoch_seconds:.0f} samples/s)")
+                if options["out"]:
+                    torch.save(model.state_dict(), options["out"] + ".tmp")
+                    os.replace(options["out"] + ".tmp", options["out"])
+        train_seconds = time.perf_counter() - train_start
+
+        if rank == 0:
+            if options["out"]:
+                convert_to_safetensors(options["out"])
+            with open(options["report"], "w") as f:
+                json.dump({"processes": world_size, "threads_per_process": threads,
+                           "train_samples": len(train_items), "extract_seconds": extract_seconds,
+                           "train_seconds": train_seconds,
+                           "samples_per_sec": len(train_items) * options["epochs"] / train_seconds,
+                           "history": history}, f)
+    finally:
+        dist.destroy_process_group()
+
+def run_distributed(data, processes, arch="fixed", K=8, batch_size=32, epochs=15, lr=1e-3,
+                    out=MODEL_SAVE_PATH, threads=None):
+    """Spawns `processes` ranks over `data` and returns rank 0's report (timings and loss history)."""
+    options = {"arch": arch, "K": K, "batch_size": batch_size, "epochs": epochs, "lr": lr, "out": out,
+               "threads": threads or max(1, CPUS // processes)}
+    with tempfile.TemporaryDirectory() as tmp:
+        options["report"] = os.path.join(tmp, "report.json")
+        mp.spawn(_train_worker, args=(processes, _free_port(), data, options), nprocs=processes, join=True)
+        with open(options["report"]) as f:
+            return json.load(f)
+
+def train_model_distributed(aadb_csv, aadb_images_dir, K=8, batch_size=32, epochs=15, lr=1e-3,
+                            val_frac=0.1, arch="fixed", processes=CPUS, out=MODEL_SAVE_PATH):
+    """
+    Distributed counterpart of train_model_aadb: trains on `processes` local
+    ranks, checkpoints to `out` from rank 0 and returns the trained model.
+    """
+    df = load_aadb_metadata(aadb_csv, aadb_images_dir)
+    if len(df) == 0:
+        raise ValueError("No images found. Check CSV and image folder paths.")
+    report = run_distributed({"metadata": split_metadata(df, val_frac)}, processes, arch=arch, K=K,
+                             batch_size=batch_size, epochs=epochs, lr=lr, out=out)
+    print(f"✅ Trained on {processes} processes: extraction {report['extract_seconds']:.0f}s, "
+          f"training {report['train_seconds']:.0f}s; saved to {out}")
+    return load_aesthetic_model(out, K=K)
+
+# -------------------------- Scaling benchmark --------------------------
+def scaling_benchmark(process_counts, data, epochs=3, batch_size=256, arch="fixed", K=8):
+    """Trains once per process count (without checkpointing) and prints throughput and speedup."""
+    results = []
+    for n in process_counts:
+        if n > CPUS:
+            print(f"⚠️ {n} processes on {CPUS} cores: ranks will share cores")
+        print(f"🚀 {n} process(es)")
+        results.append(run_distributed(data, n, arch=arch, K=K, batch_size=batch_size, epochs=epochs, out=None))
+    base = results[0]["samples_per_sec"]
+    print(f"\n{'processes':>9} {'threads':>7} {'samples/s':>10} {'speedup':>8} {'efficiency':>10} "
+          f"{'train s':>8} {'val loss':>9}")
+    for r in results:
+        speedup = r["samples_per_sec"] / base
+        r["speedup"] = speedup
+        print(f"{r['processes']:>9d} {r['threads_per_process']:>7d} {r['samples_per_sec']:>10.0f} "
+              f"{speedup:>7.2f}x {speedup * results[0]['processes'] / r['processes']:>9.0%} "
+              f"{r['train_seconds']:>8.1f} {r['history'][-1]['val_loss']:>9.5f}")
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Data-parallel CPU training of the palette aesthetic model")
+    parser.add_argument("--csv", help="AADB metadata CSV (ImageFile, score)")
+    parser.add_argument("--images", help="AADB image directory")
+    parser.add_argument("--synthetic", type=int, default=0,
+                        help="Train on N synthetic palettes instead of AADB (for benchmarking)")
+    parser.add_argument("--processes", type=int, default=CPUS, help="Local ranks (default: CPU count)")
+    parser.add_argument("--arch", default="fixed", choices=("fixed", "set"))
+    parser.add_argument("--k", type=int, default=8)
+    parser.add_argument("--epochs", type=int, default=15)
+    parser.add_argument("--batch-size", type=int, default=32, help="Global batch size, split across ranks")
+    parser.add_argument("--lr", type=float, default=1e-3)
+    parser.add_argument("--out", default=MODEL_SAVE_PATH)
+    parser.add_argument("--benchmark", help="Comma-separated process counts to compare, e.g. 1,2,4,8")
+    parser.add_argument("--save", help="With --benchmark, write results JSON to this path")
+    args = parser.parse_args(argv)
+
+    if args.benchmark:
+        if args.csv:
+            df = load_aadb_metadata(args.csv, args.images)
+            pad = args.arch != "set"
+            # Extract once up front, so the comparison times training alone
+            data = {"items": tuple([ds[i] for i in range(len(ds))] for ds in
+                                   (AADBBasedPaletteDataset(d, K=args.k, pad=pad) for d in split_metadata(df)))}
+        else:
+            items = synthetic_dataset(args.synthetic or 20000, K=args.k)
+            n_val = len(items) // 10
+            data = {"items": (items[n_val:], items[:n_val])}
+        counts = [int(n) for n in args.benchmark.split(",")]
+        results = scaling_benchmark(counts, data, epochs=args.epochs, batch_size=args.batch_size,
+                                    arch=args.arch, K=args.k)
+        if args.save:
+            with open(args.save, "w") as f:
+                json.dump({"cpu_count": CPUS, "torch": torch.__version__, "results": results}, f, indent=2)
+            print(f"✅ Results saved to {args.save}")
+        return 0
+
+    if args.synthetic:
+        items = synthetic_dataset(args.synthetic, K=args.k)
+        n_val = len(items) // 10
+        run_distributed({"items": (items[n_val:], items[:n_val])}, args.processes, arch=args.arch, K=args.k,
+                        batch_size=args.batch_size, epochs=args.epochs, lr=args.lr, out=args.out)
+        print(f"✅ Model saved to {args.out}")
+        return 0
+    if not args.csv or not args.images:
+        parser.error("--csv and --images are required (or use --synthetic)")
+    train_model_distributed(args.csv, args.images, K=args.k, batch_size=args.batch_size, epochs=args.epochs,
+                            lr=args.lr, arch=args.arch, processes=args.processes, out=args.out)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,273 @@
+# ai/video_to_palette.py
+"""
+Palette extraction for animated images (GIF/WebP/APNG) and video files.
+
+Frames are streamed one at a time, near-duplicates are skipped with a cheap
+64-bin color histogram distance, and every kept frame is clustered with
+K-Means warm-started from the previous frame's centroids (n_init=1) rather
+than a fresh KMeans(n_init=10). Frame centroids are folded into a fixed-size
+set of weighted micro-clusters for the whole clip and for the current scene
+segment, so memory stays constant regardless of clip length.
+
+Video decoding uses a local ffmpeg/ffprobe binary when available.
+"""
+import os
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import numpy as np
+from PIL import Image, ImageSequence
+from sklearn.cluster import KMeans
+from skimage.color import rgb2hsv, rgb2lab, lab2rgb
+
+from image_to_palette import rgb_to_hex
+from metrics import STAGE_SECONDS
+
+VIDEO_EXTENSIONS = {".mp4", ".mov", ".m4v", ".mkv", ".webm", ".avi"}
+FRAME_SIDE = 160            # frames are thumbnailed to this before any analysis
+
+# ------------------------
+# Frame Sources
+# ------------------------
+def _thumbnail_array(frame, max_side=FRAME_SIDE):
+    frame = frame.convert("RGB")
+    frame.thumbnail((max_side, max_side))
+    return np.asarray(frame)
+
+def iter_image_frames(image_input, max_side=FRAME_SIDE):
+    """Yields frames of an animated GIF/WebP/APNG (or a single still) as RGB arrays."""
+    with Image.open(image_input) as img:
+        for frame in ImageSequence.Iterator(img):
+            yield _thumbnail_array(frame, max_side)
+
+def _probe_video_size(path):
+    out = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "v:0",
+         "-show_entries", "stream=width,height", "-of", "json", path],
+        check=True, capture_output=True,
+    ).stdout
+    stream = json.loads(out)["streams"][0]
+    return int(stream["width"]), int(stream["height"])
+
+def iter_video_frames(path, max_side=FRAME_SIDE, fps=None):
+    """Yields RGB frames decoded by ffmpeg, scaled down, reading one frame at a time from its pipe."""
+    if not shutil.which("ffmpeg") or not shutil.which("ffprobe"):
+        raise RuntimeError("ffmpeg/ffprobe not found; install ffmpeg to extract palettes from video")
+    width, height = _probe_video_size(path)
+    scale = min(1.0, max_side / max(width, height))
+    w, h = max(2, int(width * scale) // 2 * 2), max(2, int(height * scale) // 2 * 2)
+    filters = f"scale={w}:{h}" + (f",fps={fps}" if fps else "")
+    proc = subprocess.Popen(
+        ["ffmpeg", "-v", "error", "-i", path, "-vf", filters,
+         "-f", "rawvideo", "-pix_fmt", "rgb24", "pipe:1"],
+        stdout=subprocess.PIPE,
+    )
+    frame_bytes = w * h * 3
+    try:
+        while True:
+            buf = proc.stdout.read(frame_bytes)
+            if len(buf) < frame_bytes:
+                break
+            yield np.frombuffer(buf, dtype=np.uint8).reshape(h, w, 3)
+    finally:
+        proc.stdout.close()
+        proc.kill()
+        proc.wait()
+
+def iter_frames(source, max_side=FRAME_SIDE, fps=None):
+    """
+    Picks the decoder: PIL for images it can open, ffmpeg for everything else.
+    fps resamples video to that many frames per second; animated images keep every frame.
+    """
+    if isinstance(source, str) and os.path.splitext(source)[1].lower() in VIDEO_EXTENSIONS:
+        return iter_video_frames(source, max_side, fps)
+    return iter_image_frames(source, max_side)
+
+# ------------------------
+# Streaming Aggregation
+# ------------------------
+def color_histogram(frame, bins=4):
+    """Normalized bins**3 RGB histogram; cheap enough to run on every frame."""
+    q = (frame.reshape(-1, 3) // (256 // bins)).astype(np.int64)
+    idx = (q[:, 0] * bins + q[:, 1]) * bins + q[:, 2]
+    hist = np.bincount(idx, minlength=bins ** 3).astype(np.float32)
+    return hist / max(hist.sum(), 1.0)
+
+def histogram_distance(h1, h2):
+    # Total variation distance in [0, 1]
+    return 0.5 * float(np.abs(h1 - h2).sum())
+
+class RunningPalette:
+    """
+    Weighted Lab micro-clusters with a fixed budget. New centroids merge into
+    the nearest micro-cluster when close enough; otherwise the two closest
+    micro-clusters are merged to make room. finalize() reduces to K colors.
+    """
+
+    def __init__(self, num_colors, budget_factor=4, merge_distance=8.0):
+        self.num_colors = num_colors
+        self.budget = num_colors * budget_factor
+        self.merge_distance = merge_distance
+        self.centers = np.empty((0, 3), dtype=np.float64)
+        self.weights = np.empty((0,), dtype=np.float64)
+
+    def add(self, centers, counts):
+        for center, count in zip(centers, counts):
+            if count <= 0:
+                continue
+            if len(self.centers):
+                d = np.linalg.norm(self.centers - center, axis=1)
+                j = int(np.argmin(d))
+                if d[j] < self.merge_distance:
+                    self._merge_into(j, center, count)
+                    continue
+            if len(self.centers) >= self.budget:
+                self._merge_closest_pair()
+            self.centers = np.vstack([self.centers, center])
+            self.weights = np.append(self.weights, count)
+
+    def _merge_into(self, j, center, count):
+        total = self.weights[j] + count
+        self.centers[j] = (self.centers[j] * self.weights[j] + center * count) / total
+        self.weights[j] = total
+
+    def _merge_closest_pair(self):
+        d = np.linalg.norm(self.centers[:, None, :] - self.centers[None, :, :], axis=2)
+        np.fill_diagonal(d, np.inf)
+        i, j = np.unravel_index(np.argmin(d), d.shape)
+        self._merge_into(i, self.centers[j], self.weights[j])
+        self.centers = np.delete(self.centers, j, axis=0)
+        self.weights = np.delete(self.weights, j)
+
+    def finalize(self, random_state=42):
+        """Returns hex colors sorted by prominence."""
+        if not len(self.centers):
+            return []
+        k = min(self.num_colors, len(self.centers))
+        kmeans = KMeans(n_clusters=k, random_state=random_state, n_init=4).fit(
+            self.centers, sample_weight=self.weights)
+        mass = np.bincount(kmeans.labels_, weights=self.weights, minlength=k)
+        order = np.argsort(mass)[::-1]
+        rgb = (lab2rgb(kmeans.cluster_centers_[order]) * 255.0).clip(0, 255).astype(int)
+        return [rgb_to_hex(c) for c in rgb]
+
+def _frame_pixels(frame, min_saturation=0.15, value_low=0.1, value_high=0.95):
+    # Same vibrancy filter as extract_palette
+    pixels = frame.reshape(-1, 3)
+    hsv = rgb2hsv(pixels / 255.0)
+    mask = (hsv[:, 1] > min_saturation) & (hsv[:, 2] > value_low) & (hsv[:, 2] < value_high)
+    return pixels[mask] if mask.sum() >= 8 else pixels
+
+# ------------------------
+# Main Extraction Function
+# ------------------------
+def extract_animated_palette(
+    source,
+    num_colors=8,
+    skip_threshold=0.04,
+    scene_threshold=0.35,
+    sample_size=2000,
+    max_frames=None,
+    fps=None,
+    time_limit=None,
+    random_state=42
+):
+    """
+    Extracts a global palette plus per-segment palettes from an animation or video.
+
+    Args:
+        source: Path or file-like object (animated image), or a video file path.
+        num_colors (int): Colors per palette.
+        skip_threshold (float): Frames whose histogram distance to the last
+            analysed frame is below this are treated as near-duplicates and skipped.
+        scene_threshold (float): Distance to the current segment's first frame
+            above which a new segment starts.
+        sample_size (int): Pixels sampled per frame for clustering.
+        max_frames (int): Stop after decoding this many frames.
+        fps (float): Resample video to this many frames per second before
+            analysis (frame indices then count resampled frames).
+        time_limit (float): Stop after this many seconds of decoding and clustering.
+        random_state (int): Seed for pixel sampling and clustering.
+
+    Returns:
+        A dict with 'palette', 'segments' (each with start/end frame and its
+        palette), 'frames_total', 'frames_sampled' and 'truncated' (None, or
+        "max_frames" / "time_limit" when the clip was cut short).
+    """
+    rng = np.random.default_rng(random_state)
+    clip = RunningPalette(num_colors)
+    segment = RunningPalette(num_colors)
+    segments = []
+    segment_start, segment_hist = 0, None
+    last_hist, centroids = None, None
+    frames_total = frames_sampled = 0
+    truncated = None
+    deadline = time.perf_counter() + time_limit if time_limit else None
+
+    def close_segment(end_frame):
+        palette = segment.finalize(random_state)
+        if palette:
+            segments.append({"start_frame": segment_start, "end_frame": end_frame, "palette": palette})
+
+    for index, frame in enumerate(iter_frames(source, fps=fps)):
+        if max_frames is not None and index >= max_frames:
+            truncated = "max_frames"
+            break
+        if deadline and time.perf_counter() > deadline:
+            truncated = "time_limit"
+            break
+        frames_total += 1
+        hist = color_histogram(frame)
+        if last_hist is not None and histogram_distance(hist, last_hist) < skip_threshold:
+            continue
+        last_hist = hist
+
+        if segment_hist is None:
+            segment_hist = hist
+        elif histogram_distance(hist, segment_hist) > scene_threshold:
+            close_segment(index - 1)
+            segment = RunningPalette(num_colors)
+            segment_start, segment_hist = index, hist
+
+        with STAGE_SECONDS.time("animated_frame"):
+            pixels = _frame_pixels(frame)
+            if len(pixels) > sample_size:
+                pixels = pixels[rng.choice(len(pixels), sample_size, replace=False)]
+            lab = rgb2lab((pixels / 255.0).reshape(-1, 1, 3)).reshape(-1, 3)
+            k = min(num_colors, len(np.unique(pixels, axis=0)))
+            if k == 0:
+                continue
+            # Warm start from the previous frame: consecutive frames share most colors
+            if centroids is not None and len(centroids) == k:
+                kmeans = KMeans(n_clusters=k, init=centroids, n_init=1, max_iter=50).fit(lab)
+            else:
+                kmeans = KMeans(n_clusters=k, random_state=random_state, n_init=1).fit(lab)
+            centroids = kmeans.cluster_centers_
+            counts = np.bincount(kmeans.labels_, minlength=k)
+
+        clip.add(centroids, counts)
+        segment.add(centroids, counts)
+        frames_sampled += 1
+
+    close_segment(frames_total - 1)
+    return {
+        "palette": clip.finalize(random_state),
+        "segments": segments,
+        "frames_total": frames_total,
+        "frames_sampled": frames_sampled,
+        "truncated": truncated,
+    }
+
+def extract_animated_palette_from_upload(file, filename="", **kwargs):
+    """
+    Handles an uploaded file object: animated images are streamed straight from
+    it, videos are spooled to a temporary file for ffmpeg.
+    """
+    if os.path.splitext(filename)[1].lower() not in VIDEO_EXTENSIONS:
+        return extract_animated_palette(file, **kwargs)
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(filename)[1]) as tmp:
+        shutil.copyfileobj(file, tmp)
+        tmp.flush()
+        return extract_animated_palette(tmp.name, **kwargs)
@@ -0,0 +1,127 @@
+# ai/weights.py
+"""
+Memory-mapped weight loading.
+
+torch.load on a pickled checkpoint reads every tensor into private memory, so
+each worker process pays for its own copy and for the full read at startup.
+A .safetensors file is a JSON header plus raw tensor bytes. load_state_dict()
+maps such a file with UntypedStorage.from_file and returns tensors that are
+views into the mapping, and models are built on the meta device and adopt
+those tensors with load_state_dict(assign=True). Nothing is copied: pages are
+read on first touch, and every process that maps the same file shares the
+same page-cache pages (the mapping is private, so a write would copy just
+that page).
+
+Checkpoints without a .safetensors sibling still load, through
+torch.load(mmap=True) when the file is in the zipfile format. The conversion
+records the SHA-256 of its source checkpoint in the safetensors metadata, and
+a sibling whose recorded hash does not match the checkpoint next to it (say,
+a retrained .pth committed without reconverting) is ignored as stale.
+File modification times are not used: git checkouts set them arbitrarily.
+
+Convert existing checkpoints (writes a .safetensors file next to each):
+    python weights.py palette_aesthetic_model.pth palette_policy.pth
+"""
+import os
+import sys
+import json
+import struct
+import hashlib
+
+import torch
+
+# safetensors dtype codes (https://github.com/huggingface/safetensors)
+_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8,
+    "U8": torch.uint8, "BOOL": torch.bool,
+}
+
+def safetensors_path(path):
+    return os.path.splitext(path)[0] + ".safetensors"
+
+def _read_header(path):
+    with open(path, "rb") as f:
+        header_len = struct.unpack("<Q", f.read(8))[0]
+        return header_len, json.loads(f.read(header_len))
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _mmap_safetensors(path):
+    header_len, header = _read_header(path)
+    header.pop("__metadata__", None)
+    nbytes = os.path.getsize(path)
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=nbytes)
+    mapped = torch.empty(0, dtype=torch.uint8).set_(storage)
+    base = 8 + header_len
+    state_dict = {}
+    for name, info in header.items():
+        begin, end = info["data_offsets"]
+        raw = mapped[base + begin:base + end]
+        try:
+            tensor = raw.view(_DTYPES[info["dtype"]])
+        except RuntimeError:
+            # Offset not aligned to the element size; this tensor alone is copied
+            tensor = raw.clone().view(_DTYPES[info["dtype"]])
+        state_dict[name] = tensor.reshape(info["shape"])
+    return state_dict
+
+def checkpoint_exists(path):
+    return os.path.exists(path) or os.path.exists(safetensors_path(path))
+
+def load_state_dict(path):
+    """
+    Returns (state_dict, source). Prefers the memory-mapped .safetensors
+    sibling of `path`; source is "safetensors-mmap", "torch-mmap" or "torch".
+    """
+    sibling = safetensors_path(path)
+    if os.path.exists(sibling) and (not os.path.exists(path) or is_converted_from(sibling, path)):
+        return _mmap_safetensors(sibling), "safetensors-mmap"
+    if os.path.exists(sibling):
+        print(f"⚠️ {sibling} was not converted from the current {path}; loading the checkpoint instead. "
+              f"Reconvert with `python weights.py {path}`.")
+    try:
+        return torch.load(path, map_location="cpu", mmap=True, weights_only=True), "torch-mmap"
+    except RuntimeError:
+        # Legacy (non-zipfile) checkpoints cannot be mapped
+        return torch.load(path, map_location="cpu", weights_only=True), "torch"
+
+def is_converted_from(sibling, path):
+    """True when the safetensors file records `path`'s current SHA-256 as its source."""
+    metadata = _read_header(sibling)[1].get("__metadata__") or {}
+    return metadata.get("source_sha256") == file_sha256(path)
+
+def build_module(factory, state_dict):
+    """
+    Constructs factory() on the meta device (no parameter allocation) and
+    adopts the state dict's tensors as its parameters.
+    """
+    with torch.device("meta"):
+        module = factory()
+    module.load_state_dict(state_dict, assign=True)
+    module.eval()
+    return module
+
+def convert_to_safetensors(path, out=None):
+    """
+    Writes `path`'s state dict as safetensors (default: the .safetensors sibling),
+    recording the checkpoint's SHA-256 so load_state_dict can tell when it goes stale.
+    """
+    from safetensors.torch import save_file
+
+    state_dict = torch.load(path, map_location="cpu", weights_only=True)
+    out = out or safetensors_path(path)
+    save_file({k: v.contiguous() for k, v in state_dict.items()}, out,
+              metadata={"format": "pt", "source_sha256": file_sha256(path)})
+    return out
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit("usage: python weights.py CHECKPOINT.pth [...]")
+    for checkpoint in sys.argv[1:]:
+        print(f"✅ {checkpoint} -> {convert_to_safetensors(checkpoint)}")